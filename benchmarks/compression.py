@@ -0,0 +1,88 @@
+"""
+Compares the gdal_retile compression profiles on tiles of a real raster.
+
+Tiles are cut from the input, encoded to /vsimem with every profile that
+fits the data and the encode throughput (MB of raw pixels per second) and
+the size relative to uncompressed tiles are reported:
+
+    python benchmarks/compression.py input.tiff --tiles 200 --size 256
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "geoutils"))
+
+from osgeo import gdal
+
+import gdal_retile
+
+PROFILES = ("none", "fast", "small", "lossy")
+
+
+def read_tiles(fileName, count, size):
+    """ returns up to count MEM datasets of size x size pixels cut from fileName """
+    src = gdal.Open(fileName)
+    mem = gdal.GetDriverByName("MEM")
+    tiles = []
+    for yoff in range(0, src.RasterYSize - size + 1, size):
+        for xoff in range(0, src.RasterXSize - size + 1, size):
+            if len(tiles) == count:
+                return tiles
+            tile = mem.Create("", size, size, src.RasterCount, src.GetRasterBand(1).DataType)
+            for band in range(1, src.RasterCount + 1):
+                data = src.GetRasterBand(band).ReadRaster(xoff, yoff, size, size)
+                tile.GetRasterBand(band).WriteRaster(0, 0, size, size, data)
+            tiles.append(tile)
+    return tiles
+
+
+def encode(tiles, options):
+    """ returns the seconds and bytes needed to encode tiles as GTiff """
+    driver = gdal.GetDriverByName("GTiff")
+    total = 0
+    start = time.time()
+    for index, tile in enumerate(tiles):
+        name = "/vsimem/compression_%d.tif" % index
+        driver.CreateCopy(name, tile, 0, options)
+        total += gdal.VSIStatL(name).size
+        gdal.Unlink(name)
+    return time.time() - start, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="Raster to cut the tiles from")
+    parser.add_argument("--tiles", type=int, default=100, help="Number of tiles")
+    parser.add_argument("--size", type=int, default=256, help="Tile width and height")
+    args = parser.parse_args()
+
+    tiles = read_tiles(args.input, args.tiles, args.size)
+    if not tiles:
+        parser.error("%s is smaller than one tile" % args.input)
+    bandType = tiles[0].GetRasterBand(1).DataType
+    bands = tiles[0].RasterCount
+    raw = len(tiles) * args.size * args.size * bands * gdal.GetDataTypeSize(bandType) // 8
+    driver = gdal.GetDriverByName("GTiff")
+
+    print("%d tiles of %dx%dx%d %s" % (len(tiles), args.size, args.size, bands,
+                                        gdal.GetDataTypeName(bandType)))
+    print("{:<8} {:>10} {:>8}  {}".format("profile", "MB/s", "size", "options"))
+    for profile in PROFILES:
+        if profile == "none":
+            options = []
+        else:
+            options = gdal_retile.getProfileOptions(profile, driver, bandType, bands)
+        if options is None:
+            print("{:<8} {:>10} {:>8}".format(profile, "-", "-"))
+            continue
+        seconds, size = encode(tiles, options)
+        print("{:<8} {:>10.1f} {:>7.1f}%  {}".format(
+            profile, raw / 1e6 / seconds, 100.0 * size / raw, " ".join(options)))
+
+
+if __name__ == "__main__":
+    main()
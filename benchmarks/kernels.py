@@ -0,0 +1,96 @@
+"""
+Compares the -reduce kernels with the gdal.ReprojectImage pyramid path.
+
+Every tile of 2*size x 2*size pixels, with a share of nodata pixels, is
+halved by each kernel and, if GDAL is installed, by gdal.ReprojectImage
+with the -r resampling methods as createPyramidTile does without -reduce.
+The throughput is reported in megapixels of the source tiles per second:
+
+    python benchmarks/kernels.py --tiles 200 --size 256 --type float32
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "geoutils"))
+
+import kernels
+
+try:
+    from osgeo import gdal, gdal_array
+except ImportError:
+    gdal = None
+
+NODATA = -9999
+RESAMPLING = ("near", "bilinear", "average", "mode")
+
+
+def make_tiles(count, size, dtype, nodata_share):
+    """ returns count (2*size, 2*size) arrays with random nodata pixels """
+    random = numpy.random.RandomState(0)
+    tiles = []
+    for _ in range(count):
+        tile = random.randint(0, 200, (2 * size, 2 * size)).astype(dtype)
+        tile[random.random_sample(tile.shape) < nodata_share] = NODATA
+        tiles.append(tile)
+    return tiles
+
+
+def run_kernel(tiles, method):
+    start = time.time()
+    for tile in tiles:
+        kernels.downsample(tile, method, NODATA)
+    return time.time() - start
+
+
+def run_reproject(tiles, method):
+    resampling = {"near": gdal.GRA_NearestNeighbour, "bilinear": gdal.GRA_Bilinear,
+                  "average": gdal.GRA_Average, "mode": gdal.GRA_Mode}[method]
+    mem = gdal.GetDriverByName("MEM")
+    size = tiles[0].shape[0] // 2
+    bandType = gdal_array.NumericTypeCodeToGDALTypeCode(tiles[0].dtype)
+    start = time.time()
+    for tile in tiles:
+        source = gdal_array.OpenArray(tile)
+        source.SetGeoTransform([0, 1, 0, 0, 0, -1])
+        source.GetRasterBand(1).SetNoDataValue(NODATA)
+        target = mem.Create("", size, size, 1, bandType)
+        target.SetGeoTransform([0, 2, 0, 0, 0, -2])
+        target.GetRasterBand(1).SetNoDataValue(NODATA)
+        target.GetRasterBand(1).Fill(NODATA)
+        gdal.ReprojectImage(source, target, None, None, resampling)
+        target.GetRasterBand(1).ReadAsArray()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tiles", type=int, default=100, help="Number of tiles")
+    parser.add_argument("--size", type=int, default=256, help="Width and height of the reduced tiles")
+    parser.add_argument("--type", default="float32", help="NumPy data type of the tiles, which holds -9999")
+    parser.add_argument("--nodata", type=float, default=0.1, help="Share of nodata pixels")
+    args = parser.parse_args()
+
+    tiles = make_tiles(args.tiles, args.size, numpy.dtype(args.type), args.nodata)
+    pixels = len(tiles) * tiles[0].size / 1e6
+
+    print("%d tiles of %dx%d %s, %.0f%% nodata" % (len(tiles), 2 * args.size, 2 * args.size,
+                                                   args.type, 100 * args.nodata))
+    print("{:<24} {:>10}".format("method", "MP/s"))
+    for method in kernels.METHODS:
+        print("{:<24} {:>10.1f}".format("-reduce " + method, pixels / run_kernel(tiles, method)))
+    if gdal is None:
+        print("ReprojectImage: skipped, GDAL is not installed")
+        return
+    for method in RESAMPLING:
+        print("{:<24} {:>10.1f}".format("ReprojectImage " + method,
+                                        pixels / run_reproject(tiles, method)))
+
+
+if __name__ == "__main__":
+    main()
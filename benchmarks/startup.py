@@ -0,0 +1,96 @@
+"""
+Measures the startup time of the command line tools.
+
+Every command is run in a fresh interpreter and the median wall clock time
+of several runs is reported next to the cost of a bare interpreter and of
+importing GDAL, which --help and usage errors should no longer pay:
+
+    python benchmarks/startup.py --runs 20
+
+Given a file, the time to open it repeatedly is also reported with all GDAL
+drivers registered and with the drivers hdf2tiff --prune-drivers keeps:
+
+    python benchmarks/startup.py --runs 20 --file input.hdf --opens 100
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+GEOUTILS = os.path.join(ROOT, "geoutils")
+
+COMMANDS = [
+    ("interpreter", ["-c", "pass"]),
+    ("import gdal", ["-c", "from osgeo import gdal"]),
+    ("hdf2tiff --help", [os.path.join(GEOUTILS, "hdf2tiff.py"), "--help"]),
+    ("hdf2tiff bad option", [os.path.join(GEOUTILS, "hdf2tiff.py"), "--chunk-size", "x", "a.hdf"]),
+    ("gdal_retile usage error", [os.path.join(GEOUTILS, "gdal_retile.py"), "-ps", "256", "256"]),
+    ("import tiff2tile", ["-c", "import tiff2tile"]),
+]
+
+OPEN_FILE = """
+import sys, hdf2tiff
+if sys.argv[1] == "pruned":
+    hdf2tiff.prune_gdal_drivers()
+for _ in range(int(sys.argv[3])):
+    hdf2tiff.gdal.Open(sys.argv[2])
+"""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(args, runs):
+    """
+    Returns the median wall clock time of running args, or raises
+    RuntimeError with the last line of the traceback if the command
+    crashed, e.g. because GDAL or click are not installed
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [GEOUTILS, env.get("PYTHONPATH")]))
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(runs):
+            start = time.time()
+            process = subprocess.Popen([sys.executable] + args, stdout=devnull,
+                                       stderr=subprocess.PIPE, env=env)
+            _, stderr = process.communicate()
+            timings.append(time.time() - start)
+            lines = stderr.decode("utf-8", "replace").strip().splitlines()
+            if lines and re.match(r"[\w.]*(Error|Exception)\b", lines[-1]):
+                raise RuntimeError(lines[-1])
+    return median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="Runs per command")
+    parser.add_argument("--file", help="File opened to compare all and pruned drivers")
+    parser.add_argument("--opens", type=int, default=100, help="Opens of --file per run")
+    args = parser.parse_args()
+
+    commands = list(COMMANDS)
+    if args.file:
+        for drivers in ("all", "pruned"):
+            commands.append(("{} x open, {} drivers".format(args.opens, drivers),
+                             ["-c", OPEN_FILE, drivers, args.file, str(args.opens)]))
+
+    for name, command in commands:
+        try:
+            print("{:<28} {:8.1f} ms".format(name, measure(command, args.runs) * 1000))
+        except RuntimeError as e:
+            print("{:<28} failed: {}".format(name, e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Load tests a running tile server with concurrent requests.
+
+Tiles of one level are requested by several client threads, drawn from a
+small hot set with probability --hot so the caches are exercised, and the
+throughput, the p50/p99 latency and where the tiles came from (memory,
+disk, render or a coalesced render) are reported:
+
+    python geoutils/tileserver.py -levels 4 input.tiff &
+    python benchmarks/tileserver.py --level 2 --requests 2000 --clients 16
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import random
+import threading
+import time
+
+try:
+    from urllib2 import HTTPError, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def fetch(url):
+    """ returns the HTTP status and the X-Tile-Source header of url """
+    try:
+        response = urlopen(url)
+        response.read()
+        return response.getcode(), response.info().get("X-Tile-Source")
+    except HTTPError as e:
+        return e.code, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Tile server")
+    parser.add_argument("--level", type=int, default=0, help="Level to request")
+    parser.add_argument("--requests", type=int, default=1000, help="Number of requests")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--hot", type=float, default=0.8,
+                        help="Fraction of the requests going to the hot tiles")
+    parser.add_argument("--hot-tiles", type=int, default=16, help="Number of hot tiles")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    info = json.loads(urlopen(args.url + "/info").read().decode("utf-8"))
+    grid = info["levels"][args.level]
+    tiles = [(col, row) for row in range(grid["countTilesY"]) for col in range(grid["countTilesX"])]
+
+    rng = random.Random(args.seed)
+    hot = rng.sample(tiles, min(args.hot_tiles, len(tiles)))
+    urls = []
+    for _ in range(args.requests):
+        col, row = rng.choice(hot if rng.random() < args.hot else tiles)
+        urls.append("%s/%d/%d/%d" % (args.url, args.level, col, row))
+
+    latencies = []
+    statuses = collections.Counter()
+    sources = collections.Counter()
+    lock = threading.Lock()
+    pending = list(reversed(urls))
+
+    def client():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                url = pending.pop()
+            start = time.time()
+            status, source = fetch(url)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+                sources[source or "-"] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print("{} requests in {:.2f} s: {:.1f} tiles/s".format(len(latencies), elapsed,
+                                                            len(latencies) / elapsed))
+    print("latency p50 {:.1f} ms, p99 {:.1f} ms".format(percentile(latencies, 0.5) * 1000,
+                                                         percentile(latencies, 0.99) * 1000))
+    print("status   " + ", ".join("{}: {}".format(k, v) for k, v in sorted(statuses.items())))
+    print("source   " + ", ".join("{}: {}".format(k, v) for k, v in sorted(sources.items())))
+
+
+if __name__ == "__main__":
+    main()
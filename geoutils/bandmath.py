@@ -0,0 +1,130 @@
+"""
+Band math expressions such as "(b4-b3)/(b4+b3)" evaluated with NumPy.
+
+Bands are referred to as b<N> with N indexed from 1 like the -b option.
+Expressions are validated and compiled once, then evaluated on whole
+blocks of pixels at a time. numexpr is used when it is installed.
+"""
+import ast
+import re
+
+from utils import LazyModule
+
+numpy = LazyModule("numpy")
+
+FUNCTIONS = ("abs", "sqrt", "exp", "log", "log10", "sin", "cos", "tan",
+             "arctan2", "where")
+
+BAND_NAME = re.compile(r"^b([0-9]+)$")
+
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call,
+                  ast.Name, ast.Load, ast.operator, ast.unaryop, ast.cmpop)
+if hasattr(ast, "Constant"):
+    _ALLOWED_NODES += (ast.Constant,)
+if hasattr(ast, "Num"):
+    _ALLOWED_NODES += (ast.Num,)
+
+_kernels = {}
+
+
+def band_numbers(expression):
+    """
+    Validates expression and returns the band numbers it uses
+
+    :param expression: Band math expression
+    :return: Sorted list of band numbers (indexed from 1)
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        raise ValueError("Invalid band expression: {}".format(expression))
+
+    bands = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError("Unsupported syntax in band expression: {}".format(expression))
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise ValueError("Unsupported function in band expression: {}".format(expression))
+        elif isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+            match = BAND_NAME.match(node.id)
+            if match is None or int(match.group(1)) < 1:
+                raise ValueError("Unknown band '{}' in band expression: {}".format(node.id, expression))
+            bands.add(int(match.group(1)))
+
+    if not bands:
+        raise ValueError("Band expression uses no bands: {}".format(expression))
+    return sorted(bands)
+
+
+def compile_expression(expression):
+    """
+    Compiles expression into a kernel taking a dictionary of band arrays
+    ({"b4": array, ...}) and returning the result as a Float32 array.
+    Kernels are cached so every expression is only compiled once.
+
+    :param expression: Band math expression
+    :return: Kernel function
+    """
+    if expression in _kernels:
+        return _kernels[expression]
+
+    band_numbers(expression)
+
+    try:
+        import numexpr
+    except ImportError:
+        numexpr = None
+
+    if numexpr is not None:
+        def kernel(arrays):
+            return numexpr.evaluate(expression, local_dict=arrays).astype(numpy.float32)
+    else:
+        code = compile(expression, "<band expression>", "eval")
+        functions = dict((name, getattr(numpy, name)) for name in FUNCTIONS)
+
+        def kernel(arrays):
+            names = dict(functions)
+            names.update(arrays)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                result = eval(code, {"__builtins__": {}}, names)
+            return numpy.asarray(result, dtype=numpy.float32)
+
+    _kernels[expression] = kernel
+    return kernel
+
+
+def evaluate(expression, arrays, nodata=None):
+    """
+    Evaluates expression on a block of pixels
+
+    :param expression: Band math expression
+    :param arrays: Dictionary of band arrays, {"b4": array, ...}
+    :param nodata: Pixels where any input band equals nodata, or where the
+                   result is not finite, are set to nodata
+    :return: Float32 NumPy array
+    """
+    arrays = dict((name, numpy.asarray(array, dtype=numpy.float32))
+                  for name, array in arrays.items())
+    result = compile_expression(expression)(arrays)
+    if nodata is None:
+        return result
+
+    valid = numpy.isfinite(result)
+    for array in arrays.values():
+        valid &= array != nodata
+    return numpy.where(valid, result, numpy.float32(nodata)).astype(numpy.float32)
+
+
+def pixel_function(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize,
+                   raster_ysize, buf_radius, gt, **kwargs):
+    """
+    GDAL VRT Python pixel function evaluating the band expression given in
+    the pixel function arguments "expression", "bands" (comma separated band
+    numbers matching the sources) and "nodata"
+    """
+    names = ["b" + band for band in kwargs["bands"].split(",")]
+    nodata = kwargs.get("nodata")
+    if nodata is not None:
+        nodata = float(nodata)
+    out_ar[:] = evaluate(kwargs["expression"], dict(zip(names, in_ar)), nodata)
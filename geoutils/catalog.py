@@ -0,0 +1,229 @@
+"""
+Searchable catalog of HDF inputs by tile, year, month and day of year.
+
+WELD file names carry everything needed to select inputs, e.g.
+
+    L57.Globe.month07.2011.hh09vv04.h6v1.doy182to212.NBAR.v3.0.hdf
+
+is tile h09v04 (sub tile h6v1) of July 2011, days 182 to 212. Names are
+parsed without opening the files; only files whose names do not follow
+the convention are opened once to read their Mean_JDOY metadata. The
+results are kept in an indexed SQLite file keyed by path, size and mtime,
+so later selections only query the catalog.
+"""
+import datetime
+import multiprocessing
+import os
+import re
+import sqlite3
+
+import click
+from utils import LazyModule, QueryParamType
+
+gdal = LazyModule("gdal")
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS inputs (path TEXT PRIMARY KEY, size INTEGER, "
+    "mtime REAL, tile TEXT, subtile TEXT, year INTEGER, month INTEGER, "
+    "doy_start INTEGER, doy_end INTEGER)",
+    "CREATE INDEX IF NOT EXISTS inputs_tile ON inputs (tile, year, month)",
+    "CREATE INDEX IF NOT EXISTS inputs_date ON inputs (year, doy_start, doy_end)",
+]
+
+FIELDS = ("tile", "subtile", "year", "month", "doy_start", "doy_end")
+
+TILE = re.compile(r"^hh([0-9]+)vv([0-9]+)$")
+SUBTILE = re.compile(r"^h([0-9]+)v([0-9]+)$")
+MONTH = re.compile(r"^month([0-9]{2})$")
+YEAR = re.compile(r"^([0-9]{4})$")
+DOY_RANGE = re.compile(r"^doy([0-9]+)to([0-9]+)$")
+
+
+def get_month(year, doy):
+    """ Returns the month (1-12) of a day of the year """
+    return (datetime.date(year, 1, 1) + datetime.timedelta(doy - 1)).month
+
+
+def parse_name(path, partial=False):
+    """
+    Extracts the tile, year, month and day of year range from a WELD
+    file name
+
+    :param path: HDF file
+    :param partial: Return the fields found even if some are missing
+    :return: Dictionary of FIELDS, None if the name has no tile and year
+    """
+    fields = dict.fromkeys(FIELDS)
+    for part in os.path.basename(path).split("."):
+        if TILE.match(part):
+            fields["tile"] = "h{:02d}v{:02d}".format(*[int(n) for n in TILE.match(part).groups()])
+        elif SUBTILE.match(part):
+            fields["subtile"] = part
+        elif MONTH.match(part):
+            fields["month"] = int(MONTH.match(part).group(1))
+        elif YEAR.match(part) and fields["year"] is None:
+            fields["year"] = int(part)
+        elif DOY_RANGE.match(part):
+            fields["doy_start"], fields["doy_end"] = [int(n) for n in DOY_RANGE.match(part).groups()]
+
+    if not partial and (fields["tile"] is None or fields["year"] is None):
+        return None
+    if fields["year"] is not None and fields["month"] is None and fields["doy_start"] is not None:
+        fields["month"] = get_month(fields["year"], fields["doy_start"])
+    return fields
+
+
+def read_fields(path):
+    """
+    Extracts the FIELDS of path from its name, or else from the Mean_JDOY
+    metadata of the file (runs in the worker processes)
+
+    :param path: HDF file
+    :return: (path, dictionary of FIELDS), None if the file can not be read
+    """
+    fields = parse_name(path)
+    if fields is not None:
+        return (path, fields)
+
+    fields = parse_name(path, partial=True)
+    dataset = gdal.Open(path, gdal.GA_ReadOnly)
+    if dataset is None:
+        return (path, None)
+    metadata = dataset.GetMetadata()
+    if "Mean_JDOY" in metadata and fields["doy_start"] is None:
+        fields["doy_start"] = fields["doy_end"] = int(float(metadata["Mean_JDOY"]))
+        if fields["year"] is not None:
+            fields["month"] = get_month(fields["year"], fields["doy_start"])
+    return (path, fields)
+
+
+def find_hdf_files(paths):
+    """ Returns the HDF files among paths and inside the directories among them """
+    hdf_files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            hdf_files.append(os.path.abspath(path))
+            continue
+        for root, _, names in os.walk(path):
+            hdf_files += [os.path.abspath(os.path.join(root, name))
+                          for name in sorted(names) if name.lower().endswith(".hdf")]
+    return hdf_files
+
+
+class HDFCatalog(object):
+    """
+    A class indexing HDF files by tile and date, for example:
+
+        catalog = HDFCatalog("hdf_catalog.sqlite")
+        catalog.update(["data/"])
+        july = catalog.query(tile="h09v04", year=2011, month=7)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def update(self, paths, jobs=1):
+        """
+        Adds the HDF files among paths (and inside directories) which are
+        new or changed since they were cataloged
+
+        :param paths: HDF files and directories
+        :param jobs: Number of processes reading the metadata of files
+                     whose names do not follow the WELD convention
+        :return: Number of files added
+        """
+        known = dict((row[0], (row[1], row[2])) for row in
+                     self.connection.execute("SELECT path, size, mtime FROM inputs"))
+
+        stats = {}
+        for path in find_hdf_files(paths):
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                stats[path] = (stat.st_size, stat.st_mtime)
+
+        # Only names without tile and year need the files to be opened
+        results = []
+        unparsed = []
+        for path in sorted(stats):
+            fields = parse_name(path)
+            if fields is None:
+                unparsed.append(path)
+            else:
+                results.append((path, fields))
+
+        if jobs > 1 and len(unparsed) > 1:
+            pool = multiprocessing.Pool(jobs)
+            results += pool.map(read_fields, unparsed)
+            pool.close()
+            pool.join()
+        else:
+            results += [read_fields(path) for path in unparsed]
+
+        rows = [(path,) + stats[path] + tuple(fields[field] for field in FIELDS)
+                for path, fields in results if fields is not None]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        return len(rows)
+
+    def query(self, tile=None, subtile=None, year=None, month=None, doy=None):
+        """
+        Returns the cataloged files matching every given criterion
+
+        :param tile: Tile ID, e.g. h09v04
+        :param subtile: Sub tile ID, e.g. h6v1
+        :param year: Year
+        :param month: Month (1-12)
+        :param doy: Day of the year, or (first, last) range of days, the
+                    files whose day of year range overlaps it match
+        :return: Sorted list of paths which still exist
+        """
+        clauses = []
+        values = []
+        for field, value in (("tile", tile), ("subtile", subtile),
+                             ("year", year), ("month", month)):
+            if value is not None:
+                clauses.append("{} = ?".format(field))
+                values.append(value)
+        if doy is not None:
+            first, last = doy if isinstance(doy, tuple) else (doy, doy)
+            clauses.append("doy_start <= ? AND doy_end >= ?")
+            values += [last, first]
+
+        sql = "SELECT path FROM inputs"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        rows = self.connection.execute(sql + " ORDER BY path", values)
+        return [row[0] for row in rows if os.path.exists(row[0])]
+
+    def close(self):
+        self.connection.close()
+
+
+@click.command()
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+@click.option('-c', '--catalog', default="hdf_catalog.sqlite",
+              type=click.Path(dir_okay=False),
+              help="Catalog file")
+@click.option('-q', '--query', default=None, type=QueryParamType(),
+              help="Only list the files matching e.g. tile=h09v04,year=2011,month=7 "
+                   "(also subtile and doy=N or doy=first-last)")
+@click.option('-j', '--jobs', default=1,
+              help="Number of processes reading metadata")
+def main(paths, catalog, query, jobs):
+    """ Catalogs the HDF files in PATHS and lists the files matching the query """
+    hdf_catalog = HDFCatalog(catalog)
+    try:
+        if paths:
+            hdf_catalog.update(paths, jobs)
+        for path in hdf_catalog.query(**(query or {})):
+            click.echo(path)
+    finally:
+        hdf_catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Content addressed storage of encoded tiles.
+
+Every distinct tile payload is written once into a blob directory, named by
+its SHA-1, and each tile file is a hard link to its blob, so tiles which
+encode to the same bytes (empty ocean, masked or saturated areas) cost the
+write I/O and storage of one. Blobs are renamed into place and tiles are
+linked atomically, so several processes may share one store. Blobs which no
+tile links to any more are only removed by prune, once no other process is
+writing to the store.
+"""
+import errno
+import hashlib
+import os
+import tempfile
+
+
+class TileBlobStore(object):
+    """
+    A class writing tiles as hard links to deduplicated payloads, for example:
+
+        blobs = TileBlobStore("tiles/.dedupe")
+        blobs.write("tiles/0/tile_1_1.png", data)
+        tiles, unique, size, stored = blobs.getStats()
+        blobs.prune()
+    """
+
+    def __init__(self, dirName):
+        self.dirName = dirName
+
+    def blobPath(self, digest):
+        # fan out over 256 directories to keep them small
+        return os.path.join(self.dirName, digest[:2], digest)
+
+    def writeBlob(self, blob, data):
+        dirName = os.path.dirname(blob)
+        try:
+            os.makedirs(dirName)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tempName = tempfile.mkstemp(prefix=".tmp", dir=dirName)
+        fh = os.fdopen(fd, "wb")
+        fh.write(data)
+        fh.close()
+        try:
+            os.rename(tempName, blob)
+        except OSError:
+            # another process stored the same payload first
+            os.remove(tempName)
+
+    def write(self, fileName, data):
+        """ writes the encoded tile data to fileName, linked to its payload """
+        blob = self.blobPath(hashlib.sha1(data).hexdigest())
+        if not os.path.exists(blob):
+            self.writeBlob(blob, data)
+
+        # a tile written before may share its inode with other tiles
+        if os.path.lexists(fileName):
+            os.remove(fileName)
+        try:
+            os.link(blob, fileName)
+        except (AttributeError, OSError):
+            # file systems without hard links get a copy
+            fh = open(fileName, "wb")
+            fh.write(data)
+            fh.close()
+
+    def iterBlobs(self):
+        """ yields the path and os.stat result of every stored blob """
+        for root, dirs, names in os.walk(self.dirName):
+            for name in names:
+                # skip the temporary files of blobs being written
+                if not name.startswith("."):
+                    path = os.path.join(root, name)
+                    yield path, os.stat(path)
+
+    def getStats(self):
+        """
+        returns the number of tiles, of unique payloads, the bytes of all
+        tiles and the bytes stored; blobs which no tile links to are not
+        counted
+        """
+        tiles = unique = size = stored = 0
+        for path, stat in self.iterBlobs():
+            links = stat.st_nlink - 1
+            if links > 0:
+                tiles += links
+                unique += 1
+                size += links * stat.st_size
+                stored += stat.st_size
+        return tiles, unique, size, stored
+
+    def prune(self):
+        """
+        removes the blobs which no tile links to any more and returns their
+        number; a blob is linked right after it is stored, so this must not
+        run while other processes, e.g. shards, write to the store
+        """
+        removed = 0
+        for path, stat in self.iterBlobs():
+            if stat.st_nlink == 1:
+                os.remove(path)
+                removed += 1
+        return removed
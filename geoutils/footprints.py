@@ -0,0 +1,140 @@
+"""
+Persistent catalog of the footprints (geotransform and size) of rasters.
+
+Entries are keyed by the absolute path of a raster together with its file
+size and modification time, so a raster that changed is read again while
+unchanged rasters are never opened. Missing entries are read in parallel
+worker processes and stored in one SQLite transaction.
+"""
+import multiprocessing
+import os
+import sqlite3
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS footprints (path TEXT PRIMARY KEY, size INTEGER, "
+    "mtime REAL, xsize INTEGER, ysize INTEGER, gt0 REAL, gt1 REAL, gt2 REAL, "
+    "gt3 REAL, gt4 REAL, gt5 REAL)",
+]
+
+SELECT_FOOTPRINT = ("SELECT size, mtime, xsize, ysize, gt0, gt1, gt2, gt3, gt4, gt5 "
+                    "FROM footprints WHERE path = ?")
+SELECT_ALL = ("SELECT path, size, mtime, xsize, ysize, gt0, gt1, gt2, gt3, gt4, gt5 "
+              "FROM footprints")
+DELETE_FOOTPRINT = "DELETE FROM footprints WHERE path = ?"
+INSERT_FOOTPRINT = ("INSERT OR REPLACE INTO footprints VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def readFootprint(path):
+    """
+    opens path and returns (path, (geotransform, xsize, ysize)), or
+    (path, None) if it is not a raster; runs in the worker processes
+    """
+    from osgeo import gdal
+    ds = gdal.Open(path)
+    if ds is None:
+        return (path, None)
+    return (path, (tuple(ds.GetGeoTransform()), ds.RasterXSize, ds.RasterYSize))
+
+
+class FootprintCatalog(object):
+    """
+    A class caching raster footprints in an SQLite file, for example:
+
+        catalog = FootprintCatalog("footprints.sqlite")
+        footprints = catalog.getFootprints(names, processes=8)
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.connection = sqlite3.connect(fileName)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def _stat(self, path):
+        """ returns (size, mtime) of path, or None if it can not be stat'ed """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def lookup(self, path):
+        """
+        returns the cached (geotransform, xsize, ysize) of path or None if
+        stale, which includes paths that are missing or can not be stat'ed
+        """
+        row = self.connection.execute(SELECT_FOOTPRINT, (os.path.abspath(path),)).fetchone()
+        if row is None or (row[0], row[1]) != self._stat(path):
+            return None
+        return (tuple(row[4:10]), row[2], row[3])
+
+    def getChanges(self, paths):
+        """
+        compares the catalog with paths, e.g. to find what changed since a
+        previous run recorded its inputs
+
+        returns the cataloged footprints of all entries, the cataloged
+        footprints of the entries which changed or are not in paths any
+        more, and the paths which are new or changed
+        """
+        current = dict((os.path.abspath(path), path) for path in paths)
+        footprints = []
+        stale = []
+        for row in self.connection.execute(SELECT_ALL):
+            footprint = (tuple(row[5:11]), row[3], row[4])
+            footprints.append(footprint)
+            path = current.pop(row[0], None)
+            if path is None or (row[1], row[2]) != self._stat(path):
+                stale.append(footprint)
+                if path is not None:
+                    current[row[0]] = path
+        return footprints, stale, sorted(current.values())
+
+    def remove(self, paths):
+        """ removes the entries of paths which are cataloged """
+        self.connection.executemany(DELETE_FOOTPRINT,
+                                    [(os.path.abspath(path),) for path in paths])
+        self.connection.commit()
+
+    def getPaths(self):
+        return [row[0] for row in self.connection.execute("SELECT path FROM footprints")]
+
+    def getFootprints(self, paths, processes=1):
+        """
+        returns a list with the (geotransform, xsize, ysize) of every path,
+        None for paths which are not rasters
+
+        footprints missing from the catalog are read with processes workers
+        and added to it
+        """
+        footprints = dict((path, self.lookup(path)) for path in paths)
+        missing = [path for path, footprint in footprints.items() if footprint is None]
+
+        if len(missing) > 0:
+            if processes > 1 and len(missing) > 1:
+                pool = multiprocessing.Pool(processes)
+                results = pool.imap_unordered(readFootprint, missing, 64)
+            else:
+                pool = None
+                results = (readFootprint(path) for path in missing)
+
+            rows = []
+            for path, footprint in results:
+                footprints[path] = footprint
+                stat = self._stat(path)
+                if footprint is not None and stat is not None:
+                    geotransform, xsize, ysize = footprint
+                    rows.append((os.path.abspath(path),) + stat + (xsize, ysize) + geotransform)
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            self.connection.executemany(INSERT_FOOTPRINT, rows)
+            self.connection.commit()
+
+        return [footprints[path] for path in paths]
+
+    def close(self):
+        self.connection.close()
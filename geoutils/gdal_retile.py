@@ -29,18 +29,38 @@
 # DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import errno
 import math
+import multiprocessing
 import os
+import re
 import sys
-
-from osgeo import gdal
-from osgeo import ogr
-from osgeo import osr
+import tempfile
+import threading
+import time
 
 try:
-    progress = gdal.TermProgress_nocb
-except:
-    progress = gdal.TermProgress
+    import Queue as queue
+except ImportError:
+    import queue
+
+import mercator
+from utils import LazyModule
+
+# GDAL and NumPy are only imported once they are used, so that usage
+# errors are reported without loading them
+numpy = LazyModule("numpy")
+gdal = LazyModule("osgeo.gdal")
+gdal_array = LazyModule("osgeo.gdal_array")
+ogr = LazyModule("osgeo.ogr")
+osr = LazyModule("osgeo.osr")
+
+def progress(complete):
+    try:
+        termProgress = gdal.TermProgress_nocb
+    except:
+        termProgress = gdal.TermProgress
+    termProgress(complete)
 
 class AffineTransformDecorator:
     """ A class providing some useful methods for affine Transformations """
@@ -80,7 +100,10 @@ class DataSetCache:
 
         if name in self.dict:
             return self.dict[name]
-        result = gdal.Open(name)
+        if TileSink is not None and TileSink.owns(name):
+            result = TileSink.open(name)
+        else:
+            result = gdal.Open(name)
         if result is None:
             print("Error opening: %s" % NameError)
             sys.exit(1)
@@ -98,6 +121,270 @@ class DataSetCache:
 
 
 
+class TileJournal:
+    """
+    An append only journal of the finished tiles and levels, used by -resume
+
+    Lines are tab separated: a header with the tile grid, one line per
+    finished tile (level, x, y, tile name or "-" if empty) and one per
+    finished level. Writes are fsync'd every batchSize tiles.
+    """
+    def __init__(self, fileName, batchSize):
+        self.fileName=fileName
+        self.batchSize=batchSize
+        self.header=None
+        self.tiles={}
+        self.levels=set()
+        self.last={}
+        if os.path.exists(fileName):
+            self.load()
+        self.fh=open(fileName, "a")
+        self.pending=0
+
+    def load(self):
+        # a torn write at the end of the journal is cut off
+        fh=open(self.fileName, "rb")
+        data=fh.read()
+        fh.close()
+        end=data.rfind(b"\n")+1
+        if end<len(data):
+            fh=open(self.fileName, "r+b")
+            fh.truncate(end)
+            fh.close()
+
+        fh=open(self.fileName)
+        for line in fh:
+            parts=line[:-1].split("\t", 4)
+            if parts[0]=="grid":
+                self.header=line
+            elif parts[0]=="tile":
+                key=(int(parts[1]), int(parts[2]), int(parts[3]))
+                if parts[4]=="-":
+                    self.tiles[key]=None
+                else:
+                    self.tiles[key]=parts[4]
+                self.last[key[0]]=key
+            elif parts[0]=="level":
+                self.levels.add(int(parts[1]))
+        fh.close()
+
+    def begin(self, tileWidth, tileHeight, xsize, ysize):
+        """
+        writes the grid header, returns False if the journal was written
+        for a different grid
+        """
+        header="grid\t%d\t%d\t%d\t%d\n" % (tileWidth, tileHeight, xsize, ysize)
+        if self.header is None:
+            self.header=header
+            self.fh.write(header)
+            self.sync()
+        return self.header==header
+
+    def validate(self):
+        """
+        forgets the last tile of every unfinished level unless it can be
+        read back, it may have been written only partially
+        """
+        gdal.PushErrorHandler('CPLQuietErrorHandler')
+        for level, key in self.last.items():
+            tileName=self.tiles.get(key)
+            if level in self.levels or tileName is None:
+                continue
+            valid=False
+            ds=gdal.Open(tileName)
+            if ds is not None:
+                gdal.ErrorReset()
+                try:
+                    for band in range(1, ds.RasterCount+1):
+                        ds.GetRasterBand(band).Checksum()
+                    valid=gdal.GetLastErrorType()<gdal.CE_Failure
+                except RuntimeError:
+                    valid=False
+            ds=None
+            if not valid:
+                if Verbose:
+                    print("Rendering %s again" % tileName)
+                del self.tiles[key]
+        gdal.PopErrorHandler()
+
+    def hasTile(self, level, xIndex, yIndex):
+        return (level, xIndex, yIndex) in self.tiles
+
+    def tileName(self, level, xIndex, yIndex):
+        return self.tiles[(level, xIndex, yIndex)]
+
+    def hasLevel(self, level):
+        return level in self.levels
+
+    def addTile(self, level, xIndex, yIndex, tileName):
+        self.fh.write("tile\t%d\t%d\t%d\t%s\n" % (level, xIndex, yIndex, tileName or "-"))
+        self.pending+=1
+        if self.pending>=self.batchSize:
+            self.sync()
+
+    def addLevel(self, level):
+        self.fh.write("level\t%d\n" % level)
+        self.sync()
+
+    def sync(self):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.pending=0
+
+    def close(self):
+        self.sync()
+        self.fh.close()
+
+
+class TilePipeline:
+    """
+    Renders the tiles of level 0 in three overlapping stages, used by -pipeline
+
+    A reader thread reads the source windows of the next tiles, this thread
+    encodes them in memory and a writer thread writes the encoded tiles.
+    The queues between the stages hold at most readDepth and writeDepth
+    tiles; their occupancy shows which stage is the bottleneck.
+    """
+    def __init__(self, minfo, readDepth, writeDepth):
+        self.minfo=minfo
+        self.memDriver=gdal.GetDriverByName("MEM")
+        self.queues={"read": queue.Queue(readDepth), "write": queue.Queue(writeDepth)}
+        self.done=queue.Queue()
+        # per queue: gets, summed occupancy, gets from an empty queue,
+        # puts into a full queue
+        self.stats=dict((name, [0, 0, 0, 0]) for name in self.queues)
+        self.seconds={"read": 0.0, "encode": 0.0, "write": 0.0}
+        self.error=None
+
+    def put(self, name, item):
+        if self.queues[name].full():
+            self.stats[name][3]+=1
+        self.queues[name].put(item)
+
+    def get(self, name):
+        stats=self.stats[name]
+        occupancy=self.queues[name].qsize()
+        stats[0]+=1
+        stats[1]+=occupancy
+        if occupancy==0:
+            stats[2]+=1
+        return self.queues[name].get()
+
+    def read(self, jobs):
+        try:
+            for job in jobs:
+                if self.error is not None:
+                    break
+                xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename = job
+                skipped=getSkippedTile(job)
+                if skipped is not False:
+                    self.put("read", (job, None, skipped))
+                    continue
+                start=time.time()
+                s_fh=getTileSource(self.minfo, offsetX, offsetY, width, height)
+                self.seconds["read"]+=time.time()-start
+                self.put("read", (job, s_fh, None))
+        except Exception:
+            self.error=sys.exc_info()
+        finally:
+            self.put("read", None)
+
+    def write(self):
+        while True:
+            item=self.get("write")
+            if item is None:
+                self.done.put(None)
+                return
+            job, tilename, data = item
+            if self.error is not None:
+                # the tiles queued behind a failure are dropped, not
+                # reported as written
+                continue
+            if data is not None:
+                start=time.time()
+                try:
+                    writeTileFile(tilename, data)
+                except Exception:
+                    self.error=sys.exc_info()
+                    continue
+                self.seconds["write"]+=time.time()-start
+            self.done.put((job, tilename))
+
+    def run(self, jobs):
+        """
+        yields (job, tile name) once a tile is written, (job, None) for an
+        empty tile, like renderTile
+
+        the first error of any stage stops the pipeline and is raised once
+        the tiles written before it have been yielded
+        """
+        reader=threading.Thread(target=self.read, args=(jobs,))
+        writer=threading.Thread(target=self.write)
+        for thread in (reader, writer):
+            thread.daemon=True
+            thread.start()
+
+        readerDone=False
+        try:
+            while self.error is None:
+                item=self.get("read")
+                if item is None:
+                    readerDone=True
+                    break
+                job, s_fh, skipped = item
+                xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename = job
+                if s_fh is None:
+                    # skipped tiles keep their name, empty tiles have none
+                    if skipped is None:
+                        removeStaleTile(tilename)
+                    self.put("write", (job, skipped, None))
+                else:
+                    start=time.time()
+                    t_fh=self.memDriver.Create("", width, height, self.minfo.bands, getBandType(self.minfo))
+                    t_fh.SetGeoTransform(geotransform)
+                    if Source_SRS is not None:
+                        t_fh.SetProjection(Source_SRS.ExportToWkt())
+                    fillTile(self.minfo, s_fh, t_fh)
+                    s_fh=None
+                    data=encodeTile(t_fh, tilename, True)
+                    t_fh=None
+                    self.seconds["encode"]+=time.time()-start
+                    self.put("write", (job, tilename, data))
+                    if Verbose:
+                        print(tilename + " : " + str(offsetX)+"|"+str(offsetY)+"-->"+str(width)+"-"+str(height))
+
+                while not self.done.empty():
+                    yield self.done.get()
+        except Exception:
+            self.error=sys.exc_info()
+
+        # the reader stops at its next tile after an error; take what it
+        # still queues so that it is not blocked on a full queue
+        while not readerDone:
+            readerDone=self.queues["read"].get() is None
+
+        self.put("write", None)
+        while True:
+            result=self.done.get()
+            if result is None:
+                break
+            yield result
+        reader.join()
+        writer.join()
+
+        if self.error is not None:
+            raise self.error[1]
+
+    def report(self):
+        for name in ("read", "write"):
+            gets, occupancy, empty, full = self.stats[name]
+            print("%s queue: mean occupancy %.1f of %d, empty %d and full %d times in %d tiles"
+                  % (name, occupancy / float(max(gets, 1)), self.queues[name].maxsize,
+                     empty, full, gets))
+        print("seconds reading %.2f, encoding %.2f, writing %.2f"
+              % (self.seconds["read"], self.seconds["encode"], self.seconds["write"]))
+
+
 class tile_info:
     """ A class holding info how to tile """
     def __init__(self,xsize,ysize,tileWidth,tileHeight):
@@ -165,8 +452,10 @@ class mosaic_info:
         else:
            self.ct = None
         self.ci = [0] * self.bands
+        self.nodata = [None] * self.bands
         for iband in range(self.bands):
             self.ci[iband] = fhInputTile.GetRasterBand(iband + 1).GetRasterColorInterpretation()
+            self.nodata[iband] = fhInputTile.GetRasterBand(iband + 1).GetNoDataValue()
 
         extent = self.ogrTileIndexDS.GetLayer().GetExtent()
         self.ulx = extent[0];
@@ -182,7 +471,32 @@ class mosaic_info:
         del self.cache
         del self.ogrTileIndexDS
 
-    def getDataSet(self,minx,miny,maxx,maxy):
+    def getSourceLevel(self, sourceDS, factor):
+        """
+        returns the overview of sourceDS with the largest decimation not
+        above factor as (overview index or -1 for the full resolution,
+        decimation in x, decimation in y)
+        """
+        band = sourceDS.GetRasterBand(1)
+        best = (-1, 1.0, 1.0)
+        for i in range(band.GetOverviewCount()):
+            overview = band.GetOverview(i)
+            decX = sourceDS.RasterXSize / float(overview.XSize)
+            decY = sourceDS.RasterYSize / float(overview.YSize)
+            # overview sizes are rounded up, e.g. 1001 pixels give 501
+            if decX <= factor * 1.01 and decX > best[1]:
+                best = (i, decX, decY)
+        return best
+
+    def getDataSet(self,minx,miny,maxx,maxy,factor=1):
+        """
+        returns the sources within minx,miny,maxx,maxy merged into a MEM
+        dataset with factor times the pixel size of the mosaic, None if no
+        source covers it
+
+        with a factor above 1 the sources are read from their overviews
+        closest to that resolution (but not coarser)
+        """
 
         self.ogrTileIndexDS.GetLayer().ResetReading()
         self.ogrTileIndexDS.GetLayer().SetSpatialFilterRect(minx,miny,maxx,maxy)
@@ -213,11 +527,24 @@ class mosaic_info:
          # merge tiles
 
 
-        resultSizeX =int(math.ceil(((maxx-minx) / self.scaleX )))
-        resultSizeY =int(math.ceil(((miny-maxy) / self.scaleY )))
+        scaleX = self.scaleX * factor
+        scaleY = self.scaleY * factor
+        resultSizeX =int(math.ceil(((maxx-minx) / scaleX )))
+        resultSizeY =int(math.ceil(((miny-maxy) / scaleY )))
 
         resultDS = self.TempDriver.Create( "TEMP", resultSizeX, resultSizeY, self.bands,self.band_type,[])
-        resultDS.SetGeoTransform( [minx,self.scaleX,0,maxy,0,self.scaleY] )
+        resultDS.SetGeoTransform( [minx,scaleX,0,maxy,0,scaleY] )
+
+        if factor > 1:
+            resampleAlg = getRasterIOResampling()
+        else:
+            resampleAlg = gdal.GRIORA_NearestNeighbour
+
+        # areas not covered by any source tile are nodata
+        for bandNr in range(1, self.bands + 1):
+            if self.nodata[bandNr-1] is not None:
+                resultDS.GetRasterBand(bandNr).SetNoDataValue(self.nodata[bandNr-1])
+                resultDS.GetRasterBand(bandNr).Fill(self.nodata[bandNr-1])
 
 
         for feature in features:
@@ -228,6 +555,16 @@ class mosaic_info:
             dec.lrx = dec.ulx + sourceDS.RasterXSize * dec.scaleX
             dec.lry = dec.uly + sourceDS.RasterYSize * dec.scaleY
 
+            # read from the overview matching the requested resolution
+            overview, decX, decY = self.getSourceLevel(sourceDS, factor)
+            if overview >= 0:
+                overviewBand = sourceDS.GetRasterBand(1).GetOverview(overview)
+                sourceXSize, sourceYSize = overviewBand.XSize, overviewBand.YSize
+            else:
+                sourceXSize, sourceYSize = sourceDS.RasterXSize, sourceDS.RasterYSize
+            sourceScaleX = dec.scaleX * decX
+            sourceScaleY = dec.scaleY * decY
+
             # Find the intersection region
             tgw_ulx = max(dec.ulx, minx)
             tgw_lrx = min(dec.lrx, maxx)
@@ -239,18 +576,18 @@ class mosaic_info:
                 tgw_lry = min(dec.lry, miny)
 
             # Compute source window in pixel coordinates.
-            sw_xoff = int((tgw_ulx - dec.ulx) / dec.scaleX)
-            sw_yoff = int((tgw_uly - dec.uly) / dec.scaleY)
-            sw_xsize = int((tgw_lrx - dec.ulx) / dec.scaleX + 0.5) - sw_xoff
-            sw_ysize = int((tgw_lry - dec.uly) / dec.scaleY + 0.5) - sw_yoff
+            sw_xoff = int((tgw_ulx - dec.ulx) / sourceScaleX)
+            sw_yoff = int((tgw_uly - dec.uly) / sourceScaleY)
+            sw_xsize = min(int((tgw_lrx - dec.ulx) / sourceScaleX + 0.5), sourceXSize) - sw_xoff
+            sw_ysize = min(int((tgw_lry - dec.uly) / sourceScaleY + 0.5), sourceYSize) - sw_yoff
             if sw_xsize <= 0 or sw_ysize <= 0:
                 continue
 
             # Compute target window in pixel coordinates
-            tw_xoff = int((tgw_ulx - minx) / self.scaleX)
-            tw_yoff = int((tgw_uly - maxy) / self.scaleY)
-            tw_xsize = int((tgw_lrx - minx) / self.scaleX + 0.5) - tw_xoff
-            tw_ysize = int((tgw_lry - maxy) / self.scaleY + 0.5) - tw_yoff
+            tw_xoff = int((tgw_ulx - minx) / scaleX)
+            tw_yoff = int((tgw_uly - maxy) / scaleY)
+            tw_xsize = int((tgw_lrx - minx) / scaleX + 0.5) - tw_xoff
+            tw_ysize = int((tgw_lry - maxy) / scaleY + 0.5) - tw_yoff
             if tw_xsize <= 0 or tw_ysize <= 0:
                 continue
 
@@ -261,12 +598,15 @@ class mosaic_info:
 
             for bandNr in range(1, self.bands + 1):
                 s_band = sourceDS.GetRasterBand( bandNr )
+                if overview >= 0:
+                    s_band = s_band.GetOverview(overview)
                 t_band = resultDS.GetRasterBand( bandNr )
                 if self.ct is not None:
                     t_band.SetRasterColorTable(self.ct)
                 t_band.SetRasterColorInterpretation(self.ci[bandNr-1])
 
-                data = s_band.ReadRaster( sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xsize, tw_ysize, self.band_type )
+                data = s_band.ReadRaster( sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xsize, tw_ysize, self.band_type,
+                                          resample_alg=resampleAlg )
                 if data is None:
                     print(gdal.GetLastErrorMsg())
 
@@ -289,6 +629,254 @@ class mosaic_info:
               % (self.ulx,self.uly,self.lrx,self.lry))
 
 
+class TileStoreSink:
+    """ A class packing the tiles of each level into a memory-mapped tile store """
+    prefix = "TILESTORE:"
+
+    def __init__(self):
+        self.baseName = None
+        self.files = {}
+        self.writers = {}
+        self.readers = {}
+
+    def beginLevel(self, level, levelDir, ti, geotransform, projection, bands, bandType):
+        from tilestore import TileStoreWriter
+        fileName = levelDir + self.baseName + ".tiles"
+        self.files[level] = fileName
+        self.readers.pop(fileName, None)
+        self.writers[fileName] = TileStoreWriter(
+            fileName, ti.tileWidth, ti.tileHeight, ti.countTilesX, ti.countTilesY,
+            ti.lastTileWidth, ti.lastTileHeight, bands,
+            gdal_array.GDALTypeCodeToNumericTypeCode(bandType),
+            geotransform, projection)
+
+    def endLevel(self, level):
+        self.writers.pop(self.files[level]).close()
+
+    def location(self, level, xIndex, yIndex):
+        return "%s%s:%d:%d" % (self.prefix, self.files[level], xIndex - 1, yIndex - 1)
+
+    def owns(self, name):
+        return name.startswith(self.prefix)
+
+    def parse(self, name):
+        fileName, col, row = name[len(self.prefix):].rsplit(":", 2)
+        return fileName, int(col), int(row)
+
+    def encode(self, name, ds):
+        data = ds.ReadAsArray()
+        return data.reshape((ds.RasterCount,) + data.shape[-2:])
+
+    def put(self, name, data):
+        fileName, col, row = self.parse(name)
+        self.writers[fileName].write(col, row, data)
+
+    def write(self, name, ds):
+        self.put(name, self.encode(name, ds))
+
+    def open(self, name):
+        fileName, col, row = self.parse(name)
+        if fileName not in self.readers:
+            from tilestore import TileStoreReader
+            self.readers[fileName] = TileStoreReader(fileName)
+        reader = self.readers[fileName]
+        tile = reader.tile(col, row)
+        if tile is None:
+            return None
+        ds = gdal_array.OpenArray(numpy.array(tile))
+        ds.SetGeoTransform(reader.tileGeoTransform(col, row))
+        ds.SetProjection(str(reader.projection))
+        return ds
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+
+class TileDBSink:
+    """ A class writing the tiles of all levels into one MBTiles or GeoPackage file """
+    prefix = "TILEDB:"
+
+    def __init__(self, fileName):
+        from tiledb import SQLiteTileWriter
+        self.fileName = fileName
+        self.writer = SQLiteTileWriter(fileName, TileIndexBatchSize, dedupe=Dedupe)
+        self.levels = {}
+        self.baseName = None
+
+    def zoom(self, level):
+        if TilingScheme != "raster":
+            return level
+        return Levels - level
+
+    def beginLevel(self, level, levelDir, ti, geotransform, projection, bands, bandType):
+        if len(self.levels) == 0:
+            self.setTileMatrixSet(ti, geotransform, projection)
+        self.levels[level] = (ti, geotransform, projection)
+        self.writer.addTileMatrix(self.zoom(level), ti.countTilesX, ti.countTilesY,
+                                  ti.tileWidth, ti.tileHeight,
+                                  geotransform[1], abs(geotransform[5]))
+
+    def setTileMatrixSet(self, ti, geotransform, projection):
+        srs = osr.SpatialReference()
+        srsId, organization, srsName = -1, "NONE", "Undefined cartesian SRS"
+        if len(projection) > 0 and srs.ImportFromWkt(projection) == 0:
+            srs.AutoIdentifyEPSG()
+            if srs.GetAuthorityName(None) == "EPSG":
+                srsId, organization = int(srs.GetAuthorityCode(None)), "EPSG"
+            else:
+                srsId = 100000
+            srsName = srs.GetAttrValue("PROJCS") or srs.GetAttrValue("GEOGCS") or "Unknown"
+            self.writer.setSpatialRefSys(srsId, srsName, organization, srsId, projection)
+
+        self.writer.setTileMatrixSet(
+            srsId, geotransform[0],
+            geotransform[3] + ti.countTilesY * ti.tileHeight * geotransform[5],
+            geotransform[0] + ti.countTilesX * ti.tileWidth * geotransform[1],
+            geotransform[3])
+
+    def endLevel(self, level):
+        self.writer.flush()
+
+    def location(self, level, xIndex, yIndex):
+        return "%s%d:%d:%d" % (self.prefix, level, xIndex - 1, yIndex - 1)
+
+    def owns(self, name):
+        return name.startswith(self.prefix)
+
+    def parse(self, name):
+        level, col, row = name[len(self.prefix):].split(":")
+        return int(level), int(col), int(row)
+
+    def encode(self, name, ds):
+        # tile databases only hold full tiles, edge tiles are padded
+        ti = self.levels[self.parse(name)[0]][0]
+        if ds.RasterXSize < ti.tileWidth or ds.RasterYSize < ti.tileHeight:
+            ds = padTile(ds, ti.tileWidth, ti.tileHeight)
+        return encodeTile(ds, name)
+
+    def write(self, name, ds):
+        self.put(name, self.encode(name, ds))
+
+    def put(self, name, data):
+        level, col, row = self.parse(name)
+        self.writer.put(self.zoom(level), col, row, data)
+
+    def open(self, name):
+        level, col, row = self.parse(name)
+        data = self.writer.read(self.zoom(level), col, row)
+        if data is None:
+            return None
+        ds = decodeTile(data, name)
+        ti, geotransform, projection = self.levels[level]
+        ds.SetGeoTransform([geotransform[0] + col * ti.tileWidth * geotransform[1], geotransform[1], 0,
+                            geotransform[3] + row * ti.tileHeight * geotransform[5], 0, geotransform[5]])
+        ds.SetProjection(projection)
+        return ds
+
+    def close(self):
+        zooms = [self.zoom(level) for level in self.levels]
+        self.writer.setMetadata({"name": self.baseName,
+                                 "type": "baselayer",
+                                 "format": Extension,
+                                 "minzoom": min(zooms),
+                                 "maxzoom": max(zooms)})
+        self.writer.close()
+
+
+def padTile(ds, width, height):
+    """
+    returns ds extended to width x height, the added pixels at the right
+    and bottom are nodata (or 0)
+    """
+    padded = gdal.GetDriverByName("MEM").Create("", width, height, ds.RasterCount,
+                                                ds.GetRasterBand(1).DataType)
+    padded.SetGeoTransform(ds.GetGeoTransform())
+    padded.SetProjection(ds.GetProjection())
+    for band in range(1, ds.RasterCount + 1):
+        s_band = ds.GetRasterBand(band)
+        t_band = padded.GetRasterBand(band)
+        t_band.SetRasterColorInterpretation(s_band.GetRasterColorInterpretation())
+        if s_band.GetRasterColorTable() is not None:
+            t_band.SetRasterColorTable(s_band.GetRasterColorTable())
+        if s_band.GetNoDataValue() is not None:
+            t_band.SetNoDataValue(s_band.GetNoDataValue())
+            t_band.Fill(s_band.GetNoDataValue())
+        data = s_band.ReadRaster(0, 0, ds.RasterXSize, ds.RasterYSize)
+        t_band.WriteRaster(0, 0, ds.RasterXSize, ds.RasterYSize, data)
+    return padded
+
+def getVSIName(name):
+    name = name.replace(":", "_").replace(os.sep, "_")
+    if Extension is not None:
+        name = name + "." + Extension
+    return "/vsimem/" + name
+
+def readVSIFile(vsiName):
+    fh = gdal.VSIFOpenL(vsiName, "rb")
+    gdal.VSIFSeekL(fh, 0, 2)
+    size = gdal.VSIFTellL(fh)
+    gdal.VSIFSeekL(fh, 0, 0)
+    data = gdal.VSIFReadL(1, size, fh)
+    gdal.VSIFCloseL(fh)
+    return data
+
+def encodeTile(ds, name, withAux=False):
+    """
+    encodes ds with the output driver and returns the encoded bytes, or
+    with withAux the encoded bytes and the .aux.xml written by formats
+    keeping the georeferencing in a side car file (None for the others)
+    """
+    vsiName = getVSIName(name)
+    tt_fh = Driver.CreateCopy(vsiName, ds, 0, CreateOptions)
+    if tt_fh is None:
+        # raised rather than exiting, the tile server keeps serving
+        raise IOError('Encoding failed for %s' % name)
+    tt_fh = None
+
+    data = readVSIFile(vsiName)
+    gdal.Unlink(vsiName)
+    aux = None
+    if gdal.VSIStatL(vsiName + ".aux.xml") is not None:
+        aux = readVSIFile(vsiName + ".aux.xml")
+        gdal.Unlink(vsiName + ".aux.xml")
+    if withAux:
+        return (data, aux)
+    return data
+
+def writeTileFile(tileName, encoded):
+    """
+    writes a tile encoded by encodeTile with withAux, linked to a shared
+    payload with -dedupe; the .aux.xml differs between tiles and is
+    always written as a file of its own
+    """
+    data, aux = encoded
+    if TileBlobs is not None:
+        TileBlobs.write(tileName, data)
+    else:
+        unlinkSharedTile(tileName)
+        fh = open(tileName, "wb")
+        fh.write(data)
+        fh.close()
+    if aux is not None:
+        fh = open(tileName + ".aux.xml", "wb")
+        fh.write(aux)
+        fh.close()
+
+def decodeTile(data, name):
+    """
+    decodes an encoded tile into a MEM dataset
+    """
+    vsiName = getVSIName(name)
+    gdal.FileFromMemBuffer(vsiName, data)
+    src = gdal.Open(vsiName)
+    ds = gdal.GetDriverByName("MEM").CreateCopy("", src)
+    src = None
+    gdal.Unlink(vsiName)
+    return ds
+
+
 def getTileIndexFromFiles( inputTiles, driverTyp):
 
     if Verbose:
@@ -299,6 +887,23 @@ def getTileIndexFromFiles( inputTiles, driverTyp):
             exec('print "Building internal Index for %d tile(s) ..." % len(inputTiles), ')
 
     ogrTileIndexDS = createTileIndex("TileIndex",TileIndexFieldName,None,driverTyp);
+
+    # with a footprint catalog the inputs are only opened on first use
+    if FootprintCatalogName is not None:
+        from footprints import FootprintCatalog
+        catalog = FootprintCatalog(FootprintCatalogName)
+        footprints = catalog.getFootprints(inputTiles, Processes)
+        catalog.close()
+        beginTileIndexBatch(ogrTileIndexDS)
+        for inputTile, footprint in zip(inputTiles, footprints):
+            if footprint is None:
+                return None
+            geotransform, xsize, ysize = footprint
+            points = AffineTransformDecorator(geotransform).pointsFor(xsize, ysize)
+            addFeature(ogrTileIndexDS,inputTile,points[0],points[1])
+        commitTileIndexBatch(ogrTileIndexDS)
+        inputTiles = []
+
     for inputTile in inputTiles:
 
         fhInputTile = gdal.Open(inputTile)
@@ -319,6 +924,17 @@ def getTileIndexFromFiles( inputTiles, driverTyp):
 
 
 
+def makeDir(path):
+    """
+    creates the directory path unless it exists, which may happen at any
+    time when several shards write into the same target directory
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
 def getTargetDir (level = -1):
     if level==-1:
         return TargetDir
@@ -341,17 +957,53 @@ def tileImage(minfo, ti ):
     LastRowIndx=-1
     OGRDS=createTileIndex("TileResult_0", TileIndexFieldName, Source_SRS,TileIndexDriverTyp)
 
+    if UseDirForEachRow and PyramidOnly == False:
+        indexDir=getTargetDir(0)
+    else:
+        indexDir=getTargetDir()
+
+    # a level finished by a previous run keeps its index and bounds files
+    levelDone = Journal is not None and Journal.hasLevel(0)
+
+    # shards always write a partial index for the merge step
+    indexName = TileIndexName
+    if indexName is None and getShardTag() is not None:
+        indexName = ShardIndexName
+    if indexName is not None and not levelDone:
+        shapeName=indexDir+getShardFileName(indexName)
+        IndexDS=createTileIndex(shapeName, TileIndexFieldName, Source_SRS, getTileIndexDriverName(shapeName))
+        beginTileIndexBatch(IndexDS)
+    else:
+        IndexDS=None
+
+    firstTile, lastTile = getTileRange(minfo, ti)
+    if Verbose and getShardTag() is not None:
+        print("Rendering tiles %d to %d of %d" % (firstTile, lastTile, ti.countTilesX * ti.countTilesY))
 
-    yRange = list(range(1,ti.countTilesY+1))
+    yRange = list(range((firstTile - 1) // ti.countTilesX + 1,
+                        (lastTile - 1) // ti.countTilesX + 2))
     xRange = list(range(1,ti.countTilesX+1))
 
     if not Quiet and not Verbose:
         progress(0.0)
         processed = 0
-        total = len(xRange) * len(yRange)
+        total = max(0, lastTile - firstTile + 1)
+
+    if TileSink is not None:
+        if Source_SRS is not None:
+            projection = Source_SRS.ExportToWkt()
+        else:
+            projection = minfo.projection
+        TileSink.beginLevel(0, indexDir, ti,
+                            [minfo.ulx, minfo.scaleX, 0, minfo.uly, 0, minfo.scaleY],
+                            projection, minfo.bands, getBandType(minfo))
 
+    jobs = []
     for yIndex in yRange:
         for xIndex in xRange:
+            tileNumber = (yIndex - 1) * ti.countTilesX + xIndex
+            if tileNumber < firstTile or tileNumber > lastTile:
+                continue
             offsetY=(yIndex-1)* ti.tileHeight
             offsetX=(xIndex-1)* ti.tileWidth
             if yIndex==ti.countTilesY:
@@ -363,77 +1015,593 @@ def tileImage(minfo, ti ):
                 width=ti.lastTileWidth
             else:
                 width=ti.tileWidth
+            geotransform=[minfo.ulx+offsetX*minfo.scaleX, minfo.scaleX, 0,
+                          minfo.uly+offsetY*minfo.scaleY, 0, minfo.scaleY]
             if UseDirForEachRow :
                 tilename=getTileName(minfo,ti, xIndex, yIndex,0)
             else:
                 tilename=getTileName(minfo,ti, xIndex, yIndex)
-            createTile(minfo, offsetX, offsetY, width, height,tilename,OGRDS)
+            jobs.append((xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename))
+
+    # tiles are encoded and written by the workers, the indexes and the
+    # tile sink are only written by this process
+    global TileMosaicInfo
+    TileMosaicInfo = minfo
+    pipeline = None
+    if PipelineDepths is not None:
+        pool = None
+        pipeline = TilePipeline(minfo, PipelineDepths[0], PipelineDepths[1])
+        imap = lambda function, jobs, chunksize: pipeline.run(jobs)
+    elif Processes > 1:
+        if Journal is not None:
+            Journal.sync()
+        pool = multiprocessing.Pool(Processes, initializer=initTileWorker)
+        imap = pool.imap
+    else:
+        pool = None
+        imap = lambda function, jobs, chunksize: (function(job) for job in jobs)
+
+    count = 0
+    created = []
+    for job, result in imap(renderTile, jobs, 16):
+        xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename = job
+        if TileSink is not None and result is not None:
+            TileSink.put(*result)
+            result = result[0]
+        if Journal is not None and not Journal.hasTile(0, xIndex, yIndex):
+            Journal.addTile(0, xIndex, yIndex, result)
+        if result is not None:
+            addTileFeatures(result, geotransform, width, height, OGRDS, IndexDS)
+            created.append((xIndex, yIndex, result))
+
+        count += 1
+        if IndexDS is not None and count % TileIndexBatchSize == 0:
+            commitTileIndexBatch(IndexDS)
+            beginTileIndexBatch(IndexDS)
+
+        if not Quiet and not Verbose:
+            processed += 1
+            progress(processed / float(total))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if pipeline is not None and Verbose:
+        pipeline.report()
+
+    if IndexDS is not None:
+        commitTileIndexBatch(IndexDS)
+        closeTileIndex(IndexDS)
+
+    if TileSink is not None:
+        TileSink.endLevel(0)
+
+    if not levelDone:
+        writeTileBounds(indexDir, minfo.ulx, minfo.uly, minfo.scaleX, minfo.scaleY, ti, created)
+        if Journal is not None:
+            Journal.addLevel(0)
 
-            if not Quiet and not Verbose:
-                processed += 1
-                progress(processed / float(total))
 
-    if TileIndexName is not None:
-        if UseDirForEachRow and PyramidOnly == False:
-            shapeName=getTargetDir(0)+TileIndexName
-        else:
-            shapeName=getTargetDir()+TileIndexName
-        copyTileIndexToDisk(OGRDS,shapeName)
+    return OGRDS
 
-    if CsvFileName is not None:
-        if UseDirForEachRow and PyramidOnly == False:
-            csvName=getTargetDir(0)+CsvFileName
+def initTileWorker():
+    """
+    gives every worker process its own handles on the source tiles
+    """
+    TileMosaicInfo.cache = DataSetCache()
+
+def renderTile(job):
+    """
+    renders one tile of level 0, or takes it from the journal; runs in the
+    worker processes when -processes is given
+
+    returns (job, tile name) or (job, None) for an empty tile; with a tile
+    sink (job, (tile name, encoded tile)), the main process stores the tile
+    """
+    xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename = job
+    skipped = getSkippedTile(job)
+    if skipped is not False:
+        return (job, skipped)
+    result = createTile(TileMosaicInfo, offsetX, offsetY, width, height, tilename, None, None)
+    if result is None:
+        removeStaleTile(tilename)
+    return (job, result)
+
+def getSkippedTile(job):
+    """
+    returns the name of a tile of level 0 which is not rendered again since
+    it is in the journal or unchanged by -update, None if that tile is
+    empty, or False if the tile has to be rendered
+    """
+    xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename = job
+    if Journal is not None and Journal.hasTile(0, xIndex, yIndex):
+        return Journal.tileName(0, xIndex, yIndex)
+    if not isTileChanged(geotransform, width, height):
+        if os.path.exists(tilename):
+            return tilename
+        return None
+    return False
+
+def isTileChanged(geotransform, width, height):
+    """
+    returns False if -update found no changed source overlapping the tile
+    """
+    if ChangedAreas is None:
+        return True
+    xlist, ylist = AffineTransformDecorator(geotransform).pointsFor(width, height)
+    for minx, miny, maxx, maxy in ChangedAreas:
+        if minx < max(xlist) and maxx > min(xlist) and miny < max(ylist) and maxy > min(ylist):
+            return True
+    return False
+
+def unlinkSharedTile(tileName):
+    """
+    removes a tile linked to a payload shared with other tiles by an
+    earlier -dedupe run, so that writing it in place leaves them intact
+    """
+    try:
+        if os.stat(tileName).st_nlink > 1:
+            os.remove(tileName)
+    except OSError:
+        pass
+
+def removeStaleTile(tileName):
+    """
+    removes the tile written by the previous run when -update renders it
+    empty
+    """
+    if ChangedAreas is not None and os.path.exists(tileName):
+        os.remove(tileName)
+
+def getFootprintBounds(footprint):
+    """
+    returns the (minx, miny, maxx, maxy) of a (geotransform, xsize, ysize) footprint
+    """
+    geotransform, xsize, ysize = footprint
+    xlist, ylist = AffineTransformDecorator(geotransform).pointsFor(xsize, ysize)
+    return (min(xlist), min(ylist), max(xlist), max(ylist))
+
+def getChangedAreas(sources, minfo):
+    """
+    returns the extents of the inputs which were added, removed or changed
+    since the previous -update run recorded them in sources, or None if all
+    tiles have to be rendered since there was no such run or the mosaic
+    grid changed
+    """
+    from footprints import readFootprint
+    footprints, stale, changed = sources.getChanges(Names)
+    if len(footprints) == 0:
+        return None
+
+    # the tile grid only stays the same if the extent and pixel size do
+    bounds = [getFootprintBounds(footprint) for footprint in footprints]
+    extent = (min(b[0] for b in bounds), min(b[1] for b in bounds),
+              max(b[2] for b in bounds), max(b[3] for b in bounds))
+    scaleX = footprints[0][0][1]
+    if (abs(extent[0] - minfo.ulx) > abs(minfo.scaleX) / 2 or
+            abs(extent[3] - minfo.uly) > abs(minfo.scaleY) / 2 or
+            abs(extent[2] - minfo.lrx) > abs(minfo.scaleX) / 2 or
+            abs(extent[1] - minfo.lry) > abs(minfo.scaleY) / 2 or
+            abs(scaleX - minfo.scaleX) > abs(minfo.scaleX) * 1e-9):
+        if Verbose:
+            print("The extent of the mosaic changed, rendering all tiles")
+        return None
+
+    areas = [getFootprintBounds(footprint) for footprint in stale]
+    for name in changed:
+        name, footprint = readFootprint(name)
+        if footprint is not None:
+            areas.append(getFootprintBounds(footprint))
+    if Verbose:
+        print("%d input(s) changed since the previous run" % len(areas))
+    return areas
+
+def addJournaledTile(level, xIndex, yIndex, geotransform, width, height, OGRDS, IndexDS):
+    """
+    adds a tile finished by a previous run to the tile indexes instead of
+    rendering it again
+
+    returns the tile name, None for an empty tile or False if the tile is
+    not in the journal
+    """
+    if Journal is None or not Journal.hasTile(level, xIndex, yIndex):
+        return False
+    tileName=Journal.tileName(level, xIndex, yIndex)
+    if tileName is None:
+        return None
+    addTileFeatures(tileName, geotransform, width, height, OGRDS, IndexDS)
+    return tileName
+
+def addTileFeatures(tileName, geotransform, width, height, OGRDS, IndexDS):
+    """
+    adds the footprint of a tile to the in memory and disk tile indexes
+    """
+    points = AffineTransformDecorator(geotransform).pointsFor(width, height)
+    if OGRDS is not None:
+        addFeature(OGRDS, tileName, points[0], points[1])
+    if IndexDS is not None:
+        addFeature(IndexDS, getIndexLocation(tileName), points[0], points[1])
+
+def getShardTag():
+    """
+    returns the tag naming the files written by this shard or None
+    """
+    if TileRange is not None:
+        return "tiles%d-%d" % TileRange
+    if Shard is not None:
+        return "shard%dof%d" % Shard
+    return None
+
+def getShardFileName(fileName):
+    """
+    returns fileName tagged with the shard, e.g. index.shard2of4.shp
+    """
+    tag = getShardTag()
+    if fileName is None or tag is None:
+        return fileName
+    parts = os.path.splitext(fileName)
+    return parts[0] + "." + tag + parts[1]
+
+def getTileWeights(minfo, ti):
+    """
+    estimates the non-empty area of every tile of ti from the footprints
+    in the source index of minfo
+
+    returns an array of countTilesY x countTilesX weights
+    """
+    xEdges = minfo.ulx + minfo.scaleX * numpy.minimum(
+        numpy.arange(ti.countTilesX + 1) * ti.tileWidth, minfo.xsize)
+    yEdges = minfo.uly + minfo.scaleY * numpy.minimum(
+        numpy.arange(ti.countTilesY + 1) * ti.tileHeight, minfo.ysize)
+    weights = numpy.zeros((ti.countTilesY, ti.countTilesX))
+
+    layer = minfo.ogrTileIndexDS.GetLayer()
+    layer.ResetReading()
+    while True:
+        feature = layer.GetNextFeature()
+        if feature is None:
+            break
+        minx, maxx, miny, maxy = feature.GetGeometryRef().GetEnvelope()
+
+        # the overlap of a rectangle with the grid is separable in x and y
+        overlapX = numpy.clip(numpy.minimum(maxx, xEdges[1:]) - numpy.maximum(minx, xEdges[:-1]), 0, None)
+        overlapY = numpy.clip(numpy.minimum(maxy, yEdges[:-1]) - numpy.maximum(miny, yEdges[1:]), 0, None)
+        cols = numpy.nonzero(overlapX)[0]
+        rows = numpy.nonzero(overlapY)[0]
+        if len(cols) == 0 or len(rows) == 0:
+            continue
+        c0, c1 = cols[0], cols[-1] + 1
+        r0, r1 = rows[0], rows[-1] + 1
+        weights[r0:r1, c0:c1] += numpy.outer(overlapY[r0:r1], overlapX[c0:c1])
+    layer.ResetReading()
+    return weights
+
+def getTileRange(minfo, ti):
+    """
+    returns the first and last (1 based, row major) tile number rendered by
+    this invocation, inclusive
+
+    shards get contiguous ranges holding about the same estimated non-empty
+    area, so the assignment only depends on the inputs and -shard
+    """
+    countTiles = ti.countTilesX * ti.countTilesY
+    if TileRange is not None:
+        return (max(1, TileRange[0]), min(countTiles, TileRange[1]))
+    if Shard is None:
+        return (1, countTiles)
+
+    shard, shards = Shard
+    cumulative = numpy.cumsum(getTileWeights(minfo, ti).ravel())
+    if cumulative[-1] <= 0:
+        cumulative = numpy.arange(1, countTiles + 1, dtype=numpy.float64)
+    total = cumulative[-1]
+
+    def start(k):
+        if k == 1:
+            return 0
+        if k > shards:
+            return countTiles
+        return int(numpy.searchsorted(cumulative, total * (k - 1) / float(shards), side="right"))
+
+    return (start(shard) + 1, start(shard + 1))
+
+def findShardFiles(indexDir, fileName):
+    """
+    finds the files written for fileName by the shards or tile ranges
+
+    returns their names in tile order, the shard numbers and the shard counts
+    """
+    parts = os.path.splitext(fileName)
+    pattern = re.compile(re.escape(parts[0]) + r"\.(shard(\d+)of(\d+)|tiles(\d+)-\d+)" +
+                         re.escape(parts[1]) + "$")
+    found = []
+    shards = set()
+    counts = set()
+    for name in os.listdir(indexDir):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        if match.group(2) is not None:
+            shards.add(int(match.group(2)))
+            counts.add(int(match.group(3)))
+            found.append((int(match.group(2)), name))
         else:
-            csvName=getTargetDir()+CsvFileName
-        copyTileIndexToCSV(OGRDS,csvName)
+            found.append((int(match.group(4)), name))
+    return [name for first, name in sorted(found)], shards, counts
+
+def mergeShardIndexes():
+    """
+    merges the partial level 0 tile indexes, csv and bounds files written by
+    the shards into those of the level
+
+    returns an in memory index of all tiles for building the pyramid,
+    None if shards are missing
+    """
+    if UseDirForEachRow:
+        indexDir=getTargetDir(0)
+    else:
+        indexDir=getTargetDir()
+    shardNames, shards, counts = findShardFiles(indexDir, TileIndexName or ShardIndexName)
+
+    if len(shardNames) == 0:
+        print("No shard indexes found in %s" % indexDir)
+        return None
+    for count in counts:
+        missing = sorted(set(range(1, count + 1)) - shards)
+        if len(counts) > 1 or len(missing) > 0:
+            print("Shards %s of %d are missing" % (",".join(map(str, missing)), count))
+            return None
+
+    OGRDS=createTileIndex("TileResult_0", TileIndexFieldName, Source_SRS,TileIndexDriverTyp)
+    if TileIndexName is not None:
+        shapeName=indexDir+TileIndexName
+        IndexDS=createTileIndex(shapeName, TileIndexFieldName, Source_SRS, getTileIndexDriverName(shapeName))
+        beginTileIndexBatch(IndexDS)
+    else:
+        IndexDS=None
 
+    count = 0
+    for name in shardNames:
+        if Verbose:
+            print("Merging %s" % name)
+        shardDS = ogr.Open(indexDir+name)
+        if shardDS is None:
+            print("Could not open shard index %s" % name)
+            return None
+        layer = shardDS.GetLayer()
+        while True:
+            feature = layer.GetNextFeature()
+            if feature is None:
+                break
+            location = feature.GetField(TileIndexFieldName)
+            minx, maxx, miny, maxy = feature.GetGeometryRef().GetEnvelope()
+            xlist = [minx, maxx, maxx, minx]
+            ylist = [maxy, maxy, miny, miny]
+            addFeature(OGRDS, indexDir+location, xlist, ylist)
+            if IndexDS is not None:
+                addFeature(IndexDS, location, xlist, ylist)
+                count += 1
+                if count % TileIndexBatchSize == 0:
+                    commitTileIndexBatch(IndexDS)
+                    beginTileIndexBatch(IndexDS)
+        shardDS = None
+
+    if IndexDS is not None:
+        commitTileIndexBatch(IndexDS)
+        closeTileIndex(IndexDS)
 
+    if CsvFileName is not None:
+        csvfile = open(indexDir+CsvFileName, 'w')
+        for name in findShardFiles(indexDir, CsvFileName)[0]:
+            shardFile = open(indexDir+name)
+            csvfile.write(shardFile.read())
+            shardFile.close()
+        csvfile.close()
+    if BoundsIndexName is not None:
+        locations, xIndices, yIndices, bounds = [], [], [], [numpy.zeros((0, 4))]
+        for name in findShardFiles(indexDir, BoundsIndexName)[0]:
+            columns = readTileBoundsFile(indexDir+name)
+            locations.extend(columns[0])
+            xIndices.extend(columns[1])
+            yIndices.extend(columns[2])
+            bounds.append(columns[3])
+        copyTileBoundsToFile(locations, xIndices, yIndices, numpy.concatenate(bounds),
+                             indexDir+BoundsIndexName)
     return OGRDS
 
-def copyTileIndexToDisk(OGRDS, fileName):
-    SHAPEDS = createTileIndex(fileName, TileIndexFieldName, OGRDS.GetLayer().GetSpatialRef(), "ESRI Shapefile")
-    OGRDS.GetLayer().ResetReading()
-    while True:
-      feature = OGRDS.GetLayer().GetNextFeature()
-      if feature is None:
-          break
-      newFeature = feature.Clone()
-      basename = os.path.basename(feature.GetField(0))
-      if UseDirForEachRow :
-          t = os.path.split(os.path.dirname(feature.GetField(0)))
-          basename = t[1]+"/"+basename
-      newFeature.SetField(0,basename)
-      SHAPEDS.GetLayer().CreateFeature(newFeature)
-    closeTileIndex(SHAPEDS)
-
-def copyTileIndexToCSV(OGRDS, fileName):
-    csvfile = open(fileName, 'w')
-    OGRDS.GetLayer().ResetReading()
-    while True:
-      feature = OGRDS.GetLayer().GetNextFeature()
-      if feature is None:
-          break
-      basename = os.path.basename(feature.GetField(0))
-      if UseDirForEachRow :
-          t = os.path.split(os.path.dirname(feature.GetField(0)))
-          basename = t[1]+"/"+basename
-      csvfile.write(basename);
-      geom = feature.GetGeometryRef()
-      coords = geom.GetEnvelope();
-
-      for i in range(len(coords)):
-          csvfile.write(CsvDelimiter)
-          csvfile.write("%f" % coords[i])
-      csvfile.write("\n");
+def getIndexLocation(tileName):
+    """
+    returns the location of a tile as stored in the tile index on disk
+    """
+    location = os.path.basename(tileName)
+    if UseDirForEachRow :
+        t = os.path.split(os.path.dirname(tileName))
+        location = t[1]+"/"+location
+    return location
+
+def getTileBounds(ulx, uly, scaleX, scaleY, ti, xIndices, yIndices):
+    """
+    computes the envelopes of the tiles at (1 based) xIndices/yIndices of
+    the tile grid ti starting at ulx/uly
+
+    returns an array with one (minx, maxx, miny, maxy) row per tile
+    """
+    x = numpy.asarray(xIndices, dtype=numpy.int64) - 1
+    y = numpy.asarray(yIndices, dtype=numpy.int64) - 1
+    widths = numpy.where(x == ti.countTilesX - 1, ti.lastTileWidth, ti.tileWidth)
+    heights = numpy.where(y == ti.countTilesY - 1, ti.lastTileHeight, ti.tileHeight)
+
+    minx = ulx + x * ti.tileWidth * scaleX
+    maxx = minx + widths * scaleX
+    maxy = uly + y * ti.tileHeight * scaleY
+    miny = maxy + heights * scaleY
+    return numpy.column_stack((minx, maxx, miny, maxy))
+
+def writeTileBounds(indexDir, ulx, uly, scaleX, scaleY, ti, created):
+    """
+    writes the csv and bounds index files for the created tiles of a level
+    """
+    if CsvFileName is None and BoundsIndexName is None:
+        return
+
+    if len(created) > 0:
+        xIndices, yIndices, tileNames = zip(*created)
+    else:
+        xIndices, yIndices, tileNames = (), (), ()
+    bounds = getTileBounds(ulx, uly, scaleX, scaleY, ti, xIndices, yIndices)
+    locations = [getIndexLocation(tileName) for tileName in tileNames]
 
+    if CsvFileName is not None:
+        copyTileBoundsToCSV(locations, bounds, indexDir+getShardFileName(CsvFileName))
+    if BoundsIndexName is not None:
+        copyTileBoundsToFile(locations, xIndices, yIndices, bounds,
+                             indexDir+getShardFileName(BoundsIndexName))
+
+def copyTileBoundsToCSV(locations, bounds, fileName):
+    coords = numpy.char.mod("%f", bounds)
+    lines = [CsvDelimiter.join((location,) + tuple(row)) + "\n"
+             for location, row in zip(locations, coords)]
+
+    csvfile = open(fileName, 'w')
+    csvfile.write("".join(lines))
     csvfile.close()
 
+def copyTileBoundsToFile(locations, xIndices, yIndices, bounds, fileName):
+    """
+    writes the tile bounds as a NumPy (.npy) or Parquet (.parquet) table
+    """
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == ".parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print('Writing %s requires pyarrow' % fileName)
+            sys.exit( 1 )
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(locations), pyarrow.array(xIndices, pyarrow.int32()),
+             pyarrow.array(yIndices, pyarrow.int32()),
+             bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]],
+            [TileIndexFieldName, "x", "y", "minx", "maxx", "miny", "maxy"])
+        pyarrow.parquet.write_table(table, fileName)
+        return
+
+    width = max([len(location) for location in locations] + [1])
+    index = numpy.zeros(len(locations), dtype=[
+        (TileIndexFieldName, "S%d" % width), ("x", "i4"), ("y", "i4"),
+        ("minx", "f8"), ("maxx", "f8"), ("miny", "f8"), ("maxy", "f8")])
+    index[TileIndexFieldName] = [location.encode("utf-8") for location in locations]
+    index["x"] = xIndices
+    index["y"] = yIndices
+    for i, name in enumerate(("minx", "maxx", "miny", "maxy")):
+        index[name] = bounds[:, i]
+    numpy.save(fileName, index)
+
+def readTileBoundsFile(fileName):
+    """
+    reads a table written by copyTileBoundsToFile
+
+    returns the locations, x and y indices and the bounds array
+    """
+    names = (TileIndexFieldName, "x", "y", "minx", "maxx", "miny", "maxy")
+    if os.path.splitext(fileName)[1].lower() == ".parquet":
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(fileName)
+        columns = [table.column(name).to_pylist() for name in names]
+    else:
+        index = numpy.load(fileName)
+        columns = [[location.decode("utf-8") for location in index[names[0]]]]
+        columns += [index[name].tolist() for name in names[1:]]
+    bounds = numpy.array(columns[3:], dtype=numpy.float64).reshape((4, -1)).T
+    return columns[0], columns[1], columns[2], bounds
+
+
+
+def getProfileOptions(profile, driver, bandType, bands):
+    """
+    returns the GTiff creation options of a compression profile
+
+    fast  -- ZSTD level 1 (LZW if GDAL lacks ZSTD)
+    small -- DEFLATE with a predictor
+    lossy -- WEBP (JPEG if GDAL lacks WEBP) for Byte RGB/RGBA tiles
+
+    returns None if the profile does not fit the data
+    """
+    codecs = driver.GetMetadataItem(gdal.DMD_CREATIONOPTIONLIST) or ""
+    options = ["TILED=YES"]
+    if profile == "fast":
+        if "ZSTD" in codecs:
+            options += ["COMPRESS=ZSTD", "ZSTD_LEVEL=1"]
+        else:
+            options += ["COMPRESS=LZW"]
+    elif profile == "small":
+        if bandType in (gdal.GDT_Float32, gdal.GDT_Float64):
+            predictor = 3
+        else:
+            predictor = 2
+        options += ["COMPRESS=DEFLATE", "ZLEVEL=9", "PREDICTOR=%d" % predictor]
+    elif profile == "lossy":
+        if bandType != gdal.GDT_Byte or bands not in (3, 4):
+            return None
+        if "WEBP" in codecs:
+            options += ["COMPRESS=WEBP", "WEBP_LEVEL=75"]
+        elif bands == 3:
+            options += ["COMPRESS=JPEG", "PHOTOMETRIC=YCBCR", "JPEG_QUALITY=85"]
+        else:
+            return None
+    return options
+
+def mergeCreateOptions(options, overrides):
+    """
+    returns options with the NAME=VALUE pairs of overrides replacing
+    those of the same name
+    """
+    names = set(option.split("=", 1)[0].upper() for option in overrides)
+    return [option for option in options
+            if option.split("=", 1)[0].upper() not in names] + list(overrides)
 
+def getBandType(minfo):
+    if BandType is None:
+        return minfo.band_type
+    return BandType
+
+def getRasterIOResampling():
+    """
+    returns the RasterIO resampling matching -r, used when sources are
+    read below the resolution of their closest overview
+    """
+    names = {gdal.GRA_NearestNeighbour: "GRIORA_NearestNeighbour",
+             gdal.GRA_Bilinear: "GRIORA_Bilinear",
+             gdal.GRA_Cubic: "GRIORA_Cubic",
+             gdal.GRA_CubicSpline: "GRIORA_CubicSpline",
+             gdal.GRA_Lanczos: "GRIORA_Lanczos",
+             gdal.GRA_Average: "GRIORA_Average",
+             gdal.GRA_Mode: "GRIORA_Mode"}
+    return getattr(gdal, names.get(ResamplingMethod, "GRIORA_NearestNeighbour"))
+
+def reducePyramidTile(levelMosaicInfo, s_fh, t_fh):
+    """
+    fills t_fh with the 2x2 blocks of s_fh reduced by the -reduce kernel of
+    each band, ignoring nodata
+    """
+    import kernels
+    for band in range(1, t_fh.RasterCount+1):
+        method = ReduceMethods[min(band, len(ReduceMethods))-1]
+        data = s_fh.GetRasterBand(band).ReadAsArray()
+        result = kernels.downsample(data, method, levelMosaicInfo.nodata[band-1])
+        t_fh.GetRasterBand(band).WriteArray(result[:t_fh.RasterYSize, :t_fh.RasterXSize])
+
+def createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tileName,OGRDS,IndexDS=None,factor=1):
+    """
+    creates a tile with twice the pixel size of levelMosaicInfo, or of
+    levelMosaicInfo read at factor times its pixel size
 
-def createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tileName,OGRDS):
+    returns the tile name, None for an empty tile
+    """
 
-    sx= levelMosaicInfo.scaleX*2
-    sy= levelMosaicInfo.scaleY*2
+    sx= levelMosaicInfo.scaleX*2*factor
+    sy= levelMosaicInfo.scaleY*2*factor
 
     dec = AffineTransformDecorator([levelMosaicInfo.ulx+offsetX*sx,sx,0,
                                     levelMosaicInfo.uly+offsetY*sy,0,sy])
@@ -441,20 +1609,19 @@ def createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tileName,
 
 
     s_fh = levelMosaicInfo.getDataSet(dec.ulx,dec.uly+height*dec.scaleY,
-                         dec.ulx+width*dec.scaleX,dec.uly)
+                         dec.ulx+width*dec.scaleX,dec.uly,factor)
     if s_fh is None:
-        return
+        return None
 
 
+    points = dec.pointsFor(width, height)
     if OGRDS is not None:
-        points = dec.pointsFor(width, height)
         addFeature(OGRDS, tileName, points[0], points[1])
+    if IndexDS is not None:
+        addFeature(IndexDS, getIndexLocation(tileName), points[0], points[1])
 
 
-    if BandType is None:
-        bt=levelMosaicInfo.band_type
-    else:
-        bt=BandType
+    bt=getBandType(levelMosaicInfo)
 
     geotransform = [dec.ulx, dec.scaleX, 0,dec.uly,0,dec.scaleY]
 
@@ -462,6 +1629,7 @@ def createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tileName,
     bands = levelMosaicInfo.bands
 
     if MemDriver is None:
+        unlinkSharedTile(tileName)
         t_fh = Driver.Create( tileName, width, height, bands,bt,CreateOptions)
     else:
         t_fh = MemDriver.Create( tileName, width, height, bands,bt)
@@ -478,62 +1646,103 @@ def createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tileName,
         if levelMosaicInfo.ct is not None:
             t_band.SetRasterColorTable(levelMosaicInfo.ct)
         t_band.SetRasterColorInterpretation(levelMosaicInfo.ci[band-1])
+        if levelMosaicInfo.nodata[band-1] is not None:
+            t_band.SetNoDataValue(levelMosaicInfo.nodata[band-1])
+            t_band.Fill(levelMosaicInfo.nodata[band-1])
 
-    res = gdal.ReprojectImage(s_fh,t_fh,None,None,ResamplingMethod)
-    if  res!=0:
-        print("Reprojection failed for %s, error %d" % (tileName,res))
-        sys.exit( 1 )
+    if ReduceMethods is not None:
+        reducePyramidTile(levelMosaicInfo, s_fh, t_fh)
+    else:
+        res = gdal.ReprojectImage(s_fh,t_fh,None,None,ResamplingMethod)
+        if  res!=0:
+            print("Reprojection failed for %s, error %d" % (tileName,res))
+            sys.exit( 1 )
 
 
     levelMosaicInfo.closeDataSet(s_fh);
 
-    if MemDriver is not None:
+    if TileSink is not None:
+        TileSink.write(tileName, t_fh)
+    elif TileBlobs is not None:
+        writeTileFile(tileName, encodeTile(t_fh, tileName, True))
+    elif MemDriver is not None:
+        unlinkSharedTile(tileName)
         tt_fh = Driver.CreateCopy( tileName, t_fh, 0, CreateOptions )
         tt_fh.FlushCache()
 
     if Verbose:
         print(tileName + " : " + str(offsetX)+"|"+str(offsetY)+"-->"+str(width)+"-"+str(height))
 
+    return tileName
+
+
+
+
+def getTileSource(minfo, offsetX, offsetY, width, height):
+    """
+    reads the source pixels of a tile into a MEM dataset, None if no
+    source tile covers it
+    """
+    dec = AffineTransformDecorator([minfo.ulx,minfo.scaleX,0,minfo.uly,0,minfo.scaleY])
+    return minfo.getDataSet(dec.ulx+offsetX*dec.scaleX,dec.uly+offsetY*dec.scaleY+height*dec.scaleY,
+                            dec.ulx+offsetX*dec.scaleX+width*dec.scaleX,
+                            dec.uly+offsetY*dec.scaleY)
 
+def fillTile(minfo, s_fh, t_fh):
+    """
+    copies the source pixels s_fh of a tile into the tile t_fh
+    """
+    readX=min(s_fh.RasterXSize,t_fh.RasterXSize)
+    readY=min(s_fh.RasterYSize,t_fh.RasterYSize)
+    for band in range(1,t_fh.RasterCount+1):
+        s_band = s_fh.GetRasterBand( band )
+        t_band = t_fh.GetRasterBand( band )
+        if minfo.ct is not None:
+            t_band.SetRasterColorTable(minfo.ct)
+        if minfo.nodata[band-1] is not None:
+            t_band.SetNoDataValue(minfo.nodata[band-1])
+            t_band.Fill(minfo.nodata[band-1])
 
+#        data = s_band.ReadRaster( offsetX,offsetY,width,height,width,height, t_band.DataType )
+        data = s_band.ReadRaster( 0,0,readX,readY,readX,readY,  t_band.DataType )
+        t_band.WriteRaster( 0,0,readX,readY, data,readX,readY, t_band.DataType )
 
-def createTile( minfo, offsetX,offsetY,width,height, tilename,OGRDS):
+def createTile( minfo, offsetX,offsetY,width,height, tilename,OGRDS,IndexDS=None):
     """
 
     Create tile
-    return name of created tile
+    return name of created tile, with a tile sink paired with the tile
+    encoded for the sink
 
     """
 
-    if BandType is None:
-        bt=minfo.band_type
-    else:
-        bt=BandType
+    bt=getBandType(minfo)
 
 
     dec = AffineTransformDecorator([minfo.ulx,minfo.scaleX,0,minfo.uly,0,minfo.scaleY])
 
 
-    s_fh = minfo.getDataSet(dec.ulx+offsetX*dec.scaleX,dec.uly+offsetY*dec.scaleY+height*dec.scaleY,
-                         dec.ulx+offsetX*dec.scaleX+width*dec.scaleX,
-                         dec.uly+offsetY*dec.scaleY)
+    s_fh = getTileSource(minfo, offsetX, offsetY, width, height)
     if s_fh is None:
-        return;
+        return None
 
 
     geotransform = [dec.ulx+offsetX*dec.scaleX, dec.scaleX, 0,
                     dec.uly+offsetY*dec.scaleY,  0,dec.scaleY]
 
+    dec2 = AffineTransformDecorator(geotransform)
+    points = dec2.pointsFor(width, height)
     if OGRDS is not None:
-        dec2 = AffineTransformDecorator(geotransform)
-        points = dec2.pointsFor(width, height)
         addFeature(OGRDS, tilename, points[0], points[1])
+    if IndexDS is not None:
+        addFeature(IndexDS, getIndexLocation(tilename), points[0], points[1])
 
 
 
     bands = minfo.bands
 
     if MemDriver is None:
+        unlinkSharedTile(tilename)
         t_fh = Driver.Create( tilename, width, height, bands,bt,CreateOptions)
     else:
         t_fh = MemDriver.Create( tilename, width, height, bands,bt)
@@ -546,34 +1755,42 @@ def createTile( minfo, offsetX,offsetY,width,height, tilename,OGRDS):
     if Source_SRS is not None:
         t_fh.SetProjection( Source_SRS.ExportToWkt())
 
-    readX=min(s_fh.RasterXSize,width)
-    readY=min(s_fh.RasterYSize,height)
-    for band in range(1,bands+1):
-        s_band = s_fh.GetRasterBand( band )
-        t_band = t_fh.GetRasterBand( band )
-        if minfo.ct is not None:
-            t_band.SetRasterColorTable(minfo.ct)
-
-#        data = s_band.ReadRaster( offsetX,offsetY,width,height,width,height, t_band.DataType )
-        data = s_band.ReadRaster( 0,0,readX,readY,readX,readY,  t_band.DataType )
-        t_band.WriteRaster( 0,0,readX,readY, data,readX,readY, t_band.DataType )
+    fillTile(minfo, s_fh, t_fh)
 
     minfo.closeDataSet(s_fh);
 
-    if MemDriver is not None:
+    if TileSink is not None:
+        encoded = TileSink.encode(tilename, t_fh)
+    elif TileBlobs is not None:
+        writeTileFile(tilename, encodeTile(t_fh, tilename, True))
+    elif MemDriver is not None:
+        unlinkSharedTile(tilename)
         tt_fh = Driver.CreateCopy( tilename, t_fh, 0, CreateOptions )
         tt_fh.FlushCache()
 
     if Verbose:
         print(tilename + " : " + str(offsetX)+"|"+str(offsetY)+"-->"+str(width)+"-"+str(height))
 
+    if TileSink is not None:
+        return (tilename, encoded)
+    return tilename
+
+
 
+def getTileIndexDriverName(fileName):
+    """
+    returns the OGR driver used to write the tile index fileName
+    """
+    if TileIndexFormat is not None:
+        return TileIndexFormat
+    ext = os.path.splitext(fileName)[1].lower()
+    return TileIndexDrivers.get(ext, "ESRI Shapefile")
 
 def createTileIndex(dsName,fieldName,srs,driverName):
 
     OGRDriver = ogr.GetDriverByName(driverName);
     if OGRDriver is None:
-        print('ESRI Shapefile driver not found')
+        print('%s driver not found' % driverName)
         sys.exit( 1 )
 
     OGRDataSource=OGRDriver.Open(dsName)
@@ -588,7 +1805,13 @@ def createTileIndex(dsName,fieldName,srs,driverName):
         print('Could not open datasource '+dsName)
         sys.exit( 1 )
 
-    OGRLayer = OGRDataSource.CreateLayer("index", srs, ogr.wkbPolygon)
+    # GeoPackage and FlatGeobuf build their spatial index while writing
+    if driverName in ("GPKG", "FlatGeobuf"):
+        layerOptions = ["SPATIAL_INDEX=YES"]
+    else:
+        layerOptions = []
+
+    OGRLayer = OGRDataSource.CreateLayer("index", srs, ogr.wkbPolygon, layerOptions)
     if OGRLayer is None:
         print('Could not create Layer')
         sys.exit( 1 )
@@ -605,6 +1828,20 @@ def createTileIndex(dsName,fieldName,srs,driverName):
 
     return OGRDataSource
 
+def beginTileIndexBatch(OGRDataSource):
+    """
+    starts a transaction on the tile index if its driver supports them
+    """
+    if OGRDataSource.TestCapability(ogr.ODsCTransactions):
+        OGRDataSource.StartTransaction()
+
+def commitTileIndexBatch(OGRDataSource):
+    """
+    commits the features added since beginTileIndexBatch
+    """
+    if OGRDataSource.TestCapability(ogr.ODsCTransactions):
+        OGRDataSource.CommitTransaction()
+
 def addFeature(OGRDataSource,location,xlist,ylist):
 
     OGRLayer=OGRDataSource.GetLayer();
@@ -614,12 +1851,17 @@ def addFeature(OGRDataSource,location,xlist,ylist):
         sys.exit( 1 )
 
     OGRFeature.SetField(TileIndexFieldName,location);
-    wkt = 'POLYGON ((%f %f,%f %f,%f %f,%f %f,%f %f ))' % (xlist[0],ylist[0],
-            xlist[1],ylist[1],xlist[2],ylist[2],xlist[3],ylist[3],xlist[0],ylist[0])
-    OGRGeometry=ogr.CreateGeometryFromWkt(wkt,OGRLayer.GetSpatialRef())
+
+    # Build the polygon from the corner coordinates, closing the ring
+    OGRRing = ogr.Geometry(ogr.wkbLinearRing)
+    for i in (0, 1, 2, 3, 0):
+        OGRRing.AddPoint_2D(xlist[i], ylist[i])
+    OGRGeometry = ogr.Geometry(ogr.wkbPolygon)
     if (OGRGeometry is None):
         print('Could not create Geometry')
         sys.exit( 1 )
+    OGRGeometry.AddGeometryDirectly(OGRRing)
+    OGRGeometry.AssignSpatialReference(OGRLayer.GetSpatialRef())
 
     OGRFeature.SetGeometryDirectly(OGRGeometry)
 
@@ -631,49 +1873,430 @@ def closeTileIndex(OGRDataSource):
 
 
 def buildPyramid(minfo,createdTileIndexDS,tileWidth, tileHeight):
+    """
+    builds every level from the tiles of the level below, or with
+    -zoomFrom source from the sources and their overviews, so that the
+    levels do not depend on each other and the tiles of all levels are
+    rendered by one pool of -processes workers
+    """
 
     global LastRowIndx
     inputDS=createdTileIndexDS
+    xsize, ysize = minfo.xsize, minfo.ysize
+    if ZoomFrom == "source" and TileSink is None:
+        levels = []
+        for level in range(1,Levels+1):
+            LastRowIndx = -1
+            xsize, ysize = xsize//2, ysize//2
+            levelOutputTileInfo = tile_info(xsize,ysize,tileWidth,tileHeight)
+            levels.append(PyramidLevel(minfo,levelOutputTileInfo,level,2**(level-1)))
+        renderPyramidTiles(minfo, levels)
+        for pyramidLevel in levels:
+            pyramidLevel.finish()
+        return
+
     for level in range(1,Levels+1):
         LastRowIndx = -1
-        levelMosaicInfo = mosaic_info(minfo.filename,inputDS)
-        levelOutputTileInfo = tile_info(levelMosaicInfo.xsize/2,levelMosaicInfo.ysize/2,tileWidth,tileHeight)
-        inputDS=buildPyramidLevel(levelMosaicInfo,levelOutputTileInfo,level)
+        if ZoomFrom == "source":
+            levelMosaicInfo = minfo
+            factor = 2**(level-1)
+            xsize, ysize = xsize//2, ysize//2
+        else:
+            levelMosaicInfo = mosaic_info(minfo.filename,inputDS)
+            factor = 1
+            xsize, ysize = levelMosaicInfo.xsize//2, levelMosaicInfo.ysize//2
+        levelOutputTileInfo = tile_info(xsize,ysize,tileWidth,tileHeight)
+        inputDS=buildPyramidLevel(levelMosaicInfo,levelOutputTileInfo,level,factor)
 
 
-def buildPyramidLevel(levelMosaicInfo,levelOutputTileInfo, level):
-    yRange = list(range(1,levelOutputTileInfo.countTilesY+1))
-    xRange = list(range(1,levelOutputTileInfo.countTilesX+1))
+def buildPyramidLevel(levelMosaicInfo,levelOutputTileInfo, level, factor=1):
+    """
+    builds one pyramid level from levelMosaicInfo read at factor times its
+    pixel size; the tiles are rendered by -processes workers
 
-    OGRDS=createTileIndex("TileResult_"+str(level), TileIndexFieldName, Source_SRS,TileIndexDriverTyp)
+    returns an in memory index of the created tiles
+    """
+    pyramidLevel = PyramidLevel(levelMosaicInfo, levelOutputTileInfo, level, factor)
+    renderPyramidTiles(levelMosaicInfo, [pyramidLevel])
+    return pyramidLevel.finish()
 
-    for yIndex in yRange:
-        for xIndex in xRange:
-            offsetY=(yIndex-1)* levelOutputTileInfo.tileHeight
-            offsetX=(xIndex-1)* levelOutputTileInfo.tileWidth
-            if yIndex==levelOutputTileInfo.countTilesY:
-                height=levelOutputTileInfo.lastTileHeight
-            else:
-                height=levelOutputTileInfo.tileHeight
 
-            if xIndex==levelOutputTileInfo.countTilesX:
-                width=levelOutputTileInfo.lastTileWidth
-            else:
-                width=levelOutputTileInfo.tileWidth
-            tilename=getTileName(levelMosaicInfo,levelOutputTileInfo, xIndex, yIndex,level)
-            createPyramidTile(levelMosaicInfo, offsetX, offsetY, width, height,tilename,OGRDS)
+class PyramidLevel:
+    """
+    Collects the tiles of one pyramid level and writes its indexes
 
+    The tiles kept from a previous run are indexed when the level is
+    created, the others are left in jobs for renderPyramidTiles, which
+    passes the rendered tiles to add; finish writes the level's files.
+    """
+    def __init__(self, levelMosaicInfo, levelOutputTileInfo, level, factor):
+        self.levelMosaicInfo=levelMosaicInfo
+        self.levelOutputTileInfo=levelOutputTileInfo
+        self.level=level
+        self.count=0
+        self.created=[]
+        self.jobs=[]
+
+        yRange = list(range(1,levelOutputTileInfo.countTilesY+1))
+        xRange = list(range(1,levelOutputTileInfo.countTilesX+1))
+
+        self.OGRDS=createTileIndex("TileResult_"+str(level), TileIndexFieldName, Source_SRS,TileIndexDriverTyp)
+
+        # a level finished by a previous run keeps its index and bounds files
+        self.levelDone = Journal is not None and Journal.hasLevel(level)
+
+        if TileIndexName is not None and not self.levelDone:
+            shapeName=getTargetDir(level)+TileIndexName
+            self.IndexDS=createTileIndex(shapeName, TileIndexFieldName, Source_SRS, getTileIndexDriverName(shapeName))
+            beginTileIndexBatch(self.IndexDS)
+        else:
+            self.IndexDS=None
+
+        sx=self.sx=levelMosaicInfo.scaleX*2*factor
+        sy=self.sy=levelMosaicInfo.scaleY*2*factor
+        if TileSink is not None:
+            TileSink.beginLevel(level, getTargetDir(level), levelOutputTileInfo,
+                                [levelMosaicInfo.ulx, sx, 0, levelMosaicInfo.uly, 0, sy],
+                                levelMosaicInfo.projection, levelMosaicInfo.bands,
+                                getBandType(levelMosaicInfo))
+
+        for yIndex in yRange:
+            for xIndex in xRange:
+                offsetY=(yIndex-1)* levelOutputTileInfo.tileHeight
+                offsetX=(xIndex-1)* levelOutputTileInfo.tileWidth
+                if yIndex==levelOutputTileInfo.countTilesY:
+                    height=levelOutputTileInfo.lastTileHeight
+                else:
+                    height=levelOutputTileInfo.tileHeight
+
+                if xIndex==levelOutputTileInfo.countTilesX:
+                    width=levelOutputTileInfo.lastTileWidth
+                else:
+                    width=levelOutputTileInfo.tileWidth
+                geotransform=[levelMosaicInfo.ulx+offsetX*sx, sx, 0,
+                              levelMosaicInfo.uly+offsetY*sy, 0, sy]
+                result=addJournaledTile(level, xIndex, yIndex, geotransform, width, height, self.OGRDS, self.IndexDS)
+                if result is False:
+                    tilename=getTileName(levelMosaicInfo,levelOutputTileInfo, xIndex, yIndex,level)
+                    if isTileChanged(geotransform, width, height):
+                        self.jobs.append((xIndex, yIndex, offsetX, offsetY, width, height, geotransform,
+                                          tilename, factor, level))
+                        continue
+                    elif os.path.exists(tilename):
+                        result=tilename
+                        addTileFeatures(result, geotransform, width, height, self.OGRDS, self.IndexDS)
+                    else:
+                        result=None
+                    if Journal is not None:
+                        Journal.addTile(level, xIndex, yIndex, result)
+                self.addCreated(xIndex, yIndex, result)
+
+    def addCreated(self, xIndex, yIndex, result):
+        if result is not None:
+            self.created.append((xIndex, yIndex, result))
+
+        self.count += 1
+        if self.IndexDS is not None and self.count % TileIndexBatchSize == 0:
+            commitTileIndexBatch(self.IndexDS)
+            beginTileIndexBatch(self.IndexDS)
+
+    def add(self, job, result):
+        """ indexes a tile rendered by renderPyramidTile """
+        xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename, factor, level = job
+        if Journal is not None:
+            Journal.addTile(level, xIndex, yIndex, result)
+        if result is not None:
+            addTileFeatures(result, geotransform, width, height, self.OGRDS, self.IndexDS)
+        self.addCreated(xIndex, yIndex, result)
+
+    def finish(self):
+        """
+        writes the indexes and bounds files of the level
 
-    if TileIndexName is not None:
-        shapeName=getTargetDir(level)+TileIndexName
-        copyTileIndexToDisk(OGRDS,shapeName)
+        returns an in memory index of the created tiles
+        """
+        self.created.sort(key=lambda tile: (tile[1], tile[0]))
 
-    if CsvFileName is not None:
-        csvName=getTargetDir(level)+CsvFileName
-        copyTileIndexToCSV(OGRDS,csvName)
+        if self.IndexDS is not None:
+            commitTileIndexBatch(self.IndexDS)
+            closeTileIndex(self.IndexDS)
 
+        if TileSink is not None:
+            TileSink.endLevel(self.level)
 
-    return OGRDS
+        if not self.levelDone:
+            writeTileBounds(getTargetDir(self.level), self.levelMosaicInfo.ulx,
+                            self.levelMosaicInfo.uly, self.sx, self.sy,
+                            self.levelOutputTileInfo, self.created)
+            if Journal is not None:
+                Journal.addLevel(self.level)
+
+        return self.OGRDS
+
+def renderPyramidTiles(levelMosaicInfo, levels):
+    """
+    renders the tiles left in the jobs of the PyramidLevels levels, all
+    read from levelMosaicInfo, with one pool of -processes workers
+    """
+    jobs = [job for pyramidLevel in levels for job in pyramidLevel.jobs]
+    byLevel = dict((pyramidLevel.level, pyramidLevel) for pyramidLevel in levels)
+
+    # the workers only render the tiles, the indexes are written here
+    global TileMosaicInfo
+    TileMosaicInfo = levelMosaicInfo
+    if Processes > 1 and TileSink is None and len(jobs) > 1:
+        if Journal is not None:
+            Journal.sync()
+        pool = multiprocessing.Pool(Processes, initializer=initTileWorker)
+        imap = pool.imap
+    else:
+        pool = None
+        imap = lambda function, jobs, chunksize: (function(job) for job in jobs)
+
+    for job, result in imap(renderPyramidTile, jobs, 16):
+        byLevel[job[-1]].add(job, result)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def renderPyramidTile(job):
+    """
+    renders one tile of a pyramid level; runs in the worker processes when
+    -processes is given
+
+    returns (job, tile name) or (job, None) for an empty tile
+    """
+    xIndex, yIndex, offsetX, offsetY, width, height, geotransform, tilename, factor, level = job
+    result = createPyramidTile(TileMosaicInfo, offsetX, offsetY, width, height, tilename,
+                               None, None, factor)
+    if result is None:
+        removeStaleTile(tilename)
+    return (job, result)
+
+def getMercatorBounds(minfo, srs):
+    """
+    returns the extent of the mosaic in EPSG:3857 as (minx, miny, maxx, maxy)
+    """
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(3857)
+    for ref in (srs, target):
+        if hasattr(ref, "SetAxisMappingStrategy"):
+            ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs, target)
+
+    # densify the edges, straight lines in the source are curved in mercator
+    steps = 20
+    xs = []
+    ys = []
+    for i in range(steps + 1):
+        fx = minfo.ulx + (minfo.lrx - minfo.ulx) * i / float(steps)
+        fy = minfo.lry + (minfo.uly - minfo.lry) * i / float(steps)
+        for x, y in ((fx, minfo.uly), (fx, minfo.lry), (minfo.ulx, fy), (minfo.lrx, fy)):
+            if srs.IsGeographic():
+                y = max(-85.0511287798, min(85.0511287798, y))
+            point = transform.TransformPoint(x, y)
+            xs.append(point[0])
+            ys.append(point[1])
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def getMercatorTileName(zoom, x, y):
+    if TilingScheme == "tms":
+        y = mercator.flipY(zoom, y)
+    if Extension is None:
+        ext = Format.lower()
+    else:
+        ext = Extension
+    return TargetDir + "%d%s%d%s%d.%s" % (zoom, os.sep, x, os.sep, y, ext)
+
+def isEmptyTile(ds):
+    for band in range(1, ds.RasterCount + 1):
+        data = ds.GetRasterBand(band).ReadAsArray()
+        if SourceNoData is None:
+            if data.any():
+                return False
+        elif (data != SourceNoData).any():
+            return False
+    return True
+
+def warpMercatorTile(zoom, x, y):
+    """
+    renders XYZ tile x/y at zoom from the source mosaic
+    """
+    options = gdal.WarpOptions(format="MEM", outputBounds=mercator.tileBounds(zoom, x, y),
+                               width=TileWidth, height=TileWidth, dstSRS="EPSG:3857",
+                               resampleAlg=ResamplingMethod, outputType=getBandType(MercatorInfo),
+                               srcNodata=SourceNoData, dstNodata=SourceNoData)
+    return gdal.Warp("", SourceVRTName, options=options)
+
+def openMercatorTile(zoom, x, y):
+    if TileSink is not None:
+        return TileSink.open(TileSink.location(zoom, x + 1, y + 1))
+    tilename = getMercatorTileName(zoom, x, y)
+    if not os.path.exists(tilename):
+        return None
+    return gdal.Open(tilename)
+
+def mergeMercatorChildren(zoom, x, y):
+    """
+    renders XYZ tile x/y at zoom from its four tiles at zoom + 1
+    """
+    size = TileWidth
+    minx, miny, maxx, maxy = mercator.tileBounds(zoom, x, y)
+    res = mercator.resolution(zoom, size)
+    bands = MercatorInfo.bands
+    bt = getBandType(MercatorInfo)
+
+    mosaic = None
+    for i, (cx, cy) in enumerate(mercator.children(x, y)):
+        child = openMercatorTile(zoom + 1, cx, cy)
+        if child is None:
+            continue
+        if mosaic is None:
+            mosaic = gdal.GetDriverByName("MEM").Create("", 2 * size, 2 * size, bands, bt)
+            mosaic.SetGeoTransform([minx, res / 2, 0, maxy, 0, -res / 2])
+            for band in range(1, bands + 1):
+                if SourceNoData is not None:
+                    mosaic.GetRasterBand(band).SetNoDataValue(SourceNoData)
+                    mosaic.GetRasterBand(band).Fill(SourceNoData)
+        for band in range(1, bands + 1):
+            data = child.GetRasterBand(band).ReadRaster(0, 0, size, size, size, size, bt)
+            mosaic.GetRasterBand(band).WriteRaster((i % 2) * size, (i // 2) * size,
+                                                   size, size, data, size, size, bt)
+        child = None
+
+    if mosaic is None:
+        return None
+
+    ds = gdal.GetDriverByName("MEM").Create("", size, size, bands, bt)
+    ds.SetGeoTransform([minx, res, 0, maxy, 0, -res])
+    for band in range(1, bands + 1):
+        if SourceNoData is not None:
+            ds.GetRasterBand(band).SetNoDataValue(SourceNoData)
+            ds.GetRasterBand(band).Fill(SourceNoData)
+    gdal.ReprojectImage(mosaic, ds, None, None, ResamplingMethod)
+    return ds
+
+def renderMercatorTile(job):
+    """
+    renders one XYZ tile; runs in the worker processes
+
+    returns (zoom, x, y, result) where result is the encoded tile when
+    writing to a tile database, the tile file name otherwise, or None for
+    tiles that were skipped
+    """
+    zoom, x, y = job
+    if zoom == MaxZoom or ZoomFrom == "source":
+        ds = warpMercatorTile(zoom, x, y)
+    else:
+        ds = mergeMercatorChildren(zoom, x, y)
+    if ds is None or (SkipEmpty and isEmptyTile(ds)):
+        return (zoom, x, y, None)
+
+    ds.SetProjection(MercatorSRS.ExportToWkt())
+    if TileSink is not None:
+        return (zoom, x, y, encodeTile(ds, TileSink.location(zoom, x + 1, y + 1)))
+
+    tilename = getMercatorTileName(zoom, x, y)
+    makeDir(os.path.dirname(tilename))
+    if TileBlobs is not None:
+        writeTileFile(tilename, encodeTile(ds, tilename, True))
+        return (zoom, x, y, tilename)
+    unlinkSharedTile(tilename)
+    tt_fh = Driver.CreateCopy(tilename, ds, 0, CreateOptions)
+    if tt_fh is None:
+        print('Creation failed, terminating gdal_tile.')
+        sys.exit( 1 )
+    tt_fh = None
+    return (zoom, x, y, tilename)
+
+def tileMercator(minfo, srs):
+    """
+    renders the mosaic as web mercator XYZ/TMS tiles, from MaxZoom down to
+    MinZoom
+    """
+    global MercatorInfo
+    global MercatorSRS
+    global SourceVRTName
+    global SourceNoData
+    global MinZoom
+    global MaxZoom
+
+    MercatorInfo = minfo
+    MercatorSRS = osr.SpatialReference()
+    MercatorSRS.ImportFromEPSG(3857)
+    bounds = getMercatorBounds(minfo, srs)
+    if MaxZoom is None:
+        MaxZoom = mercator.zoomForResolution((bounds[2] - bounds[0]) / minfo.xsize, TileWidth)
+    if MinZoom is None:
+        MinZoom = 0
+
+    fd, SourceVRTName = tempfile.mkstemp(suffix=".vrt")
+    os.close(fd)
+    vrt = gdal.BuildVRT(SourceVRTName, Names, outputSRS=srs.ExportToWkt())
+    SourceNoData = vrt.GetRasterBand(1).GetNoDataValue()
+    vrt = None
+
+    for zoom in range(MaxZoom, MinZoom - 1, -1):
+        xmin, ymin, xmax, ymax = mercator.tileRange(zoom, *bounds)
+        jobs = [(zoom, x, y) for y in range(ymin, ymax + 1) for x in range(xmin, xmax + 1)]
+
+        if TileSink is not None:
+            res = mercator.resolution(zoom, TileWidth)
+            size = 2 ** zoom * TileWidth
+            TileSink.beginLevel(zoom, None, tile_info(size, size, TileWidth, TileWidth),
+                                [-mercator.ORIGIN, res, 0, mercator.ORIGIN, 0, -res],
+                                MercatorSRS.ExportToWkt(), minfo.bands, getBandType(minfo))
+
+        # the workers are forked once the level is known to the tile sink,
+        # which they read the child tiles from
+        if Processes > 1:
+            pool = multiprocessing.Pool(Processes)
+            imap = pool.imap_unordered
+        else:
+            pool = None
+            imap = lambda function, jobs, chunksize: (function(job) for job in jobs)
+
+        if not Quiet and not Verbose:
+            progress(0.0)
+        processed = 0
+        for tileZoom, x, y, result in imap(renderMercatorTile, jobs, 16):
+            if result is not None and TileSink is not None:
+                TileSink.put(TileSink.location(tileZoom, x + 1, y + 1), result)
+            processed += 1
+            if Verbose and result is not None:
+                print("%d/%d/%d" % (tileZoom, x, y))
+            elif not Quiet and not Verbose:
+                progress(processed / float(len(jobs)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if TileSink is not None:
+            TileSink.endLevel(zoom)
+
+    os.remove(SourceVRTName)
+
+def pruneTileBlobs():
+    """
+    removes the -dedupe payloads which no tile links to any more; shards
+    leave them to the -mergeShards run, since the payload just stored by
+    another shard has no link yet
+    """
+    if TileBlobs is not None and getShardTag() is None:
+        TileBlobs.prune()
+
+def reportDedupe():
+    """
+    prints how many of the tiles written with -dedupe were stored once
+    """
+    if TileSink is not None:
+        tiles, unique, size, stored = TileSink.writer.getDedupeStats()
+    else:
+        tiles, unique, size, stored = TileBlobs.getStats()
+    print("Deduplication: %d tiles stored as %d unique payloads, %d of %d bytes written "
+          "(ratio %.2f:1)" % (tiles, unique, stored, size, size / float(max(stored, 1))))
 
 def getTileName(minfo,ti,xIndex,yIndex,level = -1):
     """
@@ -681,10 +2304,13 @@ def getTileName(minfo,ti,xIndex,yIndex,level = -1):
     """
     global LastRowIndx
 
-    max = ti.countTilesX
-    if (ti.countTilesY > max):
-        max=ti.countTilesY
-    countDigits= len(str(max))
+    if TileSink is not None:
+        return TileSink.location(max(level, 0), xIndex, yIndex)
+
+    maxCount = ti.countTilesX
+    if (ti.countTilesY > maxCount):
+        maxCount=ti.countTilesY
+    countDigits= len(str(maxCount))
     parts=os.path.splitext(os.path.basename(minfo.filename))
     if parts[0][0]=="@" : #remove possible leading "@"
        parts = ( parts[0][1:len(parts[0])], parts[1])
@@ -695,7 +2321,7 @@ def getTileName(minfo,ti,xIndex,yIndex,level = -1):
         if LastRowIndx < yIndex :
             LastRowIndx = yIndex
             if (os.path.exists(getTargetDir(level)+str(yIndex)) == False) :
-                os.mkdir(getTargetDir(level)+str(yIndex))
+                makeDir(getTargetDir(level)+str(yIndex))
     else:
         format=getTargetDir(level)+parts[0]+"_%0"+str(countDigits)+"i"+"_%0"+str(countDigits)+"i"
     #Check for the extension that should be used.
@@ -719,11 +2345,18 @@ def Usage():
      print('        [-ps pixelWidth pixelHeight]')
      print('        [-ot  {Byte/Int16/UInt16/UInt32/Int32/Float32/Float64/')
      print('               CInt16/CInt32/CFloat32/CFloat64}]')
-     print('        [ -tileIndex tileIndexName [-tileIndexField fieldName]]')
-     print('        [ -csv fileName [-csvDelim delimiter]]')
+     print('        [ -tileIndex tileIndexName [-tileIndexField fieldName]')
+     print('          [-tileIndexFormat {ESRI Shapefile/GPKG/FlatGeobuf}] [-tileIndexBatch count]]')
+     print('        [ -csv fileName [-csvDelim delimiter]] [-boundsIndex {fileName.npy/fileName.parquet}]')
      print('        [-s_srs srs_def]  [-pyramidOnly] -levels numberoflevels')
      print('        [-r {near/bilinear/cubic/cubicspline/lanczos}]')
-     print('        [-useDirForEachRow]')
+     print('        [-reduce {mean/mode/min/max}[,{mean/mode/min/max}]*]')
+     print('        [-useDirForEachRow] [-tileStore | -tileDB {fileName.mbtiles/fileName.gpkg}]')
+     print('        [-tilingScheme {raster/xyz/tms} [-zoom minZoom[-maxZoom]] [-skipEmpty]]')
+     print('        [-zoomFrom {below/source}] [-processes count]')
+     print('        [-shard k/n | -tileRange first-last | -mergeShards] [-resume]')
+     print('        [-profile {fast/small/lossy}] [-footprints catalogFile]')
+     print('        [-pipeline readDepth[,writeDepth]] [-update] [-dedupe]')
      print('        -targetDir TileDirectory input_files')
 
 # =============================================================================
@@ -739,7 +2372,6 @@ def main(args = None):
     global Verbose
     global Quiet
     global CreateOptions
-    global Names
     global TileWidth
     global TileHeight
     global Format
@@ -749,25 +2381,49 @@ def main(args = None):
     global MemDriver
     global TileIndexFieldName
     global TileIndexName
+    global TileIndexFormat
+    global TileIndexBatchSize
     global CsvDelimiter
     global CsvFileName
+    global BoundsIndexName
 
-    global TileIndexDriverTyp
     global Source_SRS
     global TargetDir
     global ResamplingMethod
     global Levels
     global PyramidOnly
     global UseDirForEachRow
+    global TileStore
+    global TileDBName
+    global TileSink
+    global TilingScheme
+    global MinZoom
+    global MaxZoom
+    global ZoomFrom
+    global SkipEmpty
+    global Processes
+    global Shard
+    global TileRange
+    global MergeShards
+    global Resume
+    global Journal
+    global Profile
+    global ReduceMethods
+    global FootprintCatalogName
+    global PipelineDepths
+    global Update
+    global ChangedAreas
+    global Dedupe
+    global TileBlobs
 
-    gdal.AllRegister()
-    
     if args is None:
         args = sys.argv
-    argv = gdal.GeneralCmdLineProcessor( args )
-    if argv is None:
-        return 1
-    print argv
+    # Only load GDAL for its generic --options
+    argv = list(args)
+    if any(arg.startswith("--") for arg in args[1:]):
+        argv = gdal.GeneralCmdLineProcessor( args )
+        if argv is None:
+            return 1
     # Parse command line arguments.
     i = 1
     while i < len(argv):
@@ -849,17 +2505,115 @@ def main(args = None):
         elif arg == '-tileIndexField':
             i+=1
             TileIndexFieldName=argv[i]
+        elif arg == '-tileIndexFormat':
+            i+=1
+            TileIndexFormat=argv[i]
+        elif arg == '-tileIndexBatch':
+            i+=1
+            TileIndexBatchSize=int(argv[i])
+            if TileIndexBatchSize<1:
+                print("Invalid tile index batch size : %d" % TileIndexBatchSize)
+                return 1
         elif arg == '-csv':
             i+=1
             CsvFileName=argv[i]
             parts=os.path.splitext(CsvFileName)
             if len(parts[1])==0:
                 CsvFileName+=".csv"
+        elif arg == '-boundsIndex':
+            i+=1
+            BoundsIndexName=argv[i]
+            parts=os.path.splitext(BoundsIndexName)
+            if len(parts[1])==0:
+                BoundsIndexName+=".npy"
         elif arg == '-csvDelim':
             i+=1
             CsvDelimiter=argv[i]
         elif arg == '-useDirForEachRow':
             UseDirForEachRow=True
+        elif arg == '-tilingScheme':
+            i+=1
+            TilingScheme=argv[i].lower()
+            if TilingScheme not in ("raster", "xyz", "tms"):
+                print("Unknown tiling scheme: %s" % argv[i])
+                return 1
+        elif arg == '-zoom':
+            i+=1
+            zooms=[int(z) for z in argv[i].split("-")]
+            MinZoom=zooms[0]
+            MaxZoom=zooms[-1]
+            if MinZoom<0 or MaxZoom<MinZoom:
+                print("Invalid zoom range : %s" % argv[i])
+                return 1
+        elif arg == '-zoomFrom':
+            i+=1
+            ZoomFrom=argv[i]
+            if ZoomFrom not in ("below", "source"):
+                print("Unknown -zoomFrom: %s" % ZoomFrom)
+                return 1
+        elif arg == '-skipEmpty':
+            SkipEmpty=True
+        elif arg == '-processes':
+            i+=1
+            Processes=int(argv[i])
+        elif arg == '-shard':
+            i+=1
+            try:
+                Shard=tuple(int(k) for k in argv[i].split("/"))
+            except ValueError:
+                Shard=()
+            if len(Shard)!=2 or Shard[0]<1 or Shard[0]>Shard[1]:
+                print("Invalid shard : %s, expected k/n with 1 <= k <= n" % argv[i])
+                return 1
+        elif arg == '-tileRange':
+            i+=1
+            try:
+                TileRange=tuple(int(t) for t in argv[i].split("-"))
+            except ValueError:
+                TileRange=()
+            if len(TileRange)!=2 or TileRange[0]<1 or TileRange[1]<TileRange[0]:
+                print("Invalid tile range : %s" % argv[i])
+                return 1
+        elif arg == '-mergeShards':
+            MergeShards=True
+        elif arg == '-resume':
+            Resume=True
+        elif arg == '-update':
+            Update=True
+        elif arg == '-dedupe':
+            Dedupe=True
+        elif arg == '-reduce':
+            i+=1
+            ReduceMethods=argv[i].lower().split(",")
+            for method in ReduceMethods:
+                if method not in ("mean", "mode", "min", "max"):
+                    print("Unknown reduction kernel: %s" % method)
+                    return 1
+        elif arg == '-footprints':
+            i+=1
+            FootprintCatalogName=argv[i]
+        elif arg == '-pipeline':
+            i+=1
+            try:
+                PipelineDepths=[int(d) for d in argv[i].split(",")]
+            except ValueError:
+                PipelineDepths=[]
+            if len(PipelineDepths)==1:
+                PipelineDepths.append(PipelineDepths[0])
+            if len(PipelineDepths)!=2 or min(PipelineDepths)<1:
+                print("Invalid pipeline queue depths : %s" % argv[i])
+                return 1
+        elif arg == '-profile':
+            i+=1
+            Profile=argv[i].lower()
+            if Profile not in ("fast", "small", "lossy"):
+                print("Unknown profile: %s" % argv[i])
+                return 1
+        elif arg == '-tileStore':
+            TileStore=True
+        elif arg == '-tileDB':
+            i+=1
+            TileDBName=argv[i]
         elif arg[:1] == '-':
             print('Unrecognized command option: %s' % arg)
             Usage()
@@ -883,11 +2637,77 @@ def main(args = None):
         Usage()
         return 1
 
+    if ResamplingMethod is None:
+        ResamplingMethod=gdal.GRA_NearestNeighbour
+
+    # MBTiles and GeoPackage readers only accept these tile encodings
+    if TileDBName is not None and Format not in ("PNG", "JPEG", "WEBP"):
+        print("-tileDB needs -of PNG, JPEG or WEBP")
+        return 1
+
+    # XYZ/TMS tiles are square, named by zoom, x and y, and the zoom
+    # levels replace the pyramid
+    if TilingScheme != "raster":
+        if TileStore:
+            print("-tileStore is not supported with -tilingScheme %s" % TilingScheme)
+            return 1
+        if TileIndexName is not None or CsvFileName is not None or BoundsIndexName is not None:
+            print("-tileIndex, -csv and -boundsIndex are not supported with -tilingScheme %s"
+                  % TilingScheme)
+            return 1
+        if Levels > 0:
+            print("-levels is not supported with -tilingScheme %s, use -zoom" % TilingScheme)
+            return 1
+        if TileWidth != TileHeight:
+            print("-tilingScheme %s needs square tiles" % TilingScheme)
+            return 1
+
+    if Shard is not None or TileRange is not None or MergeShards:
+        if TileStore or TileDBName is not None or TilingScheme != "raster":
+            print("-shard, -tileRange and -mergeShards only support tiles written as files "
+                  "with -tilingScheme raster")
+            return 1
+        if MergeShards and (Shard is not None or TileRange is not None):
+            print("-mergeShards can not be combined with -shard or -tileRange")
+            return 1
+
+    if Resume and (TileStore or TileDBName is not None or TilingScheme != "raster"):
+        print("-resume only supports tiles written as files with -tilingScheme raster")
+        return 1
+
+    if Update:
+        if TileStore or TileDBName is not None or TilingScheme != "raster":
+            print("-update only supports tiles written as files with -tilingScheme raster")
+            return 1
+        if Shard is not None or TileRange is not None or MergeShards or PyramidOnly:
+            print("-update can not be combined with -shard, -tileRange, -mergeShards or -pyramidOnly")
+            return 1
+
+    if Dedupe:
+        if TileStore:
+            print("-dedupe is not supported with -tileStore")
+            return 1
+        # other formats embed the georeferencing, so no two tiles are equal
+        if Format not in ("PNG", "JPEG", "WEBP"):
+            print("-dedupe needs -of PNG, JPEG or WEBP")
+            return 1
+        if TileDBName is not None and os.path.splitext(TileDBName)[1].lower() == ".gpkg":
+            print("-dedupe only supports -tileDB with an MBTiles file")
+            return 1
+
+    if PipelineDepths is not None:
+        if TileStore or TileDBName is not None or TilingScheme != "raster":
+            print("-pipeline only supports tiles written as files with -tilingScheme raster")
+            return 1
+        if Processes > 1:
+            print("-pipeline can not be combined with -processes")
+            return 1
+
     # create level 0 directory if needed
     if(UseDirForEachRow and PyramidOnly==False) :
         leveldir=TargetDir+str(0)+os.sep
         if (os.path.exists(leveldir)==False):
-            os.mkdir(leveldir)
+            makeDir(leveldir)
 
     if Levels > 0:    #prepare Dirs for pyramid
         startIndx=1
@@ -895,7 +2715,7 @@ def main(args = None):
             leveldir=TargetDir+str(levelIndx)+os.sep
             if (os.path.exists(leveldir)):
                 continue
-            os.mkdir(leveldir)
+            makeDir(leveldir)
             if (os.path.exists(leveldir)==False):
                 print("Cannot create level dir: %s" % leveldir)
                 return 1
@@ -914,9 +2734,22 @@ def main(args = None):
 
     DriverMD = Driver.GetMetadata()
     Extension=DriverMD.get(gdal.DMD_EXTENSION);
-    if 'DCAP_CREATE' not in DriverMD:
+    if TileDBName is not None:
+        TileSink=TileDBSink(TileDBName)
+    elif TileStore:
+        TileSink=TileStoreSink()
+
+    # deduplicated tiles are encoded in memory and hashed before writing
+    if Dedupe and TileSink is None:
+        from dedupe import TileBlobStore
+        TileBlobs=TileBlobStore(TargetDir+DedupeDirName)
+
+    if 'DCAP_CREATE' not in DriverMD or TileSink is not None or TileBlobs is not None:
         MemDriver=gdal.GetDriverByName("MEM")
 
+    if TileSink is not None:
+        TileSink.baseName=os.path.splitext(os.path.basename(Names[0]))[0].lstrip("@")
+
 
     tileIndexDS=getTileIndexFromFiles(Names,TileIndexDriverTyp)
     if tileIndexDS is None:
@@ -935,15 +2768,78 @@ def main(args = None):
         minfo.report()
         ti.report()
 
+    if ReduceMethods is not None and len(ReduceMethods) not in (1, minfo.bands):
+        print("-reduce needs one kernel or one per band (%d)" % minfo.bands)
+        return 1
+
+    if Profile is not None:
+        if Driver.ShortName != "GTiff":
+            print("-profile is only supported with -of GTiff")
+            return 1
+        profileOptions = getProfileOptions(Profile, Driver, getBandType(minfo), minfo.bands)
+        if profileOptions is None:
+            print("-profile %s is not supported for %d band(s) of type %s"
+                  % (Profile, minfo.bands, gdal.GetDataTypeName(getBandType(minfo))))
+            return 1
+        CreateOptions = mergeCreateOptions(profileOptions, CreateOptions)
+
+    if TilingScheme != "raster":
+        if Source_SRS is None:
+            print("A source projection is required for -tilingScheme %s" % TilingScheme)
+            return 1
+        tileMercator(minfo, Source_SRS)
+        pruneTileBlobs()
+        if Dedupe and not Quiet:
+            reportDedupe()
+        if TileSink is not None:
+            TileSink.close()
+        return 0
+
+
+    if Resume:
+       Journal = TileJournal(TargetDir+getShardFileName(JournalName), TileIndexBatchSize)
+       if not Journal.begin(TileWidth, TileHeight, minfo.xsize, minfo.ysize):
+           print("%s was written for different inputs or tile sizes" % Journal.fileName)
+           return 1
+       Journal.validate()
+
+    # only the tiles over inputs changed since the previous run are rendered
+    if Update:
+       from footprints import FootprintCatalog
+       sources = FootprintCatalog(TargetDir+SourcesName)
+       ChangedAreas = getChangedAreas(sources, minfo)
 
-    if PyramidOnly==False:
+    if MergeShards:
+       dsCreatedTileIndex = mergeShardIndexes()
+       if dsCreatedTileIndex is None:
+           return 1
+    elif PyramidOnly==False:
        dsCreatedTileIndex = tileImage(minfo,ti)
-       tileIndexDS.Destroy()
     else:
        dsCreatedTileIndex=tileIndexDS
 
-    if Levels>0:
+    # the pyramid is built by the merge step once all shards are done
+    if getShardTag() is None and Levels>0:
        buildPyramid(minfo,dsCreatedTileIndex,TileWidth, TileHeight)
+    if dsCreatedTileIndex is not tileIndexDS:
+       tileIndexDS.Destroy()
+
+    if Journal is not None:
+       Journal.close()
+
+    # the inputs are recorded once all tiles are written
+    if Update:
+       current = set(os.path.abspath(name) for name in Names)
+       sources.remove([path for path in sources.getPaths() if path not in current])
+       sources.getFootprints(Names, Processes)
+       sources.close()
+
+    pruneTileBlobs()
+    if Dedupe and not Quiet:
+        reportDedupe()
+
+    if TileSink is not None:
+        TileSink.close()
 
     if Verbose:
         print("FINISHED")
@@ -963,9 +2859,12 @@ def initGlobals():
     global MemDriver
     global TileIndexFieldName
     global TileIndexName
+    global TileIndexFormat
+    global TileIndexBatchSize
     global TileIndexDriverTyp
     global CsvDelimiter
     global CsvFileName
+    global BoundsIndexName
     global Source_SRS
     global TargetDir
     global ResamplingMethod
@@ -973,6 +2872,28 @@ def initGlobals():
     global PyramidOnly
     global LastRowIndx
     global UseDirForEachRow
+    global TileStore
+    global TileDBName
+    global TileSink
+    global TilingScheme
+    global MinZoom
+    global MaxZoom
+    global ZoomFrom
+    global SkipEmpty
+    global Processes
+    global Shard
+    global TileRange
+    global MergeShards
+    global Resume
+    global Journal
+    global Profile
+    global ReduceMethods
+    global FootprintCatalogName
+    global PipelineDepths
+    global Update
+    global ChangedAreas
+    global Dedupe
+    global TileBlobs
 
 
     Verbose=False
@@ -987,9 +2908,12 @@ def initGlobals():
     MemDriver=None
     TileIndexFieldName='location'
     TileIndexName=None
+    TileIndexFormat=None
+    TileIndexBatchSize=10000
     TileIndexDriverTyp="Memory"
     CsvDelimiter=";"
     CsvFileName=None
+    BoundsIndexName=None
 
     Source_SRS=None
     TargetDir=None
@@ -998,6 +2922,28 @@ def initGlobals():
     PyramidOnly=False
     LastRowIndx=-1
     UseDirForEachRow=False
+    TileStore=False
+    TileDBName=None
+    TileSink=None
+    TilingScheme="raster"
+    MinZoom=None
+    MaxZoom=None
+    ZoomFrom="below"
+    SkipEmpty=False
+    Processes=1
+    Shard=None
+    TileRange=None
+    MergeShards=False
+    Resume=False
+    Journal=None
+    Profile=None
+    ReduceMethods=None
+    FootprintCatalogName=None
+    PipelineDepths=None
+    Update=False
+    ChangedAreas=None
+    Dedupe=False
+    TileBlobs=None
 
 
 
@@ -1015,16 +2961,51 @@ Extension=None
 MemDriver=None
 TileIndexFieldName='location'
 TileIndexName=None
+TileIndexFormat=None
+TileIndexBatchSize=10000
 TileIndexDriverTyp="Memory"
+TileIndexDrivers={".shp": "ESRI Shapefile", ".gpkg": "GPKG", ".fgb": "FlatGeobuf"}
 CsvDelimiter=";"
 CsvFileName=None
+BoundsIndexName=None
 Source_SRS=None
 TargetDir=None
-ResamplingMethod=gdal.GRA_NearestNeighbour
+ResamplingMethod=None
 Levels=0
 PyramidOnly=False
 LastRowIndx=-1
 UseDirForEachRow=False
+TileStore=False
+TileDBName=None
+TileSink=None
+TilingScheme="raster"
+MinZoom=None
+MaxZoom=None
+ZoomFrom="below"
+SkipEmpty=False
+Processes=1
+Shard=None
+TileRange=None
+MergeShards=False
+ShardIndexName="shardindex.shp"
+Resume=False
+Journal=None
+JournalName="gdal_retile.journal"
+Profile=None
+ReduceMethods=None
+FootprintCatalogName=None
+PipelineDepths=None
+Update=False
+ChangedAreas=None
+SourcesName="gdal_retile.sources"
+Dedupe=False
+TileBlobs=None
+DedupeDirName=".dedupe"
+TileMosaicInfo=None
+MercatorInfo=None
+MercatorSRS=None
+SourceVRTName=None
+SourceNoData=None
 
 
 if __name__ == '__main__':
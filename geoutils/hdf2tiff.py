@@ -1,39 +1,85 @@
+import collections
+import copy
 import datetime
 import multiprocessing
 import errno
 import glob
+import math
 import os
 import shutil
-from xml.etree.ElementTree import parse, SubElement
+import threading
+from multiprocessing.pool import ThreadPool
+from xml.etree.ElementTree import Element, parse, SubElement
 
 import click
-import gdal
-from utils import IntCSVParamType, TemporaryDirectory
+import bandmath
+from catalog import HDFCatalog
+from utils import (BBoxParamType, IntCSVParamType, LazyModule, QueryParamType,
+                   TemporaryDirectory, get_metadata_item, keep_gdal_drivers)
 
 DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
+# Drivers used to read the HDF files, to write the VRTs and tiffs
+# and to read cutlines
+GDAL_DRIVERS = ("HDF4", "HDF4Image", "HDF5", "HDF5Image", "GTiff", "MEM", "VRT", "Memory",
+                "ESRI Shapefile", "GeoJSON", "GPKG")
+
+gdal = LazyModule("gdal")
+gdal_array = LazyModule("gdal_array")
+numpy = LazyModule("numpy")
+ogr = LazyModule("ogr")
+osr = LazyModule("osr")
+
 NO_DATA = -9999
 
+SINUSOIDAL = "+proj=sinu +R=6371007.181 +nadgrids=@null +wktext"
+
+# Integer types from the smallest up, with the range of values they hold
+INTEGER_TYPES = (("Byte", 0, 2 ** 8 - 1),
+                 ("UInt16", 0, 2 ** 16 - 1),
+                 ("Int16", -2 ** 15, 2 ** 15 - 1),
+                 ("UInt32", 0, 2 ** 32 - 1),
+                 ("Int32", -2 ** 31, 2 ** 31 - 1))
 
-def get_metadata_item(subdataset, keyword):
+
+def get_value_range(subdataset, downcast=False):
     """
-    Checks for keyword in metadata and returns if it exists
+    Returns the range of values of an integer subdataset
 
     :param subdataset: HDF subdataset
-    :param keyword: Keyword to
-    :return: Metadata item
+    :param downcast: Use the actual minimum and maximum (reads the band)
+                     instead of the range of its data type
+    :return: (low, high), or None for floating point bands
     """
 
     dataset = gdal.Open(subdataset, gdal.GA_ReadOnly)
+    band = dataset.GetRasterBand(1)
+    type_name = gdal.GetDataTypeName(band.DataType)
+
+    for name, low, high in INTEGER_TYPES:
+        if name == type_name:
+            if downcast:
+                return band.ComputeRasterMinMax(False)
+            return (low, high)
+    return None
+
 
-    metadata = dataset.GetMetadata_Dict()
+def get_integer_type(ranges):
+    """
+    Returns the smallest integer type holding every range
 
-    # Filter the metadata
-    filtered_meta = {k: v for k, v in metadata.iteritems()
-                     if keyword in k.lower()}
+    :param ranges: List of (low, high) ranges, None for floating point data
+    :return: GDAL data type name or None if no integer type fits
+    """
 
-    # Hopefully there will be one element in the dictionary
-    return filtered_meta[filtered_meta.keys()[0]]
+    if any(value_range is None for value_range in ranges):
+        return None
+    low = min(value_range[0] for value_range in ranges)
+    high = max(value_range[1] for value_range in ranges)
+    for name, type_low, type_high in INTEGER_TYPES:
+        if type_low <= low and high <= type_high:
+            return name
+    return None
 
 
 
@@ -64,12 +110,179 @@ def modify_vrt(vrt, scale):
     doc.write(vrt, xml_declaration=True)
 
 
-def convert_to_vrt(subdatasets, data_dir, bands):
+def add_vrt_metadata(vrt, metadata, band_scaling=None):
+    """
+    Adds metadata items to the vrt, and the scale and offset of its bands,
+    so that they are written along with the pixels by the warp.
+
+    :param vrt: Stacked VRT file to be processed
+    :param metadata: Dictionary of dataset metadata items
+    :param band_scaling: Optional list of (scale, offset) per band
+    :return: None
+    """
+
+    doc = parse(vrt)
+
+    root = doc.getroot()
+
+    domain = [m for m in root.findall('Metadata') if not m.get('domain')]
+    if domain:
+        domain = domain[0]
+    else:
+        domain = Element('Metadata')
+        root.insert(0, domain)
+    for key, value in sorted(metadata.items()):
+        item = SubElement(domain, 'MDI')
+        item.set('key', key)
+        item.text = value
+
+    for raster_band, scaling in zip(root.findall('VRTRasterBand'), band_scaling or []):
+        scale, offset = scaling
+        SubElement(raster_band, 'Scale').text = repr(scale)
+        SubElement(raster_band, 'Offset').text = repr(offset)
+
+    doc.write(vrt, xml_declaration=True)
+
+
+def add_expression_band(vrt, band_index, expression, band_vrts):
+    """
+    Turns a band of the stacked vrt into a derived band which evaluates
+    expression block by block while the vrt is read.
+
+    :param vrt: Stacked VRT file to be processed
+    :param band_index: Band of the stacked VRT to replace (indexed from 1)
+    :param expression: Band math expression, e.g. (b4-b3)/(b4+b3)
+    :param band_vrts: Dictionary of band number to single band VRT file
+    :return: None
+    """
+
+    doc = parse(vrt)
+
+    root = doc.getroot()
+
+    raster_band = [b for b in root.findall('VRTRasterBand')
+                   if b.get('band') == str(band_index)][0]
+    raster_band.set('subClass', 'VRTDerivedRasterBand')
+    raster_band.set('dataType', 'Float32')
+
+    description = Element('Description')
+    description.text = expression
+    raster_band.insert(0, description)
+
+    # Use the placeholder source as a template for every input band
+    template = [child for child in raster_band
+                if child.tag.endswith('Source')][0]
+    raster_band.remove(template)
+
+    numbers = bandmath.band_numbers(expression)
+    for number in numbers:
+        source = copy.deepcopy(template)
+        filename = source.find('SourceFilename')
+        filename.set('relativeToVRT', '0')
+        filename.text = band_vrts[number]
+        raster_band.append(source)
+
+    function_type = SubElement(raster_band, 'PixelFunctionType')
+    function_type.text = 'geoutils.bandmath.pixel_function'
+    function_language = SubElement(raster_band, 'PixelFunctionLanguage')
+    function_language.text = 'Python'
+    arguments = SubElement(raster_band, 'PixelFunctionArguments')
+    arguments.set('expression', expression)
+    arguments.set('bands', ','.join(str(number) for number in numbers))
+    arguments.set('nodata', str(NO_DATA))
+
+    doc.write(vrt, xml_declaration=True)
+
+
+def get_srs(definition):
+    """ Returns an osr.SpatialReference with x/y axis order """
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(definition)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def transform_bounds(bounds, src_srs, dst_srs, densify=21):
+    """
+    Transforms bounds between coordinate systems, sampling points along
+    the edges since the sinusoidal projection bends straight lines
+
+    :param bounds: (minx, miny, maxx, maxy) in src_srs
+    :return: (minx, miny, maxx, maxy) in dst_srs
+    """
+    minx, miny, maxx, maxy = bounds
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    points = []
+    for i in range(densify):
+        fx = minx + (maxx - minx) * i / float(densify - 1)
+        fy = miny + (maxy - miny) * i / float(densify - 1)
+        points += [(fx, miny), (fx, maxy), (minx, fy), (maxx, fy)]
+    xs, ys = zip(*[transform.TransformPoint(x, y)[:2] for x, y in points])
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def get_cutline_bounds(cutline, dst_srs):
+    """ Returns the extent of the cutline features in dst_srs """
+    source = ogr.Open(cutline)
+    if source is None:
+        raise IOError("Could not open cutline {}".format(cutline))
+    layer = source.GetLayer(0)
+    minx, maxx, miny, maxy = layer.GetExtent()
+    srs = layer.GetSpatialRef()
+    if srs is None:
+        return (minx, miny, maxx, maxy)
+    if hasattr(srs, "SetAxisMappingStrategy"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return transform_bounds((minx, miny, maxx, maxy), srs, dst_srs)
+
+
+def get_source_window(subdataset, bounds):
+    """
+    Returns the window of the subdataset covering bounds, snapped
+    outwards to whole pixels and clipped to the raster
+
+    :param subdataset: HDF subdataset
+    :param bounds: (minx, miny, maxx, maxy) in the source coordinate system
+    :return: (xoff, yoff, xsize, ysize) or None if bounds miss the raster
+    """
+    dataset = gdal.Open(subdataset, gdal.GA_ReadOnly)
+    x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+    minx, miny, maxx, maxy = bounds
+
+    xs = sorted([(minx - x0) / dx, (maxx - x0) / dx])
+    ys = sorted([(miny - y0) / dy, (maxy - y0) / dy])
+    xoff = max(0, int(math.floor(xs[0])))
+    yoff = max(0, int(math.floor(ys[0])))
+    xend = min(dataset.RasterXSize, int(math.ceil(xs[1])))
+    yend = min(dataset.RasterYSize, int(math.ceil(ys[1])))
+    if xend <= xoff or yend <= yoff:
+        return None
+    return (xoff, yoff, xend - xoff, yend - yoff)
+
+
+def window_bounds(subdataset, window):
+    """ Returns the (minx, miny, maxx, maxy) of a window of the subdataset """
+    dataset = gdal.Open(subdataset, gdal.GA_ReadOnly)
+    x0, dx, _, y0, _, dy = dataset.GetGeoTransform()
+    xoff, yoff, xsize, ysize = window
+    xs = (x0 + xoff * dx, x0 + (xoff + xsize) * dx)
+    ys = (y0 + yoff * dy, y0 + (yoff + ysize) * dy)
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def convert_to_vrt(subdatasets, data_dir, bands, source_bounds=None,
+                   nodata=NO_DATA, keep_integers=False):
     """
     Loops through the subdatasets and creates vrt files
 
     :param subdatasets: Subdataset of every HDF file
     :param data_dir: Result of create_output_directory method
+    :param source_bounds: Only include the pixels covering these
+                          (minx, miny, maxx, maxy) source coordinates
+    :param nodata: Value the fill values are replaced with
+    :param keep_integers: Keep the stored values instead of scaling
+                          them to Float32
     :return: None
     """
     data_list = []
@@ -87,16 +300,28 @@ def convert_to_vrt(subdatasets, data_dir, bands):
         # Get the fill value
         fill_value = get_metadata_item(subdatasets[band][0], 'fillvalue')
 
+        # Restrict the vrt to the source window (srcWin) of the area of
+        # interest so that only the HDF blocks inside it are decoded
+        output_bounds = None
+        if source_bounds is not None:
+            window = get_source_window(subdatasets[band][0], source_bounds)
+            if window is None:
+                raise ValueError("Band {} is outside of the area of interest".format(band + 1))
+            output_bounds = window_bounds(subdatasets[band][0], window)
+
         # Pass some options
-        vrt_options = gdal.BuildVRTOptions(srcNodata=fill_value, VRTNodata=NO_DATA)
+        vrt_options = gdal.BuildVRTOptions(srcNodata=fill_value, VRTNodata=nodata,
+                                           outputBounds=output_bounds)
 
         # Create the virtual raster
         gdal.BuildVRT(output_name, subdatasets[band][0], options=vrt_options)
 
         # Check if scale and offset exists
-        scale = get_metadata_item(subdatasets[band][0], 'scale')
+        # (kept as band metadata of the tiff for integer output)
+        if not keep_integers:
+            scale = get_metadata_item(subdatasets[band][0], 'scale')
 
-        modify_vrt(output_name, scale)
+            modify_vrt(output_name, scale)
 
         data_list.append(output_name)
 
@@ -110,14 +335,160 @@ def get_date(year, doy):
                                                 str(date.month).zfill(2))
     return formatted_date
 
-def hdf2tif(hdf, tiff_path, bands=None, clobber=False,
-            reproject=True, warpMemoryLimit=4096):
+def warp_to_vrt(vrt, data_dir, warp_kwargs, warpMemoryLimit=4096):
     """
-    Converts hdf files to tiff files
+    Lets GDAL work out the output grid without warping any pixels,
+    reading a window of the warped VRT only warps that window
+
+    :param vrt: Stacked VRT to be warped
+    :param data_dir: Directory for the warped VRT
+    :param warp_kwargs: gdal.WarpOptions arguments (e.g. srcSRS, dstSRS)
+    :param warpMemoryLimit: Memory limit of every reader of the VRT (MB)
+    :return: Path of the warped VRT
+    """
+
+    warped_vrt = os.path.join(data_dir, "warped.vrt")
+    options = gdal.WarpOptions(format="VRT", warpMemoryLimit=warpMemoryLimit,
+                               **warp_kwargs)
+    gdal.Warp(warped_vrt, vrt, options=options)
+    return warped_vrt
+
+
+def warp_in_chunks(tiff_path, vrt, data_dir, warp_kwargs, chunk_size,
+                   threads=1, warpMemoryLimit=4096):
+    """
+    Warps vrt into tiff_path one chunk of the output at a time so that
+    peak memory is bounded by the chunk size rather than the file size
+
+    :param tiff_path: Output tiff
+    :param vrt: Stacked VRT to be warped
+    :param data_dir: Directory for the warped VRT
+    :param warp_kwargs: gdal.WarpOptions arguments (e.g. srcSRS, dstSRS)
+    :param chunk_size: Width and height of the chunks in output pixels
+    :param threads: Number of chunks warped in parallel
+    :param warpMemoryLimit: Memory limit shared by the threads (MB)
+    :return: (min, max, mean, stddev) of the valid pixels of every band,
+             None for bands without valid pixels
+    """
+
+    warped_vrt = warp_to_vrt(vrt, data_dir, warp_kwargs,
+                             max(1, warpMemoryLimit // threads))
+    warped = gdal.Open(warped_vrt)
+    xsize, ysize = warped.RasterXSize, warped.RasterYSize
+    band_count = warped.RasterCount
+    data_type = warped.GetRasterBand(1).DataType
+
+    target = gdal.GetDriverByName("GTiff").Create(
+        tiff_path, xsize, ysize, band_count, data_type,
+        ["TILED=YES", "BIGTIFF=IF_SAFER"])
+    target.SetGeoTransform(warped.GetGeoTransform())
+    target.SetProjection(warped.GetProjection())
+
+    # Set the metadata before the first write so it lands in the first
+    # directory of the tiff
+    target.SetMetadata(warped.GetMetadata())
+    nodata_values = []
+    for band in range(1, band_count + 1):
+        source_band = warped.GetRasterBand(band)
+        target_band = target.GetRasterBand(band)
+        nodata = source_band.GetNoDataValue()
+        if nodata is not None:
+            target_band.SetNoDataValue(nodata)
+        if source_band.GetScale() is not None:
+            target_band.SetScale(source_band.GetScale())
+        if source_band.GetOffset() is not None:
+            target_band.SetOffset(source_band.GetOffset())
+        nodata_values.append(nodata)
+    warped = None
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+
+    chunks = [(xoff, yoff, min(chunk_size, xsize - xoff),
+               min(chunk_size, ysize - yoff))
+              for yoff in range(0, ysize, chunk_size)
+              for xoff in range(0, xsize, chunk_size)]
+
+    # GDAL datasets must not be shared between threads
+    local = threading.local()
+
+    def warp_chunk(chunk):
+        if not hasattr(local, "dataset"):
+            local.dataset = gdal.Open(warped_vrt)
+        xoff, yoff, width, height = chunk
+        return chunk, local.dataset.ReadRaster(xoff, yoff, width, height)
+
+    # Running minimum, maximum, sum, sum of squares and count per band
+    sums = [[None, None, 0.0, 0.0, 0] for _ in range(band_count)]
+
+    def write_chunk(result):
+        (xoff, yoff, width, height), data = result
+        target.WriteRaster(xoff, yoff, width, height, data)
+
+        pixels = numpy.frombuffer(data, dtype=dtype).reshape(band_count, height, width)
+        for band, band_sums in enumerate(sums):
+            values = pixels[band]
+            valid = numpy.ones(values.shape, dtype=bool)
+            if nodata_values[band] is not None:
+                valid &= values != nodata_values[band]
+            if values.dtype.kind == "f":
+                valid &= ~numpy.isnan(values)
+            values = values[valid].astype(numpy.float64)
+            if values.size == 0:
+                continue
+            low, high = values.min(), values.max()
+            band_sums[0] = low if band_sums[0] is None else min(band_sums[0], low)
+            band_sums[1] = high if band_sums[1] is None else max(band_sums[1], high)
+            band_sums[2] += values.sum()
+            band_sums[3] += (values * values).sum()
+            band_sums[4] += values.size
+
+    pool = ThreadPool(threads)
+    try:
+        # At most threads chunks are warped or waiting to be written, so a
+        # slow writer holds back the warping instead of piling up chunks;
+        # only this thread writes to the target
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(warp_chunk, (chunk,)))
+            if len(pending) >= threads:
+                write_chunk(pending.popleft().get())
+        while pending:
+            write_chunk(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+    target = None
+
+    statistics = []
+    for low, high, total, squares, count in sums:
+        if count == 0:
+            statistics.append(None)
+            continue
+        mean = total / count
+        statistics.append((low, high, mean, math.sqrt(max(squares / count - mean * mean, 0.0))))
+    return statistics
+
+
+def build_stack(hdf, data_dir, bands=None, reproject=True, expressions=None,
+                bbox=None, cutline=None, target_res=None, keep_integers=False,
+                downcast=False):
+    """
+    Stacks the bands of an hdf file into a VRT with the metadata of the
+    tiff, and works out how it is warped
 
     :param hdf: HDF file to be processed
+    :param data_dir: Directory for the VRT files
     :param reproject: Will be reprojected by default
-    :return: None
+    :param expressions: Band math expressions added as extra bands
+    :param bbox: Clip to (minx, miny, maxx, maxy) in output coordinates
+    :param cutline: Clip to the features of this vector file
+    :param target_res: Output pixel size in output coordinates
+    :param keep_integers: Keep the stored integer values and record the
+                          scale, offset and nodata as band metadata
+    :param downcast: With keep_integers, use the smallest integer type
+                     holding the actual values
+    :return: (stacked VRT, gdal.WarpOptions arguments), or None if hdf is
+             outside of bbox/cutline
     """
 
     basename, _ = os.path.splitext(os.path.basename(hdf))
@@ -125,62 +496,213 @@ def hdf2tif(hdf, tiff_path, bands=None, clobber=False,
     dataset = gdal.Open(hdf, gdal.GA_ReadOnly)
     subdatasets = dataset.GetSubDatasets()
 
+    expressions = list(expressions or [])
+    if keep_integers and expressions:
+        raise ValueError("Band expressions need scaled Float32 bands, "
+                         "they can not be combined with keep_integers")
+
     # Use bands passed in,  or list of all bands (indexed from 1)
-    bands = bands if bands is not None else range(1, len(subdatasets) + 1)
+    # unless only derived bands were asked for
+    if bands is None:
+        bands = [] if expressions else range(1, len(subdatasets) + 1)
+    bands = list(bands)
+
+    # Bands only needed as inputs of the expressions
+    source_bands = list(bands)
+    for expression in expressions:
+        for band in bandmath.band_numbers(expression):
+            if band > len(subdatasets):
+                raise ValueError("{} has no band {}".format(hdf, band))
+            if band not in source_bands:
+                source_bands.append(band)
+
+    # Integer output keeps the fill value as nodata if all bands share it
+    nodata = NO_DATA
+    if keep_integers:
+        fill_values = set(float(get_metadata_item(subdatasets[band - 1][0], 'fillvalue'))
+                          for band in bands)
+        if len(fill_values) == 1:
+            nodata = fill_values.pop()
+
+    # The warp takes the nodata of the tiff from the stacked VRT
+    if reproject:
+        warp_kwargs = dict(srcSRS=SINUSOIDAL, dstSRS="EPSG:4326")
+    else:
+        warp_kwargs = {}
+    if keep_integers:
+        # A tiff has a single data type for all of its bands
+        ranges = [get_value_range(subdatasets[band - 1][0], downcast) for band in bands]
+        output_type = get_integer_type(ranges + [(nodata, nodata)]) or "Float32"
+        warp_kwargs.update(outputType=gdal.GetDataTypeByName(output_type))
+    if target_res:
+        warp_kwargs.update(xRes=target_res, yRes=target_res)
+
+    # Work out the area of interest in output and source coordinates
+    source_bounds = None
+    if bbox is not None or cutline is not None:
+        source_srs = get_srs(SINUSOIDAL)
+        output_srs = get_srs("EPSG:4326") if reproject else source_srs
+
+        area = bbox
+        if cutline is not None:
+            warp_kwargs.update(cutlineDSName=cutline, cropToCutline=True)
+            cutline_bounds = get_cutline_bounds(cutline, output_srs)
+            if area is None:
+                area = cutline_bounds
+            else:
+                area = (max(area[0], cutline_bounds[0]), max(area[1], cutline_bounds[1]),
+                        min(area[2], cutline_bounds[2]), min(area[3], cutline_bounds[3]))
+        if bbox is not None:
+            warp_kwargs.update(outputBounds=bbox)
+
+        if area[0] < area[2] and area[1] < area[3]:
+            source_bounds = transform_bounds(area, output_srs, source_srs)
+        if (source_bounds is None or
+                get_source_window(subdatasets[0][0], source_bounds) is None):
+            click.echo("Skipping {}, it is outside of the area of interest".format(hdf))
+            return None
+
+    vrt_list = convert_to_vrt(subdatasets, data_dir, source_bands, source_bounds,
+                              nodata, keep_integers)
+    band_vrts = dict(zip(source_bands, vrt_list))
+
+    # Every expression gets a placeholder band which is turned
+    # into a derived band once the stack is built
+    stack = [band_vrts[band] for band in bands]
+    stack += [band_vrts[bandmath.band_numbers(expression)[0]]
+              for expression in expressions]
+
+    vrt_options = gdal.BuildVRTOptions(separate=True, srcNodata=nodata)
+    vrt_output = os.path.join(data_dir, basename + ".vrt")
+
+    gdal.BuildVRT(vrt_output, stack, options=vrt_options)
+
+    for idx, expression in enumerate(expressions):
+        add_expression_band(vrt_output, len(bands) + idx + 1,
+                            expression, band_vrts)
+
+    meta = dataset.GetMetadata()
+
+    # Add the metadata
+    for idx, band in enumerate(bands):
+        # Generate band names
+        key = "BAND_{}_NAME".format(idx + 1)
+        meta[key] = str(subdatasets[band - 1][0].split(":")[4])
+
+    for idx, expression in enumerate(expressions):
+        key = "BAND_{}_NAME".format(len(bands) + idx + 1)
+        meta[key] = expression
+
+    meta['BANDS'] = str(meta)
+
+    doy = int(meta['Mean_JDOY'])
+    year = int(basename.split(".")[3])
+
+    # Set the date time for the dataset
+    meta["TIFFTAG_DATETIME"] = get_date(year, doy)
+
+    # Consumers apply the scale of integer bands lazily
+    band_scaling = None
+    if keep_integers:
+        band_scaling = [(float(get_metadata_item(subdatasets[band - 1][0], 'scale')),
+                         float(get_metadata_item(subdatasets[band - 1][0], 'offset', 0)))
+                        for band in bands]
+
+    # The warp copies the metadata of the vrt into the tiff as it is
+    # created, so the tiff is written once and never reopened for update
+    add_vrt_metadata(vrt_output, meta, band_scaling)
+
+    if expressions:
+        # Allow the vrt to run the band math pixel function
+        gdal.SetConfigOption('GDAL_VRT_ENABLE_PYTHON', 'TRUSTED_MODULES')
+        gdal.SetConfigOption('GDAL_VRT_PYTHON_TRUSTED_MODULES',
+                             'geoutils.bandmath')
+
+    return vrt_output, warp_kwargs
 
-    # data_dir = create_output_directory(hdf)
-    with TemporaryDirectory() as data_dir:
-        vrt_list = convert_to_vrt(subdatasets, data_dir, bands)
-        vrt_options = gdal.BuildVRTOptions(separate=True, srcNodata=NO_DATA)
-        vrt_output = os.path.join(data_dir, basename + ".vrt")
 
-        gdal.BuildVRT(vrt_output, vrt_list, options=vrt_options)
+def hdf2tif(hdf, tiff_path, bands=None, clobber=False,
+            reproject=True, warpMemoryLimit=4096, expressions=None,
+            chunk_size=None, chunk_threads=1, bbox=None, cutline=None,
+            target_res=None, keep_integers=False, downcast=False):
+    """
+    Converts hdf files to tiff files
+
+    :param hdf: HDF file to be processed
+    :param reproject: Will be reprojected by default
+    :param expressions: Band math expressions added as extra bands
+    :param chunk_size: Warp the output in chunks of this many pixels
+    :param chunk_threads: Number of chunks warped in parallel
+    :param bbox: Clip to (minx, miny, maxx, maxy) in output coordinates
+    :param cutline: Clip to the features of this vector file
+    :param target_res: Output pixel size in output coordinates
+    :param keep_integers: Keep the stored integer values and record the
+                          scale, offset and nodata as band metadata
+    :param downcast: With keep_integers, use the smallest integer type
+                     holding the actual values
+    :return: Path of the tiff, or None if hdf is outside of bbox/cutline
+    """
 
-        if reproject:
-            proj = "+proj=sinu +R=6371007.181 +nadgrids=@null +wktext"
-            warp_options = gdal.WarpOptions(srcSRS=proj, dstSRS="EPSG:4326",
-                                            warpMemoryLimit=warpMemoryLimit,
-                                            multithread=True)
+    # data_dir = create_output_directory(hdf)
+    with TemporaryDirectory() as data_dir:
+        stack = build_stack(hdf, data_dir, bands, reproject, expressions, bbox,
+                            cutline, target_res, keep_integers, downcast)
+        if stack is None:
+            return None
+        vrt_output, warp_kwargs = stack
+
+        if warp_kwargs:
+            warp_options = gdal.WarpOptions(warpMemoryLimit=warpMemoryLimit,
+                                            multithread=True, **warp_kwargs)
         else:
             warp_options = ""
         if not clobber and os.path.exists(tiff_path):
             raise RuntimeError(
                 "{} already exists, use '--clober' to overwrite".format(tiff_path))
 
-        gdal.Warp(tiff_path,
-                  vrt_output, options=warp_options)
-
-
-        meta = dataset.GetMetadata()
+        if chunk_size:
+            statistics = warp_in_chunks(tiff_path, vrt_output, data_dir, warp_kwargs,
+                                        chunk_size, chunk_threads, warpMemoryLimit)
+        else:
+            gdal.Warp(tiff_path,
+                      vrt_output, options=warp_options)
+            statistics = None
 
-        # Add the metadata
-        for idx, band in enumerate(bands):
-            # Generate band names
-            key = "BAND_{}_NAME".format(idx + 1)
-            meta[key] = str(subdatasets[band - 1][0].split(":")[4])
+        # Inject the band statistics so that
+        # we do not have to enter them
+        store_statistics(tiff_path, statistics)
 
-        dataset = gdal.Open(tiff_path, gdal.GA_Update)
+    return tiff_path
 
-        # Inject the metadata to the tiff
 
-        meta['BANDS'] = str(meta)
-        dataset.SetMetadata(meta)
+def store_statistics(tiff_path, statistics=None):
+    """
+    Stores exact band statistics of a tiff. It is opened read only, so they
+    go to the .aux.xml sidecar and the tiff is left as written
 
-        doy = int(meta['Mean_JDOY'])
-        year = int(basename.split(".")[3])
+    :param tiff_path: Tiff
+    :param statistics: (min, max, mean, stddev) or None per band, as returned
+                       by warp_in_chunks; computed from the tiff if None
+    """
 
-        # Set the date time for the dataset
-        dataset.SetMetadataItem("TIFFTAG_DATETIME", get_date(year, doy))
+    dataset = gdal.Open(tiff_path, gdal.GA_ReadOnly)
+    for band in range(dataset.RasterCount):
+        if statistics is None:
+            dataset.GetRasterBand(band+1).ComputeStatistics(0)
+        elif statistics[band] is not None:
+            dataset.GetRasterBand(band+1).SetStatistics(*statistics[band])
 
-        # Inject the band statistics so that
-        # we do not have to enter them
-        for band in range(dataset.RasterCount):
-            srcband = dataset.GetRasterBand(band+1).ComputeStatistics(0)
+    # Flush the statistics
+    dataset = None
 
-        # Flush the dataset
-        dataset = None
 
-    return tiff_path
+def prune_gdal_drivers():
+    """
+    Deregisters every GDAL driver hdf2tiff does not use, so that each
+    gdal.Open() probes fewer drivers. This changes the registry of the whole
+    process, so only the command line tool does it when asked to.
+    """
+    keep_gdal_drivers(gdal, GDAL_DRIVERS)
 
 
 def serial_process(hdf_files, **kwargs):
@@ -201,34 +723,103 @@ def process_file((hdf_file, kwargs)):
 
     file_base, ext = os.path.splitext(os.path.basename(hdf_file))
 
-    hdf2tif(hdf_file, os.path.join(output_dir, file_base + ".tiff"),
-            **kwargs)
+    return hdf2tif(hdf_file, os.path.join(output_dir, file_base + ".tiff"),
+                   **kwargs)
 
 @click.command()
 @click.argument('hdf_files', nargs=-1,
                 type=click.Path(exists=True, resolve_path=True))
+@click.option('-q', '--query', default=None, type=QueryParamType(),
+              help="Only convert the cataloged files matching e.g. "
+                   "tile=h09v04,year=2011,month=7 (HDF_FILES and directories "
+                   "among them are added to the catalog first)")
+@click.option('--catalog', default="hdf_catalog.sqlite",
+              type=click.Path(dir_okay=False),
+              help="Catalog file used by --query")
 @click.option('-o', '--output', default=None,
               type=click.Path(file_okay=False, writable=True),
               help="Output file/directory")
 @click.option('-b', '--bands', default=None, type=IntCSVParamType(),
               help="Only include specified bands (formated as csv)")
+@click.option('-e', '--expression', 'expressions', multiple=True,
+              help="Band math expression added as a band, e.g. "
+                   "'(b4-b3)/(b4+b3)' (can be repeated)")
 @click.option('-w', '--warpMemoryLimit', default=4096,
               help="Memory limit for Warp operation")
+@click.option('--chunk-size', default=0,
+              help="Warp the output in chunks of this many pixels "
+                   "to bound memory use (0 warps the whole file at once)")
+@click.option('--chunk-threads', default=1,
+              help="Number of chunks warped in parallel")
+@click.option('--bbox', default=None, type=BBoxParamType(),
+              help="Clip to minx,miny,maxx,maxy in output coordinates "
+                   "(EPSG:4326 unless --no-reproject)")
+@click.option('--cutline', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="Clip to the features of a vector file")
+@click.option('--target-res', default=None, type=float,
+              help="Output pixel size in output coordinates")
+@click.option('--keep-integers', is_flag=True,
+              help="Keep the stored integers, with scale/offset/nodata as "
+                   "band metadata, instead of scaling to Float32")
+@click.option('--downcast', is_flag=True,
+              help="With --keep-integers, use the smallest integer type "
+                   "holding the values")
 @click.option('-j', '--jobs', default=0, help="Number of Processes in pool")
+@click.option('--prune-drivers', is_flag=True,
+              help="Deregister the GDAL drivers not needed to read HDF files "
+                   "and write tiffs, so opening files probes fewer drivers")
 @click.option('--clobber/--no-clobber', default=False, help="Overwrite the created tiff")
 @click.option('--reproject/--no-reproject', default=True, help="Reproject the tiff")
-def main(hdf_files, output, bands, warpmemorylimit, jobs, clobber, reproject):
+def main(hdf_files, query, catalog, output, bands, expressions, warpmemorylimit, chunk_size,
+         chunk_threads, bbox, cutline, target_res, keep_integers, downcast, jobs,
+         prune_drivers, clobber, reproject):
     """ Main function which orchestrates the conversion """
+    for expression in expressions:
+        try:
+            bandmath.band_numbers(expression)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--expression")
+    if keep_integers and expressions:
+        raise click.BadParameter("can not be combined with --expression",
+                                 param_hint="--keep-integers")
+    if downcast and not keep_integers:
+        raise click.BadParameter("needs --keep-integers", param_hint="--downcast")
+
+    if query is not None:
+        hdf_catalog = HDFCatalog(catalog)
+        try:
+            if hdf_files:
+                hdf_catalog.update(hdf_files, max(jobs, 1))
+            hdf_files = hdf_catalog.query(**query)
+        finally:
+            hdf_catalog.close()
+        click.echo("{} files match the query".format(len(hdf_files)))
+
     kwargs = dict(output_dir=output,
                   bands=bands,
+                  expressions=list(expressions),
                   warpMemoryLimit=warpmemorylimit,
+                  chunk_size=chunk_size,
+                  chunk_threads=chunk_threads,
+                  bbox=bbox,
+                  cutline=cutline,
+                  target_res=target_res,
+                  keep_integers=keep_integers,
+                  downcast=downcast,
                   clobber=clobber,
                   reproject=reproject)
 
+    initializer = None
+    if prune_drivers:
+        prune_gdal_drivers()
+        # spawned workers start with a fresh registry
+        initializer = prune_gdal_drivers
+
     if jobs == 0:
         serial_process(hdf_files, **kwargs)
     else:
-        p = multiprocessing.Pool(jobs)
+        p = multiprocessing.Pool(jobs, initializer=initializer)
         p.map(process_file, zip(hdf_files, [kwargs] * len(hdf_files)))
 
 if __name__ == "__main__":
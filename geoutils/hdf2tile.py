@@ -0,0 +1,345 @@
+"""
+Converts HDF files straight into gdal_retile tiles.
+
+The stacked VRT of hdf2tiff is warped window by window into the tile grid
+gdal_retile would cut from the tiff, so no intermediate tiff is written
+and read back. Tiles are warped in parallel worker processes, which also
+halve every tile with a nodata aware kernel; the pyramid levels are
+assembled from these quarters in memory instead of being read back.
+"""
+import multiprocessing
+import os
+
+import click
+import gdal_retile
+from hdf2tiff import build_stack, gdal, numpy, warp_to_vrt
+from utils import BBoxParamType, IntCSVParamType, TemporaryDirectory
+
+REDUCE_METHODS = ("mean", "mode", "min", "max")
+
+# Settings of the file being tiled, set once in every worker process
+_settings = {}
+_datasets = {}
+
+
+def init_worker(settings):
+    """ Receives the settings of the file being tiled in a worker process """
+    _settings.clear()
+    _settings.update(settings)
+    _datasets.clear()
+
+
+def tile_extension(driver):
+    """
+    Returns the extension of the tiles written by driver, which gdal_retile
+    takes from the driver metadata, or that of the tiffs of hdf2tiff
+    """
+    return driver.GetMetadataItem(gdal.DMD_EXTENSION) or "tiff"
+
+
+def tile_name(output_dir, basename, grid, level, x, y, extension):
+    """
+    Returns the file of tile x/y (indexed from 0) named like gdal_retile
+    names it: in output_dir for level 0 and in output_dir/<level>/ above
+    """
+    if level > 0:
+        output_dir = os.path.join(output_dir, str(level))
+    digits = len(str(max(grid.countTilesX, grid.countTilesY)))
+    name = "{}_{:0{digits}d}_{:0{digits}d}.{}".format(basename, y + 1, x + 1, extension,
+                                                      digits=digits)
+    return os.path.join(output_dir, name)
+
+
+def tile_window(grid, x, y):
+    """ Returns the (xoff, yoff, width, height) of tile x/y (indexed from 0) """
+    width = grid.lastTileWidth if x == grid.countTilesX - 1 else grid.tileWidth
+    height = grid.lastTileHeight if y == grid.countTilesY - 1 else grid.tileHeight
+    return (x * grid.tileWidth, y * grid.tileHeight, width, height)
+
+
+def write_tile(path, data, level, window):
+    """
+    Writes the (bands, height, width) array data as tile path
+
+    :param level: Pyramid level, its pixels are 2 ** level times larger
+    :param window: Window of the tile in the pixels of its level
+    """
+    x0, dx, rx, y0, ry, dy = _settings["geotransform"]
+    factor = 2 ** level
+    xoff, yoff, width, height = window
+    bands = data.shape[0]
+
+    tile = gdal.GetDriverByName("GTiff").Create(
+        path, width, height, bands, _settings["data_type"], _settings["create_options"])
+    tile.SetGeoTransform([x0 + xoff * dx * factor, dx * factor, rx,
+                          y0 + yoff * dy * factor, ry, dy * factor])
+    tile.SetProjection(_settings["projection"])
+    tile.SetMetadata(_settings["metadata"])
+    for band in range(bands):
+        target_band = tile.GetRasterBand(band + 1)
+        if _settings["nodata"] is not None:
+            target_band.SetNoDataValue(_settings["nodata"])
+        target_band.WriteArray(data[band])
+    tile = None
+
+
+def reduce_tile(data):
+    """ Halves every band of the (bands, height, width) array data """
+    import kernels
+    methods = _settings["reduce"]
+    return numpy.array([kernels.downsample(band, methods[min(idx, len(methods) - 1)],
+                                           _settings["nodata"])
+                        for idx, band in enumerate(data)])
+
+
+def render_tile(job):
+    """
+    Warps the window of one level 0 tile and writes it; runs in the
+    worker processes
+
+    :param job: (x, y, window, path) of the tile
+    :return: (x, y, quarter) where quarter is the tile halved for the
+             first pyramid level, None without pyramid
+    """
+    x, y, window, path = job
+    warped_vrt = _settings["warped_vrt"]
+    if warped_vrt not in _datasets:
+        _datasets[warped_vrt] = gdal.Open(warped_vrt)
+    xoff, yoff, width, height = window
+    data = _datasets[warped_vrt].ReadAsArray(xoff, yoff, width, height)
+    data = data.reshape((-1, height, width))
+
+    write_tile(path, data, 0, window)
+    if _settings["levels"] == 0:
+        return (x, y, None)
+    return (x, y, reduce_tile(data))
+
+
+class Pyramid(object):
+    """
+    A class assembling the pyramid tiles from the halved tiles of the level
+    below. A tile is written, and halved in turn, as soon as all of its
+    children have arrived, so only the partially covered tiles are kept
+    in memory.
+    """
+
+    def __init__(self, output_dir, basename, grids, extension):
+        self.output_dir = output_dir
+        self.basename = basename
+        self.grids = grids
+        self.extension = extension
+        self.pending = {}
+
+    def add(self, level, x, y, quarter):
+        """ Adds the halved tile x/y of level - 1 to its parent at level """
+        grid = self.grids[level]
+        child_grid = self.grids[level - 1]
+        px, py = x // 2, y // 2
+
+        # The floored level size may drop the last column or row of children
+        if px >= grid.countTilesX or py >= grid.countTilesY:
+            return
+
+        key = (level, px, py)
+        if key not in self.pending:
+            data = numpy.empty((quarter.shape[0], grid.tileHeight, grid.tileWidth),
+                               dtype=quarter.dtype)
+            nodata = _settings["nodata"]
+            data.fill(nodata if nodata is not None else 0)
+            children = (min(2, child_grid.countTilesX - 2 * px) *
+                        min(2, child_grid.countTilesY - 2 * py))
+            self.pending[key] = [data, children]
+
+        entry = self.pending[key]
+        height, width = quarter.shape[1:]
+        xoff = (x % 2) * (grid.tileWidth // 2)
+        yoff = (y % 2) * (grid.tileHeight // 2)
+        entry[0][:, yoff:yoff + height, xoff:xoff + width] = quarter
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+
+        del self.pending[key]
+        window = tile_window(grid, px, py)
+        data = entry[0][:, :window[3], :window[2]]
+        write_tile(tile_name(self.output_dir, self.basename, grid, level, px, py,
+                             self.extension),
+                   data, level, window)
+        if level + 1 < len(self.grids):
+            self.add(level + 1, px, py, reduce_tile(data))
+
+
+def hdf2tile(hdf, output_dir, tile_size=256, levels=0, jobs=1, reduce=("mean",),
+             create_options=None, profile=None, clobber=False, warpMemoryLimit=4096,
+             **kwargs):
+    """
+    Converts an hdf file into tiles without writing an intermediate tiff
+
+    :param hdf: HDF file to be processed
+    :param output_dir: Directory of the level 0 tiles, the pyramid levels
+                       go to numbered sub directories like gdal_retile's
+    :param tile_size: Width and height of the tiles (even)
+    :param levels: Number of pyramid levels
+    :param jobs: Number of processes warping tiles
+    :param reduce: Kernel halving the tiles, one for all bands or one per band
+    :param create_options: GTiff creation options of the tiles
+    :param profile: gdal_retile compression profile (fast, small or lossy)
+    :param warpMemoryLimit: Memory limit shared by the processes (MB)
+    :param kwargs: Arguments of build_stack (bands, expressions, bbox, ...)
+    :return: Number of level 0 tiles, or None if hdf is outside of bbox/cutline
+    """
+
+    basename, _ = os.path.splitext(os.path.basename(hdf))
+    jobs = max(jobs, 1)
+
+    with TemporaryDirectory() as data_dir:
+        stack = build_stack(hdf, data_dir, **kwargs)
+        if stack is None:
+            return None
+        vrt_output, warp_kwargs = stack
+        warped_vrt = warp_to_vrt(vrt_output, data_dir, warp_kwargs,
+                                 max(1, warpMemoryLimit // jobs))
+
+        warped = gdal.Open(warped_vrt)
+        bands = warped.RasterCount
+        data_type = warped.GetRasterBand(1).DataType
+        if len(reduce) not in (1, bands):
+            raise ValueError("{} has {} bands, reduce needs one kernel or one per band"
+                             .format(hdf, bands))
+
+        driver = gdal.GetDriverByName("GTiff")
+        extension = tile_extension(driver)
+        options = list(create_options or [])
+        if profile is not None:
+            profile_options = gdal_retile.getProfileOptions(
+                profile, driver, data_type, bands)
+            if profile_options is None:
+                raise ValueError("Profile {} is not supported for {} band(s) of type {}".format(
+                    profile, bands, gdal.GetDataTypeName(data_type)))
+            options = gdal_retile.mergeCreateOptions(profile_options, options)
+
+        settings = dict(warped_vrt=warped_vrt,
+                        geotransform=warped.GetGeoTransform(),
+                        projection=warped.GetProjection(),
+                        metadata=warped.GetMetadata(),
+                        data_type=data_type,
+                        nodata=warped.GetRasterBand(1).GetNoDataValue(),
+                        create_options=options,
+                        reduce=list(reduce),
+                        levels=levels)
+
+        # Level sizes are halved and floored like gdal_retile's
+        xsize, ysize = warped.RasterXSize, warped.RasterYSize
+        warped = None
+        grids = []
+        for level in range(levels + 1):
+            if xsize < 1 or ysize < 1:
+                break
+            grids.append(gdal_retile.tile_info(xsize, ysize, tile_size, tile_size))
+            xsize, ysize = xsize // 2, ysize // 2
+
+        # Any tile of any level may be left from an earlier run
+        if not clobber:
+            for level, grid in enumerate(grids):
+                for y in range(grid.countTilesY):
+                    for x in range(grid.countTilesX):
+                        path = tile_name(output_dir, basename, grid, level, x, y, extension)
+                        if os.path.exists(path):
+                            raise RuntimeError(
+                                "{} already exists, use '--clobber' to overwrite".format(path))
+
+        level0 = grids[0]
+        tiles = [(x, y, tile_window(level0, x, y),
+                  tile_name(output_dir, basename, level0, 0, x, y, extension))
+                 for y in range(level0.countTilesY) for x in range(level0.countTilesX)]
+        for level, grid in enumerate(grids):
+            gdal_retile.makeDir(os.path.dirname(
+                tile_name(output_dir, basename, grid, level, 0, 0, extension)))
+
+        # The pyramid is assembled in this process from the quarters
+        # returned by the workers
+        init_worker(settings)
+        pyramid = Pyramid(output_dir, basename, grids, extension)
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(settings,))
+            results = pool.imap_unordered(render_tile, tiles, 16)
+        else:
+            pool = None
+            results = (render_tile(tile) for tile in tiles)
+
+        try:
+            for x, y, quarter in results:
+                if quarter is not None and len(grids) > 1:
+                    pyramid.add(1, x, y, quarter)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    return len(tiles)
+
+
+@click.command()
+@click.argument('hdf_files', nargs=-1,
+                type=click.Path(exists=True, resolve_path=True))
+@click.option('-o', '--output', default=None,
+              type=click.Path(file_okay=False, writable=True),
+              help="Output directory (default: a directory named after "
+                   "every HDF file next to it)")
+@click.option('-b', '--bands', default=None, type=IntCSVParamType(),
+              help="Only include specified bands (formated as csv)")
+@click.option('-e', '--expression', 'expressions', multiple=True,
+              help="Band math expression added as a band (can be repeated)")
+@click.option('-ps', '--tile-size', default=256,
+              help="Width and height of the tiles")
+@click.option('--levels', default=0, help="Number of pyramid levels")
+@click.option('--reduce', default="mean",
+              help="Kernel halving the tiles for the pyramid (mean, mode, min "
+                   "or max), or one per band as csv")
+@click.option('-co', '--creation-option', 'create_options', multiple=True,
+              help="GTiff creation option of the tiles (can be repeated)")
+@click.option('--profile', default=None, type=click.Choice(["fast", "small", "lossy"]),
+              help="Compression profile of the tiles")
+@click.option('-w', '--warpMemoryLimit', default=4096,
+              help="Memory limit for Warp operation")
+@click.option('--bbox', default=None, type=BBoxParamType(),
+              help="Clip to minx,miny,maxx,maxy in output coordinates "
+                   "(EPSG:4326 unless --no-reproject)")
+@click.option('--cutline', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help="Clip to the features of a vector file")
+@click.option('--target-res', default=None, type=float,
+              help="Output pixel size in output coordinates")
+@click.option('--keep-integers', is_flag=True,
+              help="Keep the stored integers instead of scaling to Float32")
+@click.option('-j', '--jobs', default=1, help="Number of processes warping tiles")
+@click.option('--clobber/--no-clobber', default=False, help="Overwrite existing tiles")
+@click.option('--reproject/--no-reproject', default=True, help="Reproject the tiles")
+def main(hdf_files, output, bands, expressions, tile_size, levels, reduce,
+         create_options, profile, warpmemorylimit, bbox, cutline, target_res,
+         keep_integers, jobs, clobber, reproject):
+    """ Converts HDF files into tiles and pyramid levels """
+    if tile_size < 2 or tile_size % 2:
+        raise click.BadParameter("must be an even number of pixels", param_hint="--tile-size")
+    reduce = reduce.lower().split(",")
+    for method in reduce:
+        if method not in REDUCE_METHODS:
+            raise click.BadParameter("unknown kernel {}".format(method), param_hint="--reduce")
+    if keep_integers and expressions:
+        raise click.BadParameter("can not be combined with --expression",
+                                 param_hint="--keep-integers")
+
+    for hdf_file in hdf_files:
+        output_dir = output
+        if output_dir is None:
+            output_dir = os.path.splitext(hdf_file)[0]
+        count = hdf2tile(hdf_file, output_dir, tile_size, levels, jobs, reduce,
+                         create_options, profile, clobber, warpmemorylimit,
+                         bands=bands, expressions=list(expressions), bbox=bbox,
+                         cutline=cutline, target_res=target_res,
+                         keep_integers=keep_integers, reproject=reproject)
+        if count is not None:
+            click.echo("{}: {} tiles in {}".format(hdf_file, count, output_dir))
+
+if __name__ == "__main__":
+    main()
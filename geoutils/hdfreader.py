@@ -0,0 +1,199 @@
+from collections import OrderedDict
+
+from utils import LazyModule, find_metadata_item
+
+gdal = LazyModule("gdal")
+numpy = LazyModule("numpy")
+
+
+def sampled_blocks(offset, size, step, block_size):
+    """
+    Yields the blocks holding the samples offset + k * step of a window of
+    size pixels, as (block index, first k, last k + 1)
+    """
+    count = (size + step - 1) // step
+    first = 0
+    while first < count:
+        block = (offset + first * step) // block_size
+        stop = min(count, ((block + 1) * block_size - offset + step - 1) // step)
+        yield block, first, stop
+        first = stop
+
+
+class HDFReader(object):
+    """
+    Opens an HDF file once and exposes its subdatasets as lazily loaded,
+    scaled NumPy arrays. For example:
+
+        with HDFReader(hdf) as reader:
+            red = reader.band(3).read(window=(0, 0, 512, 512))
+            nir = reader.band(4)[0:512, 0:512]
+
+    Decoded blocks are shared between the bands in a least recently used
+    cache holding at most cache_blocks blocks.
+    """
+
+    def __init__(self, hdf, cache_blocks=256):
+        self.hdf = hdf
+        self.dataset = gdal.Open(hdf, gdal.GA_ReadOnly)
+        if self.dataset is None:
+            raise IOError("Could not open {}".format(hdf))
+        self.subdatasets = self.dataset.GetSubDatasets()
+        self.cache_blocks = cache_blocks
+        self._cache = OrderedDict()
+        self._bands = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.subdatasets)
+
+    def __getitem__(self, band):
+        return self.band(band)
+
+    @property
+    def metadata(self):
+        return self.dataset.GetMetadata()
+
+    @property
+    def names(self):
+        """ Short names of the subdatasets, in band order """
+        return [subdataset[0].split(":")[-1] for subdataset in self.subdatasets]
+
+    def band(self, band):
+        """
+        Returns a band of the HDF file
+
+        :param band: Band number (indexed from 1 like the -b option) or name
+        :return: HDFBand
+        """
+        if not isinstance(band, int):
+            band = self.names.index(band) + 1
+        if band not in self._bands:
+            if band < 1 or band > len(self.subdatasets):
+                raise IndexError("{} has no band {}".format(self.hdf, band))
+            self._bands[band] = HDFBand(self, band, self.subdatasets[band - 1][0])
+        return self._bands[band]
+
+    def _block(self, band, bx, by):
+        key = (band.number, bx, by)
+        if key in self._cache:
+            block = self._cache.pop(key)
+        else:
+            bw, bh = band.block_size
+            x0, y0 = bx * bw, by * bh
+            block = band.gdal_band.ReadAsArray(x0, y0,
+                                               min(bw, band.width - x0),
+                                               min(bh, band.height - y0))
+            if len(self._cache) >= self.cache_blocks:
+                self._cache.popitem(last=False)
+        self._cache[key] = block
+        return block
+
+    def close(self):
+        self._cache.clear()
+        for band in self._bands.values():
+            band.close()
+        self._bands = {}
+        self.dataset = None
+
+
+class HDFBand(object):
+    """
+    A lazily read band of an HDF file. Values are scaled with the band's
+    scale metadata and fill values become NaN (or are masked).
+    """
+
+    def __init__(self, reader, number, subdataset):
+        self.reader = reader
+        self.number = number
+        self.subdataset = subdataset
+        self.name = subdataset.split(":")[-1]
+
+        self.dataset = gdal.Open(subdataset, gdal.GA_ReadOnly)
+        self.gdal_band = self.dataset.GetRasterBand(1)
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.block_size = tuple(self.gdal_band.GetBlockSize())
+
+        metadata = self.dataset.GetMetadata_Dict()
+        self.scale = float(find_metadata_item(metadata, 'scale'))
+        self.fill_value = float(find_metadata_item(metadata, 'fillvalue'))
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def geotransform(self):
+        return self.dataset.GetGeoTransform()
+
+    def __getitem__(self, key):
+        """ Supports band[yslice, xslice] with positive steps """
+        rows, cols = key
+        ystart, ystop, ystep = rows.indices(self.height)
+        xstart, xstop, xstep = cols.indices(self.width)
+        return self.read(window=(xstart, ystart, xstop - xstart, ystop - ystart),
+                         step=(xstep, ystep))
+
+    def read_raw(self, window=None, step=1):
+        """
+        Reads the unscaled values of a window through the block cache; with
+        a step only the blocks holding sampled pixels are read
+
+        :param window: (xoff, yoff, xsize, ysize), the whole band by default
+        :param step: Take every step-th pixel, an int or (xstep, ystep)
+        :return: NumPy array
+        """
+        if isinstance(step, int):
+            step = (step, step)
+        xstep, ystep = step
+        if window is None:
+            window = (0, 0, self.width, self.height)
+        xoff, yoff, xsize, ysize = window
+        if (xoff < 0 or yoff < 0 or xsize <= 0 or ysize <= 0 or
+                xoff + xsize > self.width or yoff + ysize > self.height):
+            raise ValueError("Window {} is outside of {}".format(window, self.name))
+
+        bw, bh = self.block_size
+        out = None
+        for by, r0, r1 in sampled_blocks(yoff, ysize, ystep, bh):
+            for bx, c0, c1 in sampled_blocks(xoff, xsize, xstep, bw):
+                block = self.reader._block(self, bx, by)
+                if out is None:
+                    out = numpy.empty(((ysize + ystep - 1) // ystep,
+                                       (xsize + xstep - 1) // xstep), dtype=block.dtype)
+
+                # pixel offsets of the first and last sample within the block
+                y0 = yoff + r0 * ystep - by * bh
+                y1 = yoff + (r1 - 1) * ystep - by * bh
+                x0 = xoff + c0 * xstep - bx * bw
+                x1 = xoff + (c1 - 1) * xstep - bx * bw
+                out[r0:r1, c0:c1] = block[y0:y1 + 1:ystep, x0:x1 + 1:xstep]
+        return out
+
+    def read(self, window=None, step=1, masked=False):
+        """
+        Reads a window of the band as scaled values
+
+        :param window: (xoff, yoff, xsize, ysize), the whole band by default
+        :param step: Take every step-th pixel, an int or (xstep, ystep)
+        :param masked: Return a masked array instead of NaN for fill values
+        :return: Float32 NumPy array
+        """
+        raw = self.read_raw(window, step)
+
+        fill = raw == self.fill_value
+        data = raw.astype(numpy.float32) * numpy.float32(self.scale)
+        if masked:
+            return numpy.ma.masked_array(data, mask=fill)
+        data[fill] = numpy.nan
+        return data
+
+    def close(self):
+        self.gdal_band = None
+        self.dataset = None
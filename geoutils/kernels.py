@@ -0,0 +1,115 @@
+"""
+Nodata aware 2x2 reduction kernels for building pyramid levels.
+
+Every kernel takes a 2D array and returns an array of half its size
+(rounded up) where each pixel is computed from the valid pixels of one
+2x2 block only, so nodata never blends into valid pixels. Blocks without
+any valid pixel become nodata; without a nodata value they become NaN for
+float data and 0 for integer data.
+"""
+import numpy
+
+METHODS = ("mean", "mode", "min", "max")
+
+
+def _blocks(data, nodata):
+    """
+    returns data as an (h/2, w/2, 4) array of 2x2 blocks and the matching
+    validity mask, odd sizes are padded with invalid pixels
+    """
+    valid = numpy.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    if data.dtype.kind == "f":
+        valid &= ~numpy.isnan(data)
+
+    h, w = data.shape
+    ph, pw = h + h % 2, w + w % 2
+    if (ph, pw) != (h, w):
+        padded = numpy.zeros((ph, pw), dtype=data.dtype)
+        padded[:h, :w] = data
+        data = padded
+        paddedValid = numpy.zeros((ph, pw), dtype=bool)
+        paddedValid[:h, :w] = valid
+        valid = paddedValid
+
+    def split(array):
+        return array.reshape(ph // 2, 2, pw // 2, 2).transpose(0, 2, 1, 3).reshape(ph // 2, pw // 2, 4)
+
+    return split(data), split(valid)
+
+
+def _finish(result, count, dtype, nodata):
+    """ casts result to dtype and sets the blocks without valid pixels to nodata """
+    if numpy.dtype(dtype).kind in "iu":
+        result = numpy.round(result)
+    result = result.astype(dtype)
+    if nodata is None:
+        nodata = numpy.nan if numpy.dtype(dtype).kind == "f" else 0
+    result[count == 0] = nodata
+    return result
+
+
+def _sentinel(dtype, largest):
+    if numpy.dtype(dtype).kind == "f":
+        return numpy.inf if largest else -numpy.inf
+    info = numpy.iinfo(dtype)
+    return info.max if largest else info.min
+
+
+def mean(data, nodata=None):
+    blocks, valid = _blocks(data, nodata)
+    count = valid.sum(axis=-1)
+    total = numpy.where(valid, blocks, 0).sum(axis=-1, dtype=numpy.float64)
+    return _finish(total / numpy.maximum(count, 1), count, data.dtype, nodata)
+
+
+def minimum(data, nodata=None):
+    blocks, valid = _blocks(data, nodata)
+    result = numpy.where(valid, blocks, _sentinel(data.dtype, True)).min(axis=-1)
+    return _finish(result, valid.sum(axis=-1), data.dtype, nodata)
+
+
+def maximum(data, nodata=None):
+    blocks, valid = _blocks(data, nodata)
+    result = numpy.where(valid, blocks, _sentinel(data.dtype, False)).max(axis=-1)
+    return _finish(result, valid.sum(axis=-1), data.dtype, nodata)
+
+
+def mode(data, nodata=None):
+    """ the most frequent valid value of every block, the smallest one on ties """
+    blocks, valid = _blocks(data, nodata)
+    order = numpy.argsort(numpy.where(valid, blocks, _sentinel(data.dtype, True)), axis=-1)
+    blocks = _take(blocks, order)
+    valid = _take(valid, order)
+
+    # count how often the value of every position occurs in its block
+    counts = numpy.zeros(valid.shape, dtype=numpy.int8)
+    for j in range(4):
+        counts += (blocks == blocks[..., j:j + 1]) & valid[..., j:j + 1]
+    counts[~valid] = -1
+
+    best = counts.argmax(axis=-1)[..., numpy.newaxis]
+    result = _take(blocks, best)[..., 0]
+    return _finish(result, valid.sum(axis=-1), data.dtype, nodata)
+
+
+def _take(array, indices):
+    """ picks indices along the last axis, like numpy.take_along_axis """
+    rows, cols = numpy.indices(array.shape[:2])
+    return array[rows[..., numpy.newaxis], cols[..., numpy.newaxis], indices]
+
+
+KERNELS = {"mean": mean, "mode": mode, "min": minimum, "max": maximum}
+
+
+def downsample(data, method, nodata=None):
+    """
+    Halves data with the kernel method
+
+    :param data: 2D NumPy array
+    :param method: One of METHODS
+    :param nodata: Value of the pixels to ignore
+    :return: NumPy array of (ceil(h/2), ceil(w/2)) with the dtype of data
+    """
+    return KERNELS[method](data, nodata)
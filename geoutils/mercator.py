@@ -0,0 +1,57 @@
+"""
+Tile arithmetic for the spherical mercator (EPSG:3857) XYZ/TMS tile scheme.
+
+The XYZ scheme is the same grid as the GoogleMapsCompatible WMTS tile matrix
+set: zoom level z has 2**z x 2**z tiles numbered from the top left corner.
+TMS numbers the rows from the bottom instead.
+"""
+import math
+
+ORIGIN = 20037508.342789244
+TILE_SIZE = 256
+
+
+def resolution(zoom, tileSize=TILE_SIZE):
+    """ returns the size of a pixel in meters at zoom """
+    return 2 * ORIGIN / (tileSize * 2 ** zoom)
+
+
+def zoomForResolution(res, tileSize=TILE_SIZE):
+    """ returns the first zoom level at least as fine as res meters per pixel """
+    return max(0, int(math.ceil(math.log(2 * ORIGIN / (tileSize * res), 2) - 1e-9)))
+
+
+def tileBounds(zoom, x, y):
+    """ returns (minx, miny, maxx, maxy) in meters of XYZ tile x/y at zoom """
+    size = 2 * ORIGIN / 2 ** zoom
+    minx = -ORIGIN + x * size
+    maxy = ORIGIN - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+
+def tileRange(zoom, minx, miny, maxx, maxy):
+    """
+    returns the (xmin, ymin, xmax, ymax) XYZ tile numbers covering the
+    given bounds in meters at zoom, inclusive
+    """
+    count = 2 ** zoom
+    size = 2 * ORIGIN / count
+
+    def clamp(value):
+        return min(count - 1, max(0, value))
+
+    xmin = clamp(int(math.floor((minx + ORIGIN) / size)))
+    xmax = clamp(int(math.ceil((maxx + ORIGIN) / size)) - 1)
+    ymin = clamp(int(math.floor((ORIGIN - maxy) / size)))
+    ymax = clamp(int(math.ceil((ORIGIN - miny) / size)) - 1)
+    return (xmin, ymin, xmax, ymax)
+
+
+def flipY(zoom, y):
+    """ converts between XYZ and TMS row numbers """
+    return 2 ** zoom - 1 - y
+
+
+def children(x, y):
+    """ returns the four tiles of the next zoom level covering tile x/y """
+    return [(2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)]
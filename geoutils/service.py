@@ -0,0 +1,326 @@
+"""
+Long running hdf2tiff conversion service.
+
+Jobs are HDF files dropped into a spool directory or sent as lines to a
+local Unix socket. They are converted by a pool of worker processes which
+stay alive between jobs, so interpreter startup and GDAL driver
+registration are only paid once per worker. Completion events are written
+as JSON lines to the event log (and back to the socket client that
+submitted the job).
+"""
+import errno
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import traceback
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+import click
+import bandmath
+from utils import IntCSVParamType, LazyModule
+
+hdf2tiff = LazyModule("hdf2tiff")
+
+
+def init_worker():
+    """ Loads GDAL once when a worker process starts """
+    hdf2tiff.gdal.VersionInfo()
+
+
+def convert(job):
+    """
+    Converts one HDF file in a worker process
+
+    :param job: (hdf_file, kwargs) as passed to process_file
+    :return: Completion event, also for failed conversions so that the
+             service always gets its worker slot back
+    """
+    hdf_file, kwargs = job
+    start = time.time()
+    event = {"hdf": hdf_file}
+    try:
+        event["tiff"] = hdf2tiff.process_file((hdf_file, dict(kwargs)))
+        event["event"] = "done"
+    except (Exception, SystemExit) as e:
+        event["event"] = "failed"
+        event["error"] = "{}: {}".format(type(e).__name__, e)
+        event["traceback"] = traceback.format_exc()
+    event["seconds"] = round(time.time() - start, 3)
+    return event
+
+
+class ConversionService(object):
+    """
+    A class feeding conversion jobs to a warm pool of worker processes
+
+    At most queue_size jobs wait in the queue; submit() blocks (or raises
+    queue.Full) while it is full, which pushes back on the spool watcher
+    and the socket clients.
+    """
+
+    def __init__(self, kwargs, workers=None, queue_size=64, event_log=None):
+        self.kwargs = kwargs
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.workers, initializer=init_worker)
+        self.jobs = queue.Queue(queue_size)
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.event_log = event_log
+        self.log_lock = threading.Lock()
+
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, hdf_file, callback=None, block=True, timeout=None):
+        """ Queues hdf_file; callback is called with its completion event """
+        self.jobs.put((hdf_file, callback), block, timeout)
+        self.emit({"event": "queued", "hdf": hdf_file})
+
+    def _dispatch(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            hdf_file, callback = item
+
+            # Keep jobs in the bounded queue until a worker is free
+            self.slots.acquire()
+
+            def finished(event, callback=callback):
+                self.slots.release()
+                self.emit(event)
+                if callback is not None:
+                    callback(event)
+
+            job = (hdf_file, self.kwargs)
+            try:
+                # convert() reports its own errors, but a job the pool can
+                # not send to a worker would never call back
+                pickle.dumps(job, pickle.HIGHEST_PROTOCOL)
+                self.pool.apply_async(convert, (job,), callback=finished)
+            except Exception as e:
+                finished({"event": "failed", "hdf": hdf_file,
+                          "error": "{}: {}".format(type(e).__name__, e)})
+
+    def emit(self, event):
+        line = json.dumps(event, sort_keys=True)
+        with self.log_lock:
+            click.echo(line)
+            if self.event_log is not None:
+                with open(self.event_log, "a") as log:
+                    log.write(line + "\n")
+
+    def close(self):
+        self.jobs.put(None)
+        self.dispatcher.join()
+        self.pool.close()
+        self.pool.join()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def claim_spool_files(spool_dir, sizes):
+    """
+    Moves the HDF files of spool_dir whose size and modification time did
+    not change since the previous scan to processing/, so that files which
+    are still being copied into the spool are left alone
+
+    :param spool_dir: Spool directory
+    :param sizes: (size, mtime) of the files seen by the previous scan,
+                  updated in place
+    :return: Paths of the claimed files
+    """
+    processing = os.path.join(spool_dir, "processing")
+    claimed = []
+    seen = {}
+    for name in sorted(os.listdir(spool_dir)):
+        if not name.lower().endswith(".hdf"):
+            continue
+        try:
+            stat = os.stat(os.path.join(spool_dir, name))
+        except OSError:
+            continue
+        seen[name] = (stat.st_size, stat.st_mtime)
+        if sizes.get(name) != seen[name]:
+            continue
+        try:
+            os.rename(os.path.join(spool_dir, name), os.path.join(processing, name))
+        except OSError:
+            # Claimed by another watcher or removed in the meantime
+            continue
+        del seen[name]
+        claimed.append(os.path.join(processing, name))
+    sizes.clear()
+    sizes.update(seen)
+    return claimed
+
+
+def watch_spool(service, spool_dir, poll_interval=1.0):
+    """
+    Claims HDF files dropped into spool_dir once their size is stable over
+    two polls and submits them to service. Claimed files are moved to
+    processing/ and then to done/ or failed/.
+    """
+    for name in ("processing", "done", "failed"):
+        makedirs(os.path.join(spool_dir, name))
+
+    def finished(event):
+        target = os.path.join(spool_dir, event["event"],
+                              os.path.basename(event["hdf"]))
+        shutil.move(event["hdf"], target)
+
+    sizes = {}
+    while True:
+        for claimed in claim_spool_files(spool_dir, sizes):
+            service.submit(claimed, callback=finished)
+        time.sleep(poll_interval)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one HDF path per line and streams the completion events back as
+    JSON lines; the connection is closed once all its jobs have finished
+    """
+
+    def handle(self):
+        lock = threading.Lock()
+        pending = [0]
+        idle = threading.Event()
+        idle.set()
+
+        def send(event):
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(event, sort_keys=True) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                except (IOError, OSError):
+                    pass
+
+        def finished(event):
+            send(event)
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    idle.set()
+
+        for line in self.rfile:
+            hdf_file = line.decode("utf-8").strip()
+            if not hdf_file:
+                continue
+            if not os.path.exists(hdf_file):
+                send({"event": "failed", "hdf": hdf_file,
+                      "error": "No such file"})
+                continue
+            with lock:
+                pending[0] += 1
+                idle.clear()
+            self.server.service.submit(os.path.abspath(hdf_file), callback=finished)
+
+        idle.wait()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+        self.service = service
+
+
+@click.command()
+@click.argument('spool_dir', type=click.Path(file_okay=False, writable=True))
+@click.option('-o', '--output', default=None,
+              type=click.Path(file_okay=False, writable=True),
+              help="Output directory (default: SPOOL_DIR/output)")
+@click.option('-b', '--bands', default=None, type=IntCSVParamType(),
+              help="Only include specified bands (formated as csv)")
+@click.option('-e', '--expression', 'expressions', multiple=True,
+              help="Band math expression added as a band (can be repeated)")
+@click.option('-w', '--warpMemoryLimit', default=4096,
+              help="Memory limit for Warp operation")
+@click.option('--chunk-size', default=0,
+              help="Warp the output in chunks of this many pixels")
+@click.option('--chunk-threads', default=1,
+              help="Number of chunks warped in parallel")
+@click.option('-j', '--jobs', default=0,
+              help="Number of worker processes (default: number of CPUs)")
+@click.option('--queue-size', default=64,
+              help="Number of jobs waiting before submitters are blocked")
+@click.option('--socket', 'socket_path', default=None,
+              type=click.Path(dir_okay=False),
+              help="Also accept jobs on this Unix socket")
+@click.option('--poll-interval', default=1.0,
+              help="Seconds between scans of the spool directory")
+@click.option('--clobber/--no-clobber', default=False, help="Overwrite the created tiff")
+@click.option('--reproject/--no-reproject', default=True, help="Reproject the tiff")
+def main(spool_dir, output, bands, expressions, warpmemorylimit, chunk_size,
+         chunk_threads, jobs, queue_size, socket_path, poll_interval, clobber,
+         reproject):
+    """ Converts HDF files dropped into SPOOL_DIR until interrupted """
+    for expression in expressions:
+        try:
+            bandmath.band_numbers(expression)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--expression")
+
+    makedirs(spool_dir)
+    output = output or os.path.join(spool_dir, "output")
+
+    kwargs = dict(output_dir=output,
+                  bands=bands,
+                  expressions=list(expressions),
+                  warpMemoryLimit=warpmemorylimit,
+                  chunk_size=chunk_size,
+                  chunk_threads=chunk_threads,
+                  clobber=clobber,
+                  reproject=reproject)
+
+    service = ConversionService(kwargs, workers=jobs or None,
+                                queue_size=queue_size,
+                                event_log=os.path.join(spool_dir, "events.log"))
+
+    server = None
+    if socket_path is not None:
+        server = JobServer(socket_path, service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        watch_spool(service, spool_dir, poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+        service.close()
+
+if __name__ == "__main__":
+    main()
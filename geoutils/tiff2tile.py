@@ -1,4 +1,3 @@
-import gdal
 import gdal_retile
 
 def tiff2tile(tiff_file, output_dir):
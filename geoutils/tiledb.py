@@ -0,0 +1,264 @@
+"""
+Writes tile pyramids into a single SQLite tile store (MBTiles or GeoPackage).
+
+All inserts go through one writer thread that owns the database connection.
+Producers hand encoded tiles to it through a bounded queue and the writer
+inserts them in large transactions with a single prepared statement.
+
+MBTiles files may be deduplicated: tile payloads are then stored once per
+SHA-1 in an images table, referenced from a map table, and the tiles table
+is a view joining the two.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MBTILES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)",
+    "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+    "tile_row INTEGER, tile_data BLOB)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles "
+    "(zoom_level, tile_column, tile_row)",
+]
+
+MBTILES_DEDUPE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)",
+    "CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, "
+    "tile_row INTEGER, tile_id TEXT)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map "
+    "(zoom_level, tile_column, tile_row)",
+    "CREATE TABLE IF NOT EXISTS images (tile_id TEXT, tile_data BLOB)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)",
+    "CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, "
+    "map.tile_column AS tile_column, map.tile_row AS tile_row, "
+    "images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id",
+]
+
+GPKG_SCHEMA = [
+    "PRAGMA application_id = 1196444487",
+    "PRAGMA user_version = 10200",
+    "CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, "
+    "srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL, "
+    "organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, "
+    "description TEXT)",
+    "INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES "
+    "('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', NULL)",
+    "INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES "
+    "('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', NULL)",
+    "CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, "
+    "data_type TEXT NOT NULL, identifier TEXT UNIQUE, description TEXT DEFAULT '', "
+    "last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "
+    "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER)",
+    "CREATE TABLE IF NOT EXISTS gpkg_tile_matrix_set (table_name TEXT NOT NULL PRIMARY KEY, "
+    "srs_id INTEGER NOT NULL, min_x DOUBLE NOT NULL, min_y DOUBLE NOT NULL, "
+    "max_x DOUBLE NOT NULL, max_y DOUBLE NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS gpkg_tile_matrix (table_name TEXT NOT NULL, "
+    "zoom_level INTEGER NOT NULL, matrix_width INTEGER NOT NULL, "
+    "matrix_height INTEGER NOT NULL, tile_width INTEGER NOT NULL, "
+    "tile_height INTEGER NOT NULL, pixel_x_size DOUBLE NOT NULL, "
+    "pixel_y_size DOUBLE NOT NULL, PRIMARY KEY (table_name, zoom_level))",
+    "CREATE TABLE IF NOT EXISTS tiles (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+    "tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL, "
+    "UNIQUE (zoom_level, tile_column, tile_row))",
+]
+
+INSERT_TILE = ("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+               "VALUES (?, ?, ?, ?)")
+INSERT_MAP = ("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) "
+              "VALUES (?, ?, ?, ?)")
+INSERT_IMAGE = "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)"
+SELECT_DEDUPE_STATS = ("SELECT COUNT(*), COUNT(DISTINCT images.tile_id), "
+                       "SUM(LENGTH(images.tile_data)) FROM map JOIN images "
+                       "ON images.tile_id = map.tile_id")
+SELECT_TILE = ("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? "
+               "AND tile_row = ?")
+
+
+class SQLiteTileWriter(object):
+    """
+    A class writing encoded tiles into an MBTiles or GeoPackage file
+
+    put() may be called from any number of producer threads; it blocks when
+    queueSize tiles are waiting, which bounds the memory held by the queue.
+    Tile rows are given with the origin at the top, MBTiles rows are flipped
+    to the TMS convention on insert.
+
+    With dedupe, identical payloads of an MBTiles file are stored once.
+    """
+
+    def __init__(self, fileName, batchSize=10000, queueSize=1024, tableName="tiles",
+                 dedupe=False):
+        self.fileName = fileName
+        self.batchSize = batchSize
+        self.tableName = tableName
+        if os.path.splitext(fileName)[1].lower() == ".gpkg":
+            self.flavor = "gpkg"
+        else:
+            self.flavor = "mbtiles"
+        if dedupe and self.flavor != "mbtiles":
+            raise ValueError("Only MBTiles files can be deduplicated")
+        self.dedupe = dedupe
+        self.matrixHeights = {}
+        self.error = None
+        self.reader = None
+
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+        self.queue = queue.Queue(queueSize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        connection = None
+        try:
+            connection = sqlite3.connect(self.fileName)
+            connection.isolation_level = None
+            cursor = connection.cursor()
+            cursor.execute("PRAGMA synchronous = OFF")
+            cursor.execute("PRAGMA journal_mode = MEMORY")
+            if self.flavor == "gpkg":
+                schema = GPKG_SCHEMA
+            elif self.dedupe:
+                schema = MBTILES_DEDUPE_SCHEMA
+            else:
+                schema = MBTILES_SCHEMA
+            for statement in schema:
+                cursor.execute(statement)
+        except sqlite3.Error as e:
+            # the queue is still drained, so that producers never block
+            self.error = e
+
+        batch = []
+        while True:
+            item = self.queue.get()
+            if item[0] == "tile":
+                batch.append(item[1:])
+                if len(batch) < self.batchSize:
+                    continue
+
+            if self.error is None and len(batch) > 0:
+                try:
+                    cursor.execute("BEGIN")
+                    if self.dedupe:
+                        cursor.executemany(INSERT_IMAGE, [tile[3:] for tile in batch])
+                        cursor.executemany(INSERT_MAP, [tile[:4] for tile in batch])
+                    else:
+                        cursor.executemany(INSERT_TILE, batch)
+                    cursor.execute("COMMIT")
+                except sqlite3.Error as e:
+                    self.error = e
+            batch = []
+
+            if item[0] == "execute" and self.error is None:
+                try:
+                    cursor.execute(item[1], item[2])
+                except sqlite3.Error as e:
+                    self.error = e
+            elif item[0] == "flush":
+                item[1].set()
+            elif item[0] == "close":
+                if connection is not None:
+                    connection.close()
+                return
+
+    def _send(self, item):
+        if self.error is not None:
+            raise self.error
+        if not self.thread.is_alive():
+            raise RuntimeError("The writer of %s has stopped" % self.fileName)
+        self.queue.put(item)
+
+    def execute(self, statement, parameters=()):
+        self._send(("execute", statement, parameters))
+
+    def setSpatialRefSys(self, srsId, srsName, organization, organizationId, definition):
+        """ registers the spatial reference system of a GeoPackage """
+        if self.flavor == "gpkg":
+            self.execute("INSERT OR REPLACE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, NULL)",
+                         (srsName, srsId, organization, organizationId, definition))
+
+    def setTileMatrixSet(self, srsId, minx, miny, maxx, maxy):
+        if self.flavor == "gpkg":
+            self.execute("INSERT OR REPLACE INTO gpkg_contents (table_name, data_type, identifier, "
+                         "min_x, min_y, max_x, max_y, srs_id) VALUES (?, 'tiles', ?, ?, ?, ?, ?, ?)",
+                         (self.tableName, self.tableName, minx, miny, maxx, maxy, srsId))
+            self.execute("INSERT OR REPLACE INTO gpkg_tile_matrix_set VALUES (?, ?, ?, ?, ?, ?)",
+                         (self.tableName, srsId, minx, miny, maxx, maxy))
+
+    def addTileMatrix(self, zoom, matrixWidth, matrixHeight, tileWidth, tileHeight,
+                      pixelXSize, pixelYSize):
+        self.matrixHeights[zoom] = matrixHeight
+        if self.flavor == "gpkg":
+            self.execute("INSERT OR REPLACE INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (self.tableName, zoom, matrixWidth, matrixHeight, tileWidth, tileHeight,
+                          pixelXSize, pixelYSize))
+
+    def setMetadata(self, metadata):
+        if self.flavor == "mbtiles":
+            for name, value in sorted(metadata.items()):
+                self.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                             (name, str(value)))
+
+    def _row(self, zoom, row):
+        if self.flavor == "mbtiles":
+            return self.matrixHeights[zoom] - 1 - row
+        return row
+
+    def put(self, zoom, col, row, data):
+        """ queues the encoded tile col/row of zoom level zoom """
+        if self.dedupe:
+            # hashed by the producers, the writer thread only inserts
+            self._send(("tile", zoom, col, self._row(zoom, row),
+                        hashlib.sha1(data).hexdigest(), sqlite3.Binary(data)))
+        else:
+            self._send(("tile", zoom, col, self._row(zoom, row), sqlite3.Binary(data)))
+
+    def flush(self):
+        """ waits until every queued tile is committed """
+        done = threading.Event()
+        self._send(("flush", done))
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def getDedupeStats(self):
+        """
+        returns the number of tiles, of unique payloads, the bytes of all
+        tiles and the bytes stored, once every queued tile is committed
+        """
+        self.flush()
+        connection = sqlite3.connect(self.fileName)
+        tiles, unique, size = connection.execute(SELECT_DEDUPE_STATS).fetchone()
+        stored = connection.execute("SELECT SUM(LENGTH(tile_data)) FROM images").fetchone()[0]
+        connection.close()
+        return tiles, unique, size or 0, stored or 0
+
+    def read(self, zoom, col, row):
+        """ returns the encoded tile col/row of zoom level zoom or None """
+        if self.reader is None:
+            self.reader = sqlite3.connect(self.fileName)
+        result = self.reader.execute(SELECT_TILE, (zoom, col, self._row(zoom, row))).fetchone()
+        if result is None:
+            return None
+        return bytes(result[0])
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.thread.is_alive():
+            self.queue.put(("close",))
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
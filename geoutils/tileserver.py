@@ -0,0 +1,387 @@
+"""
+Renders the tiles of a mosaic on request and serves them over HTTP.
+
+Tiles are cut from the source mosaic with the mosaic_info machinery of
+gdal_retile, using its tile grid and pyramid levels (level 0 at the full
+resolution, every level halving the one below), so nothing has to be
+rendered ahead of time. Rendered tiles are kept in a bounded in-memory LRU
+cache and optionally in a cache directory, and concurrent requests for a
+tile that is being rendered wait for that render instead of repeating it.
+
+    python geoutils/tileserver.py -port 8080 -levels 6 -cacheDir cache/ *.tiff
+
+GET /<level>/<col>/<row> returns a tile (columns and rows counted from 0
+at the top left), 204 for a tile without data and 404 outside the grid.
+GET /info returns the tile grid and GET /stats the cache counters.
+"""
+import argparse
+import collections
+import errno
+import json
+import os
+import re
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import gdal_retile
+from gdal_retile import gdal, ogr
+
+TILE_PATH = re.compile(r"^/([0-9]+)/([0-9]+)/([0-9]+)(\.[A-Za-z0-9]+)?$")
+
+RESAMPLING = {"near": "GRA_NearestNeighbour", "bilinear": "GRA_Bilinear",
+              "cubic": "GRA_Cubic", "average": "GRA_Average", "mode": "GRA_Mode"}
+
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp",
+                 "GTiff": "image/tiff"}
+
+
+class LRUCache:
+    """ A thread safe cache of encoded tiles holding at most maxBytes """
+    def __init__(self, maxBytes):
+        self.maxBytes=maxBytes
+        self.size=0
+        self.items=collections.OrderedDict()
+        self.lock=threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data=self.items.pop(key, None)
+            if data is not None:
+                self.items[key]=data
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.maxBytes:
+            return
+        with self.lock:
+            old=self.items.pop(key, None)
+            if old is not None:
+                self.size-=len(old)
+            self.items[key]=data
+            self.size+=len(data)
+            while self.size > self.maxBytes:
+                _, evicted=self.items.popitem(last=False)
+                self.size-=len(evicted)
+
+
+class TileRenderer:
+    """
+    Renders the tiles of the mosaic; every renderer has its own tile index
+    and dataset handles since GDAL handles must not be shared by threads
+    """
+    def __init__(self, tileIndexDS, names, tileWidth, tileHeight, resampling):
+        self.tileIndexDS=tileIndexDS
+        self.minfo=gdal_retile.mosaic_info(names[0], tileIndexDS)
+        self.memDriver=gdal.GetDriverByName("MEM")
+        self.tileWidth=tileWidth
+        self.tileHeight=tileHeight
+        self.resampling=resampling
+
+    def render(self, level, col, row, width, height):
+        """ returns tile col/row of level as a MEM dataset, None without data """
+        minfo=self.minfo
+        factor=2**level
+        sx=minfo.scaleX*factor
+        sy=minfo.scaleY*factor
+        minx=minfo.ulx+col*self.tileWidth*sx
+        maxy=minfo.uly+row*self.tileHeight*sy
+        maxx=minx+width*sx
+        miny=maxy+height*sy
+
+        # pyramid tiles are reduced from the source overviews at twice
+        # their resolution instead of from the full resolution
+        s_fh=minfo.getDataSet(minx, miny, maxx, maxy, max(1, factor//2))
+        if s_fh is None:
+            return None
+
+        t_fh=self.memDriver.Create("", width, height, minfo.bands, minfo.band_type)
+        t_fh.SetGeoTransform([minx, sx, 0, maxy, 0, sy])
+        t_fh.SetProjection(minfo.projection)
+        if level == 0:
+            gdal_retile.fillTile(minfo, s_fh, t_fh)
+        else:
+            for band in range(1, minfo.bands+1):
+                if minfo.nodata[band-1] is not None:
+                    t_fh.GetRasterBand(band).SetNoDataValue(minfo.nodata[band-1])
+                    t_fh.GetRasterBand(band).Fill(minfo.nodata[band-1])
+            gdal.ReprojectImage(s_fh, t_fh, None, None, self.resampling)
+        minfo.closeDataSet(s_fh)
+        return t_fh
+
+
+class TileCache:
+    """
+    A class returning encoded tiles from the memory cache, the cache
+    directory or a renderer, in that order
+
+    Concurrent requests for the same missing tile are coalesced: the
+    first one renders it and the others wait for its result.
+    """
+    def __init__(self, grids, renderers, memoryBytes, cacheDir=None, extension="tif"):
+        self.grids=grids
+        self.renderers=queue.Queue()
+        for renderer in renderers:
+            self.renderers.put(renderer)
+        self.memory=LRUCache(memoryBytes)
+        self.cacheDir=cacheDir
+        self.extension=extension
+        self.lock=threading.Lock()
+        self.pending={}
+        self.stats=collections.Counter()
+
+    def shape(self, level, col, row):
+        """ returns the (width, height) of a tile, None outside the grid """
+        if level >= len(self.grids):
+            return None
+        ti=self.grids[level]
+        if col >= ti.countTilesX or row >= ti.countTilesY:
+            return None
+        width=ti.lastTileWidth if col == ti.countTilesX-1 else ti.tileWidth
+        height=ti.lastTileHeight if row == ti.countTilesY-1 else ti.tileHeight
+        return (width, height)
+
+    def cachePath(self, level, col, row):
+        return os.path.join(self.cacheDir, str(level), str(col), "%d.%s" % (row, self.extension))
+
+    def get(self, level, col, row):
+        """
+        returns (encoded tile, where it came from), an empty string for a
+        tile without data
+        """
+        key=(level, col, row)
+        data=self.memory.get(key)
+        if data is not None:
+            return self.count(data, "memory")
+
+        with self.lock:
+            event=self.pending.get(key)
+            owner=event is None
+            if owner:
+                event=self.pending[key]=[threading.Event(), None]
+        if not owner:
+            event[0].wait()
+            if event[1] is None:
+                raise RuntimeError("Rendering tile %d/%d/%d failed" % key)
+            return self.count(event[1], "coalesced")
+
+        source="disk"
+        try:
+            data=self.readCache(key)
+            if data is None:
+                source="render"
+                data=self.render(key)
+                self.writeCache(key, data)
+            self.memory.put(key, data)
+            event[1]=data
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event[0].set()
+        return self.count(data, source)
+
+    def count(self, data, source):
+        with self.lock:
+            self.stats[source]+=1
+        return data, source
+
+    def render(self, key):
+        level, col, row=key
+        width, height=self.shape(level, col, row)
+        renderer=self.renderers.get()
+        try:
+            ds=renderer.render(level, col, row, width, height)
+            if ds is None:
+                return b""
+            return gdal_retile.encodeTile(ds, "tileserver/%d/%d/%d" % key)
+        finally:
+            self.renderers.put(renderer)
+
+    def readCache(self, key):
+        if self.cacheDir is None:
+            return None
+        try:
+            fh=open(self.cachePath(*key), "rb")
+        except IOError:
+            return None
+        data=fh.read()
+        fh.close()
+        return data
+
+    def writeCache(self, key, data):
+        """ writes a tile to the cache directory, renamed into place once complete """
+        if self.cacheDir is None:
+            return
+        path=self.cachePath(*key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temp="%s.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+        fh=open(temp, "wb")
+        fh.write(data)
+        fh.close()
+        os.rename(temp, path)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """ Serves /<level>/<col>/<row>, /info and /stats """
+
+    def do_GET(self):
+        tiles=self.server.tiles
+        if self.path == "/info":
+            return self.sendJSON(self.server.info)
+        if self.path == "/stats":
+            with tiles.lock:
+                stats=dict(tiles.stats)
+            stats["memoryBytes"]=tiles.memory.size
+            stats["memoryTiles"]=len(tiles.memory.items)
+            return self.sendJSON(stats)
+
+        match=TILE_PATH.match(self.path)
+        if match is None:
+            return self.send_error(404)
+        level, col, row=[int(v) for v in match.groups()[:3]]
+        if tiles.shape(level, col, row) is None:
+            return self.send_error(404, "Tile outside of the grid")
+
+        try:
+            data, source=tiles.get(level, col, row)
+        except Exception as e:
+            return self.send_error(500, str(e))
+        if len(data) == 0:
+            self.send_response(204)
+            self.send_header("X-Tile-Source", source)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", self.server.contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Tile-Source", source)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendJSON(self, value):
+        data=json.dumps(value, sort_keys=True).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if gdal_retile.Verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TileServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads=True
+
+    def __init__(self, address, tiles, info, contentType):
+        HTTPServer.__init__(self, address, TileRequestHandler)
+        self.tiles=tiles
+        self.info=info
+        self.contentType=contentType
+
+
+def createTileCache(names, tileWidth, tileHeight, levels, renderers, resampling,
+                    memoryBytes, cacheDir=None):
+    """
+    builds the tile index of the mosaic and returns a TileCache with
+    renderers renderers and the grid description served as /info
+    """
+    tileIndexDS=gdal_retile.getTileIndexFromFiles(names, "Memory")
+    if tileIndexDS is None:
+        raise IOError("Error building tile index")
+    memDriver=ogr.GetDriverByName("Memory")
+    indexes=[tileIndexDS]+[memDriver.CopyDataSource(tileIndexDS, "TileIndex%d" % i)
+                           for i in range(1, renderers)]
+    tileRenderers=[TileRenderer(index, names, tileWidth, tileHeight, resampling)
+                   for index in indexes]
+
+    minfo=tileRenderers[0].minfo
+    grids=[]
+    xsize, ysize=minfo.xsize, minfo.ysize
+    for level in range(levels+1):
+        if xsize < 1 or ysize < 1:
+            break
+        grids.append(gdal_retile.tile_info(xsize, ysize, tileWidth, tileHeight))
+        xsize, ysize=xsize//2, ysize//2
+
+    extension=gdal_retile.Extension or "tif"
+    tiles=TileCache(grids, tileRenderers, memoryBytes, cacheDir, extension)
+    info=dict(tileWidth=tileWidth, tileHeight=tileHeight, bands=minfo.bands,
+              geotransform=[minfo.ulx, minfo.scaleX, 0, minfo.uly, 0, minfo.scaleY],
+              projection=minfo.projection,
+              levels=[dict(level=level, countTilesX=ti.countTilesX, countTilesY=ti.countTilesY)
+                      for level, ti in enumerate(grids)])
+    return tiles, info
+
+
+def main(args=None):
+    parser=argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="Source rasters of the mosaic")
+    parser.add_argument("-host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("-ps", nargs=2, type=int, default=[256, 256],
+                        metavar=("WIDTH", "HEIGHT"), help="Tile size")
+    parser.add_argument("-levels", type=int, default=0, help="Number of pyramid levels")
+    parser.add_argument("-of", default="GTiff", help="Tile format")
+    parser.add_argument("-co", action="append", default=[], help="Creation option")
+    parser.add_argument("-r", default="near", choices=sorted(RESAMPLING),
+                        help="Resampling of the pyramid levels")
+    parser.add_argument("-renderers", type=int, default=4,
+                        help="Number of tiles rendered at the same time")
+    parser.add_argument("-cacheMB", type=int, default=256,
+                        help="Size of the in-memory tile cache")
+    parser.add_argument("-cacheDir", default=None, help="Directory caching rendered tiles")
+    parser.add_argument("-footprints", default=None,
+                        help="Footprint catalog of the inputs, see gdal_retile")
+    parser.add_argument("-v", action="store_true", help="Log every request")
+    options=parser.parse_args(args)
+
+    driver=gdal.GetDriverByName(options.of)
+    if driver is None:
+        print("Format driver %s not found" % options.of)
+        return 1
+
+    # tiles are encoded by gdal_retile.encodeTile
+    gdal_retile.Driver=driver
+    gdal_retile.Extension=driver.GetMetadata().get(gdal.DMD_EXTENSION)
+    gdal_retile.CreateOptions=options.co
+    gdal_retile.FootprintCatalogName=options.footprints
+    gdal_retile.ResamplingMethod=getattr(gdal, RESAMPLING[options.r])
+    gdal_retile.Verbose=options.v
+
+    tiles, info=createTileCache(options.inputs, options.ps[0], options.ps[1], options.levels,
+                                options.renderers, getattr(gdal, RESAMPLING[options.r]),
+                                options.cacheMB*1024*1024, options.cacheDir)
+    server=TileServer((options.host, options.port), tiles, info,
+                      CONTENT_TYPES.get(driver.ShortName, "application/octet-stream"))
+    print("Serving %d level(s) of %s on http://%s:%d/" % (len(tiles.grids), options.inputs[0],
+                                                         options.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
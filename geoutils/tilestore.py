@@ -0,0 +1,195 @@
+"""
+Memory-mapped container holding every tile of a pyramid level in one file.
+
+Layout of a tile store file:
+
+    header     magic, version and the length of the JSON metadata
+    metadata   JSON: tile grid, band count, dtype, geotransform, projection
+    bitmap     one bit per tile (row major), set when the tile holds data
+    offsets    int64 byte offset of every edge tile (row major)
+    data       fixed-size slots for the full tiles (row major), followed by
+               the smaller edge tiles of the last column and row
+
+Tiles are stored band sequential as C ordered (bands, height, width) arrays
+so that a tile can be returned as a view of the mapped file.
+"""
+import json
+import struct
+
+import numpy
+
+MAGIC = b"GUTS"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+ALIGNMENT = 4096
+
+
+def _align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class TileLayout(object):
+    """ Computes where each tile of a level lives inside a tile store """
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.bands = meta["bands"]
+        self.dtype = numpy.dtype(meta["dtype"])
+        self.tileWidth = meta["tileWidth"]
+        self.tileHeight = meta["tileHeight"]
+        self.countTilesX = meta["countTilesX"]
+        self.countTilesY = meta["countTilesY"]
+        self.lastTileWidth = meta["lastTileWidth"]
+        self.lastTileHeight = meta["lastTileHeight"]
+
+        self.fullTilesX = self.countTilesX
+        if self.lastTileWidth != self.tileWidth:
+            self.fullTilesX -= 1
+        self.fullTilesY = self.countTilesY
+        if self.lastTileHeight != self.tileHeight:
+            self.fullTilesY -= 1
+
+        self.tileCount = self.countTilesX * self.countTilesY
+        self.slotSize = self.tileSize(self.tileWidth, self.tileHeight)
+        self.edgeTiles = [(col, row)
+                          for row in range(self.countTilesY)
+                          for col in range(self.countTilesX)
+                          if not self.isFull(col, row)]
+        self.edgeIndex = dict((tile, i) for i, tile in enumerate(self.edgeTiles))
+
+    def isFull(self, col, row):
+        return col < self.fullTilesX and row < self.fullTilesY
+
+    def shape(self, col, row):
+        if col < 0 or col >= self.countTilesX or row < 0 or row >= self.countTilesY:
+            raise IndexError("tile %d,%d is outside of the store" % (col, row))
+        width = self.lastTileWidth if col == self.countTilesX - 1 else self.tileWidth
+        height = self.lastTileHeight if row == self.countTilesY - 1 else self.tileHeight
+        return (self.bands, height, width)
+
+    def tileSize(self, width, height):
+        return self.bands * width * height * self.dtype.itemsize
+
+    def sections(self, metaLength):
+        """ returns the offsets of the bitmap, offset table and data """
+        bitmapOffset = HEADER.size + metaLength
+        tableOffset = _align(bitmapOffset + (self.tileCount + 7) // 8, 8)
+        dataOffset = _align(tableOffset + 8 * len(self.edgeTiles))
+        return bitmapOffset, tableOffset, dataOffset
+
+
+class TileStoreWriter(object):
+    """ A class writing the tiles of one level into a tile store """
+
+    def __init__(self, fileName, tileWidth, tileHeight, countTilesX, countTilesY,
+                 lastTileWidth, lastTileHeight, bands, dtype,
+                 geotransform=None, projection=""):
+        self.fileName = fileName
+        meta = dict(tileWidth=tileWidth, tileHeight=tileHeight,
+                    countTilesX=countTilesX, countTilesY=countTilesY,
+                    lastTileWidth=lastTileWidth, lastTileHeight=lastTileHeight,
+                    bands=bands, dtype=numpy.dtype(dtype).str,
+                    geotransform=list(geotransform or []), projection=projection)
+        self.layout = TileLayout(meta)
+        metaBytes = json.dumps(meta).encode("utf-8")
+
+        bitmapOffset, tableOffset, dataOffset = self.layout.sections(len(metaBytes))
+        edgeOffsets = []
+        offset = dataOffset + self.layout.fullTilesX * self.layout.fullTilesY * self.layout.slotSize
+        for col, row in self.layout.edgeTiles:
+            edgeOffsets.append(offset)
+            bands, height, width = self.layout.shape(col, row)
+            offset += self.layout.tileSize(width, height)
+
+        with open(fileName, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, len(metaBytes)))
+            fh.write(metaBytes)
+            fh.seek(tableOffset)
+            fh.write(numpy.array(edgeOffsets, dtype="<i8").tobytes())
+            fh.truncate(max(offset, dataOffset))
+
+        self.map = numpy.memmap(fileName, dtype=numpy.uint8, mode="r+")
+        self.bitmap = self.map[bitmapOffset:tableOffset]
+        self.edgeOffsets = edgeOffsets
+        self.dataOffset = dataOffset
+
+    def offset(self, col, row):
+        if self.layout.isFull(col, row):
+            slot = row * self.layout.fullTilesX + col
+            return self.dataOffset + slot * self.layout.slotSize
+        return self.edgeOffsets[self.layout.edgeIndex[(col, row)]]
+
+    def write(self, col, row, array):
+        """ Stores a (bands, height, width) array as tile col/row """
+        shape = self.layout.shape(col, row)
+        array = numpy.asarray(array, dtype=self.layout.dtype).reshape(shape)
+        target = numpy.ndarray(shape, dtype=self.layout.dtype,
+                               buffer=self.map, offset=self.offset(col, row))
+        target[...] = array
+
+        index = row * self.layout.countTilesX + col
+        self.bitmap[index // 8] |= 1 << (index % 8)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+            self.bitmap = None
+
+
+class TileStoreReader(object):
+    """ A class returning the tiles of a tile store as NumPy arrays """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.map = numpy.memmap(fileName, dtype=numpy.uint8, mode="r")
+
+        magic, version, metaLength = HEADER.unpack(self.map[:HEADER.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a tile store" % fileName)
+        self.meta = json.loads(
+            self.map[HEADER.size:HEADER.size + metaLength].tobytes().decode("utf-8"))
+        self.layout = TileLayout(self.meta)
+
+        bitmapOffset, tableOffset, dataOffset = self.layout.sections(metaLength)
+        self.bitmap = self.map[bitmapOffset:tableOffset]
+        self.edgeOffsets = numpy.ndarray((len(self.layout.edgeTiles),), dtype="<i8",
+                                         buffer=self.map, offset=tableOffset)
+        self.dataOffset = dataOffset
+
+    @property
+    def geotransform(self):
+        return self.meta["geotransform"]
+
+    @property
+    def projection(self):
+        return self.meta["projection"]
+
+    def isEmpty(self, col, row):
+        self.layout.shape(col, row)
+        index = row * self.layout.countTilesX + col
+        return not (self.bitmap[index // 8] >> (index % 8)) & 1
+
+    def tileGeoTransform(self, col, row):
+        """ returns the geotransform of tile col/row """
+        gt = self.geotransform
+        return [gt[0] + col * self.layout.tileWidth * gt[1], gt[1], 0,
+                gt[3] + row * self.layout.tileHeight * gt[5], 0, gt[5]]
+
+    def tile(self, col, row):
+        """
+        Returns tile col/row as a read-only (bands, height, width) view of
+        the mapped file, or None for an empty tile
+        """
+        if self.isEmpty(col, row):
+            return None
+        if self.layout.isFull(col, row):
+            slot = row * self.layout.fullTilesX + col
+            offset = self.dataOffset + slot * self.layout.slotSize
+        else:
+            offset = int(self.edgeOffsets[self.layout.edgeIndex[(col, row)]])
+        return numpy.ndarray(self.layout.shape(col, row), dtype=self.layout.dtype,
+                             buffer=self.map, offset=offset)
+
+    def close(self):
+        self.map = None
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import importlib as _importlib
 import warnings as _warnings
 import os as _os
 import click
@@ -90,6 +91,90 @@ class TemporaryDirectory(object):
             pass
 
 
+class LazyModule(object):
+    """A module which is only imported on first attribute access.
+
+    Command line tools use it for heavy dependencies such as GDAL so that
+    --help and usage errors return without loading them.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = _importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return "<LazyModule {!r}>".format(self._name)
+
+
+def keep_gdal_drivers(gdal, names):
+    """
+    Deregisters every GDAL driver whose short name is not in names.
+
+    The bindings register all drivers when they are imported, so this
+    cannot save the registration itself, but every gdal.Open() afterwards
+    only probes the remaining drivers.
+    """
+    for index in reversed(range(gdal.GetDriverCount())):
+        driver = gdal.GetDriver(index)
+        if driver.ShortName not in names:
+            driver.Deregister()
+
+
+_gdal = LazyModule("gdal")
+
+_MISSING = object()
+
+
+def find_metadata_item(metadata, keyword, default=_MISSING):
+    """
+    Returns the first metadata item whose key contains keyword
+
+    :param metadata: Metadata dictionary of a dataset
+    :param keyword: Keyword to look for (lower case)
+    :param default: Returned if there is no such item, which raises
+                    IndexError otherwise
+    :return: Metadata item
+    """
+
+    # Filter the metadata
+    filtered_meta = {k: v for k, v in metadata.items()
+                     if keyword in k.lower()}
+
+    if not filtered_meta and default is not _MISSING:
+        return default
+
+    # Hopefully there will be one element in the dictionary
+    return list(filtered_meta.values())[0]
+
+
+def get_metadata_item(subdataset, keyword, default=_MISSING):
+    """
+    Checks for keyword in metadata and returns if it exists
+
+    :param subdataset: HDF subdataset
+    :param keyword: Keyword to
+    :param default: Returned if there is no such item
+    :return: Metadata item
+    """
+
+    dataset = _gdal.Open(subdataset, _gdal.GA_ReadOnly)
+
+    metadata = dataset.GetMetadata_Dict()
+
+    return find_metadata_item(metadata, keyword, default)
+
+
 ## Paramater type that takes a list of integers as a csv
 class IntCSVParamType(click.ParamType):
     name = 'csv'
@@ -100,3 +185,46 @@ class IntCSVParamType(click.ParamType):
                 return [int(b) for b in value.split(",")]
         except ValueError:
             self.fail('%s is not a valid comma seperated list of integers' % value, param, ctx)
+
+
+## Paramater type that takes a bounding box minx,miny,maxx,maxy as a csv
+class BBoxParamType(click.ParamType):
+    name = 'bbox'
+
+    def convert(self, value, param, ctx):
+        if value is None:
+            return None
+        try:
+            bbox = tuple(float(v) for v in value.split(","))
+        except ValueError:
+            self.fail('%s is not a valid comma seperated list of numbers' % value, param, ctx)
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            self.fail('%s is not a valid minx,miny,maxx,maxy bounding box' % value, param, ctx)
+        return bbox
+
+
+## Paramater type that takes catalog criteria as key=value pairs in a csv
+class QueryParamType(click.ParamType):
+    name = 'query'
+
+    KEYS = ('tile', 'subtile', 'year', 'month', 'doy')
+
+    def convert(self, value, param, ctx):
+        if value is None or isinstance(value, dict):
+            return value
+        query = {}
+        try:
+            for item in value.split(","):
+                key, criterion = [v.strip() for v in item.split("=")]
+                if key not in self.KEYS:
+                    self.fail('%s is not one of %s' % (key, ", ".join(self.KEYS)), param, ctx)
+                if key in ('year', 'month'):
+                    criterion = int(criterion)
+                elif key == 'doy':
+                    days = [int(v) for v in criterion.split("-")]
+                    criterion = days[0] if len(days) == 1 else (days[0], days[1])
+                query[key] = criterion
+        except ValueError:
+            self.fail('%s is not a valid comma seperated list of key=value criteria' % value,
+                      param, ctx)
+        return query
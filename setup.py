@@ -11,7 +11,10 @@ setup(name='geoutils',
       zip_safe=False,
       entry_points={
           'console_scripts': [
-              "hdf2tiff=geoutils.hdf2tiff:main"
+              "hdf2tiff=geoutils.hdf2tiff:main",
+              "hdf2tiff-serve=geoutils.service:main",
+              "hdf2tiff-catalog=geoutils.catalog:main",
+              "hdf2tile=geoutils.hdf2tile:main"
           ]
       }
 )
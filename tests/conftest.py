@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# the modules import each other without the package prefix
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "geoutils"))
+
+
+def create_raster(path, ulx, uly, data, nodata=None, epsg=32633):
+    """ writes the (bands, rows, columns) array data as a GeoTIFF with 1 m pixels """
+    from osgeo import gdal, gdal_array, osr
+    bands, rows, cols = data.shape
+    ds = gdal.GetDriverByName("GTiff").Create(
+        str(path), cols, rows, bands, gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype))
+    ds.SetGeoTransform([ulx, 1, 0, uly, 0, -1])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds.SetProjection(srs.ExportToWkt())
+    for band in range(bands):
+        if nodata is not None:
+            ds.GetRasterBand(band + 1).SetNoDataValue(nodata)
+        ds.GetRasterBand(band + 1).WriteArray(data[band])
+    ds = None
+    return str(path)
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """ two adjacent 300x200 Byte rasters forming a 600x200 mosaic """
+    numpy = pytest.importorskip("numpy")
+    pytest.importorskip("osgeo.gdal")
+    source_dir = tmp_path / "sources"
+    source_dir.mkdir()
+    data = (numpy.arange(600 * 200).reshape((1, 200, 600)) % 251).astype(numpy.uint8)
+    return [create_raster(source_dir / "west.tif", 0, 200, data[:, :, :300]),
+            create_raster(source_dir / "east.tif", 300, 200, data[:, :, 300:])]
+
+
+@pytest.fixture
+def mosaic_data():
+    numpy = pytest.importorskip("numpy")
+    return (numpy.arange(600 * 200).reshape((200, 600)) % 251).astype(numpy.uint8)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+pytest.importorskip("click")
+
+from click.testing import CliRunner
+
+import catalog
+from catalog import HDFCatalog, parse_name
+
+JULY = "L57.Globe.month07.2011.hh09vv04.h6v1.doy182to212.NBAR.v3.0.hdf"
+AUGUST = "L57.Globe.month08.2011.hh09vv04.h6v1.doy213to243.NBAR.v3.0.hdf"
+WEEK = "L57.Globe.week27.2011.hh10vv04.h0v0.doy182to188.NBAR.v3.0.hdf"
+NAMES = (JULY, AUGUST, WEEK)
+
+
+@pytest.fixture
+def hdf_files(tmp_path):
+    """ empty files with WELD names, the names alone are cataloged """
+    for name in NAMES:
+        (tmp_path / name).write_bytes(b"")
+    return tmp_path
+
+
+def test_parse_name():
+    assert parse_name(os.path.join("data", JULY)) == {
+        "tile": "h09v04", "subtile": "h6v1", "year": 2011, "month": 7,
+        "doy_start": 182, "doy_end": 212}
+    # the month comes from the first day without a monthNN part
+    assert parse_name(WEEK)["month"] == 7
+    assert parse_name("mosaic.2011.hdf") is None
+    assert parse_name("mosaic.2011.hdf", partial=True) == {
+        "tile": None, "subtile": None, "year": 2011, "month": None,
+        "doy_start": None, "doy_end": None}
+
+
+def test_query(hdf_files):
+    hdf_catalog = HDFCatalog(str(hdf_files / "catalog.sqlite"))
+    assert hdf_catalog.update([str(hdf_files)]) == 3
+    # unchanged files are not cataloged again
+    assert hdf_catalog.update([str(hdf_files)]) == 0
+
+    def names(**query):
+        return [os.path.basename(path) for path in hdf_catalog.query(**query)]
+
+    assert names() == sorted(NAMES)
+    assert names(tile="h09v04", month=7) == [JULY]
+    assert names(year=2011, doy=185) == sorted([JULY, WEEK])
+    assert names(doy=(210, 220)) == sorted([JULY, AUGUST])
+    assert names(subtile="h0v0") == [WEEK]
+    assert names(year=2012) == []
+
+    # removed files are no longer listed
+    os.remove(str(hdf_files / AUGUST))
+    assert names(tile="h09v04") == [JULY]
+    hdf_catalog.close()
+
+
+def test_main_query(hdf_files):
+    runner = CliRunner()
+    args = [str(hdf_files), "--catalog", str(hdf_files / "catalog.sqlite"),
+            "--query", "tile=h09v04,doy=200-215"]
+    result = runner.invoke(catalog.main, args)
+    assert result.exit_code == 0, result.output
+    assert [os.path.basename(line) for line in result.output.splitlines()] == [JULY, AUGUST]
+
+    result = runner.invoke(catalog.main, args[:-1] + ["colour=red"])
+    assert result.exit_code == 2
+    assert "colour is not one of" in result.output
@@ -0,0 +1,52 @@
+import hashlib
+import os
+
+from dedupe import TileBlobStore
+
+
+def test_identical_tiles_share_a_blob(tmp_path):
+    blobs = TileBlobStore(str(tmp_path / ".dedupe"))
+    names = [str(tmp_path / name) for name in ("a.png", "b.png", "c.png")]
+    for name, data in zip(names, [b"ocean", b"ocean", b"land"]):
+        blobs.write(name, data)
+
+    assert os.stat(names[0]).st_ino == os.stat(names[1]).st_ino
+    assert os.stat(names[0]).st_nlink == 3
+    assert blobs.getStats() == (3, 2, 14, 9)
+
+
+def test_rewriting_a_tile_keeps_the_others(tmp_path):
+    blobs = TileBlobStore(str(tmp_path / ".dedupe"))
+    names = [str(tmp_path / name) for name in ("a.png", "b.png")]
+    for name in names:
+        blobs.write(name, b"ocean")
+    blobs.write(names[0], b"land")
+
+    with open(names[1], "rb") as fh:
+        assert fh.read() == b"ocean"
+    with open(names[0], "rb") as fh:
+        assert fh.read() == b"land"
+    assert blobs.getStats() == (2, 2, 9, 9)
+
+    # a blob no tile links to any more is not counted, but only removed
+    # by prune
+    os.remove(names[1])
+    digest = hashlib.sha1(b"ocean").hexdigest()
+    blob = str(tmp_path / ".dedupe" / digest[:2] / digest)
+    assert blobs.getStats() == (1, 1, 4, 4)
+    assert os.path.exists(blob)
+    assert blobs.prune() == 1
+    assert not os.path.exists(blob)
+    assert blobs.getStats() == (1, 1, 4, 4)
+
+
+def test_stats_keep_blobs_of_other_writers(tmp_path):
+    blobs = TileBlobStore(str(tmp_path / ".dedupe"))
+    # a shard stored the payload but did not link its tile yet
+    digest = hashlib.sha1(b"ocean").hexdigest()
+    blob = blobs.blobPath(digest)
+    blobs.writeBlob(blob, b"ocean")
+    assert blobs.getStats() == (0, 0, 0, 0)
+    blobs.write(str(tmp_path / "a.png"), b"ocean")
+    assert os.stat(blob).st_nlink == 2
+    assert blobs.getStats() == (1, 1, 5, 5)
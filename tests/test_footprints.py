@@ -0,0 +1,53 @@
+import os
+
+import footprints
+from footprints import FootprintCatalog
+
+FOOTPRINT = ((0.0, 1.0, 0.0, 200.0, 0.0, -1.0), 300, 200)
+
+
+def add(catalog, path):
+    """ catalogs FOOTPRINT for path as if it had been read """
+    stat = os.stat(path)
+    geotransform, xsize, ysize = FOOTPRINT
+    catalog.connection.execute(footprints.INSERT_FOOTPRINT,
+                               (os.path.abspath(path), stat.st_size, stat.st_mtime,
+                                xsize, ysize) + geotransform)
+
+
+def test_lookup(tmp_path):
+    raster = str(tmp_path / "west.tif")
+    with open(raster, "wb") as fh:
+        fh.write(b"tiff")
+    catalog = FootprintCatalog(str(tmp_path / "footprints.sqlite"))
+    add(catalog, raster)
+    assert catalog.lookup(raster) == FOOTPRINT
+
+    # changed inputs are read again
+    with open(raster, "ab") as fh:
+        fh.write(b"more")
+    assert catalog.lookup(raster) is None
+
+    # missing inputs are stale rather than raising
+    add(catalog, raster)
+    os.remove(raster)
+    assert catalog.lookup(raster) is None
+    catalog.close()
+
+
+def test_changes(tmp_path):
+    names = [str(tmp_path / name) for name in ("a.tif", "b.tif", "c.tif")]
+    for name in names:
+        with open(name, "wb") as fh:
+            fh.write(b"tiff")
+    catalog = FootprintCatalog(str(tmp_path / "footprints.sqlite"))
+    for name in names[:2]:
+        add(catalog, name)
+    os.remove(names[1])
+
+    everything, stale, changed = catalog.getChanges([names[0], names[2]])
+    assert everything == [FOOTPRINT, FOOTPRINT]
+    # b.tif is gone, c.tif is new
+    assert stale == [FOOTPRINT]
+    assert changed == [names[2]]
+    catalog.close()
@@ -0,0 +1,416 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy
+import pytest
+
+import gdal_retile
+
+try:
+    from osgeo import gdal, ogr
+except ImportError:
+    # the tests writing tiles take the sources fixture, which skips them
+    gdal = ogr = None
+
+
+def retile(*args):
+    gdal_retile.initGlobals()
+    return gdal_retile.main(["gdal_retile.py", "-q"] + [str(arg) for arg in args])
+
+
+def test_tile_files(tmp_path, sources, mosaic_data):
+    assert retile("-ps", 256, 256, "-targetDir", tmp_path, *sources) == 0
+    tile = gdal.Open(str(tmp_path / "west_1_2.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == mosaic_data[:, 256:512]).all()
+
+
+def test_tile_index_driver_from_extension(monkeypatch):
+    monkeypatch.setattr(gdal_retile, "TileIndexFormat", None)
+    assert gdal_retile.getTileIndexDriverName("index.GPKG") == "GPKG"
+    assert gdal_retile.getTileIndexDriverName("index.fgb") == "FlatGeobuf"
+    assert gdal_retile.getTileIndexDriverName("index.idx") == "ESRI Shapefile"
+    monkeypatch.setattr(gdal_retile, "TileIndexFormat", "GPKG")
+    assert gdal_retile.getTileIndexDriverName("index.shp") == "GPKG"
+
+
+@pytest.mark.parametrize("index", ["index.gpkg", "index.fgb"])
+def test_tile_index_formats(tmp_path, sources, index):
+    assert retile("-ps", 256, 256, "-tileIndex", index, "-tileIndexField", "tile",
+                  "-targetDir", tmp_path, *sources) == 0
+
+    layer = ogr.Open(str(tmp_path / index)).GetLayer()
+    features = dict((feature.GetField("tile"), feature.GetGeometryRef().GetEnvelope())
+                    for feature in layer)
+    assert features == {"west_1_1.tif": (0, 256, 0, 200),
+                        "west_1_2.tif": (256, 512, 0, 200),
+                        "west_1_3.tif": (512, 600, 0, 200)}
+
+
+def test_tile_index_batches(tmp_path, sources, monkeypatch):
+    commits = []
+    commit = gdal_retile.commitTileIndexBatch
+
+    def counting(ds):
+        commits.append(ds.GetLayer().GetFeatureCount())
+        commit(ds)
+
+    monkeypatch.setattr(gdal_retile, "commitTileIndexBatch", counting)
+    assert retile("-ps", 128, 128, "-tileIndex", "index.gpkg", "-tileIndexBatch", 4,
+                  "-targetDir", tmp_path, *sources) == 0
+    # 10 tiles are written in batches of 4
+    assert commits == [4, 8, 10]
+
+
+def test_tile_bounds():
+    ti = gdal_retile.tile_info(600, 200, 256, 256)
+    bounds = gdal_retile.getTileBounds(0, 200, 1, -1, ti, [1, 3], [1, 1])
+    assert bounds.tolist() == [[0, 256, 0, 200], [512, 600, 0, 200]]
+
+
+@pytest.mark.parametrize("extension", [".npy", ".parquet"])
+def test_tile_bounds_file(tmp_path, monkeypatch, extension):
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(gdal_retile, "TileIndexFieldName", "location")
+    ti = gdal_retile.tile_info(600, 200, 256, 256)
+    bounds = gdal_retile.getTileBounds(0, 200, 1, -1, ti, [1, 2, 3], [1, 1, 1])
+    fileName = str(tmp_path / ("bounds" + extension))
+    locations = ["a_1_1.tif", "a_1_2.tif", "a_1_3.tif"]
+
+    gdal_retile.copyTileBoundsToFile(locations, (1, 2, 3), (1, 1, 1), bounds, fileName)
+    result = gdal_retile.readTileBoundsFile(fileName)
+    assert result[:3] == (locations, [1, 2, 3], [1, 1, 1])
+    assert (result[3] == bounds).all()
+
+
+def test_tile_bounds_csv(tmp_path, sources):
+    assert retile("-ps", 256, 256, "-csv", "tiles.csv", "-csvDelim", ";",
+                  "-targetDir", tmp_path, *sources) == 0
+
+    with open(str(tmp_path / "tiles.csv")) as csvfile:
+        rows = [line.split(";") for line in csvfile.read().splitlines()]
+    assert [row[0] for row in rows] == ["west_1_1.tif", "west_1_2.tif", "west_1_3.tif"]
+    assert [float(value) for value in rows[2][1:]] == [512, 600, 0, 200]
+
+
+def test_tile_store(tmp_path, sources, mosaic_data):
+    from tilestore import TileStoreReader
+    assert retile("-ps", 256, 256, "-tileStore", "-levels", 1, "-targetDir", tmp_path,
+                  *sources) == 0
+
+    reader = TileStoreReader(str(tmp_path / "west.tiles"))
+    assert (reader.tile(1, 0)[0] == mosaic_data[:, 256:512]).all()
+    assert reader.tile(2, 0).shape == (1, 200, 88)
+    reader.close()
+    assert os.path.exists(str(tmp_path / "1" / "west.tiles"))
+
+
+def test_tile_db(tmp_path, sources):
+    mbtiles = tmp_path / "mosaic.mbtiles"
+    assert retile("-ps", 256, 256, "-of", "PNG", "-tileDB", mbtiles, "-levels", 1,
+                  "-targetDir", tmp_path, *sources) == 0
+
+    connection = sqlite3.connect(str(mbtiles))
+    zooms = dict(connection.execute(
+        "SELECT zoom_level, COUNT(*) FROM tiles GROUP BY zoom_level").fetchall())
+    connection.close()
+    # level 0 (3x1 tiles) is the highest zoom of the raster scheme
+    assert zooms == {1: 3, 0: 2}
+
+
+def test_tile_db_pads_edge_tiles(tmp_path, sources):
+    gpkg = tmp_path / "mosaic.gpkg"
+    assert retile("-ps", 256, 256, "-of", "PNG", "-tileDB", gpkg, "-targetDir", tmp_path,
+                  *sources) == 0
+
+    connection = sqlite3.connect(str(gpkg))
+    data = connection.execute("SELECT tile_data FROM tiles WHERE tile_column = 2").fetchone()[0]
+    connection.close()
+    gdal.FileFromMemBuffer("/vsimem/edge.png", bytes(data))
+    tile = gdal.Open("/vsimem/edge.png")
+    assert (tile.RasterXSize, tile.RasterYSize) == (256, 256)
+    tile = None
+    gdal.Unlink("/vsimem/edge.png")
+
+
+def test_tile_db_needs_image_format(tmp_path, sources):
+    assert retile("-tileDB", tmp_path / "mosaic.mbtiles", "-targetDir", tmp_path, *sources) == 1
+
+
+def test_tile_db_processes(tmp_path, sources):
+    tiles = []
+    for processes in (1, 2):
+        mbtiles = tmp_path / ("%d.mbtiles" % processes)
+        assert retile("-ps", 128, 128, "-of", "PNG", "-processes", processes, "-levels", 1,
+                      "-tileDB", mbtiles, "-targetDir", tmp_path, *sources) == 0
+        connection = sqlite3.connect(str(mbtiles))
+        tiles.append(connection.execute(
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles "
+            "ORDER BY zoom_level, tile_column, tile_row").fetchall())
+        connection.close()
+    assert len(tiles[0]) == 10 + 3
+    assert tiles[0] == tiles[1]
+
+
+def test_tile_store_processes(tmp_path, sources, mosaic_data):
+    from tilestore import TileStoreReader
+    assert retile("-ps", 128, 128, "-tileStore", "-processes", 2, "-targetDir", tmp_path,
+                  *sources) == 0
+
+    reader = TileStoreReader(str(tmp_path / "west.tiles"))
+    assert (reader.tile(2, 1)[0] == mosaic_data[128:, 256:384]).all()
+    reader.close()
+
+
+def test_mercator_tile_db_processes(tmp_path, sources):
+    mbtiles = tmp_path / "mercator.mbtiles"
+    assert retile("-tilingScheme", "xyz", "-zoom", "14-16", "-of", "PNG", "-processes", 2,
+                  "-tileDB", mbtiles, "-targetDir", tmp_path, *sources) == 0
+
+    connection = sqlite3.connect(str(mbtiles))
+    zooms = [row[0] for row in connection.execute(
+        "SELECT DISTINCT zoom_level FROM tiles ORDER BY zoom_level")]
+    connection.close()
+    assert zooms == [14, 15, 16]
+
+
+@pytest.mark.parametrize("option", [("-tileIndex", "index.shp"), ("-csv", "tiles.csv"),
+                                    ("-levels", 2), ("-ps", 256, 512), ("-tileStore",)])
+def test_mercator_rejects_raster_options(tmp_path, sources, option):
+    assert retile("-tilingScheme", "xyz", "-zoom", "14", "-targetDir", tmp_path,
+                  *(option + tuple(sources))) == 1
+    assert os.listdir(str(tmp_path)) == ["sources"]
+
+
+def test_tile_processes(tmp_path, sources, mosaic_data):
+    assert retile("-ps", 256, 256, "-processes", 2, "-levels", 1, "-tileIndex", "index.shp",
+                  "-targetDir", tmp_path, *sources) == 0
+
+    tile = gdal.Open(str(tmp_path / "west_1_3.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == mosaic_data[:, 512:]).all()
+    tile = None
+    assert ogr.Open(str(tmp_path / "index.shp")).GetLayer().GetFeatureCount() == 3
+    assert ogr.Open(str(tmp_path / "1" / "index.shp")).GetLayer().GetFeatureCount() == 2
+
+
+def test_shards_merge(tmp_path, sources):
+    outputs = ("-tileIndex", "index.shp", "-csv", "tiles.csv", "-boundsIndex", "bounds.npy")
+    for shard in ("1/2", "2/2"):
+        assert retile("-ps", 256, 256, "-shard", shard, "-targetDir", tmp_path,
+                      *(outputs + tuple(sources))) == 0
+    assert os.path.exists(str(tmp_path / "tiles.shard2of2.csv"))
+    assert retile("-ps", 256, 256, "-mergeShards", "-levels", 1, "-targetDir", tmp_path,
+                  *(outputs + tuple(sources))) == 0
+
+    names = ["west_1_1.tif", "west_1_2.tif", "west_1_3.tif"]
+    assert ogr.Open(str(tmp_path / "index.shp")).GetLayer().GetFeatureCount() == 3
+    with open(str(tmp_path / "tiles.csv")) as csvfile:
+        rows = [line.split(gdal_retile.CsvDelimiter) for line in csvfile.read().splitlines()]
+    assert [row[0] for row in rows] == names
+    bounds = numpy.load(str(tmp_path / "bounds.npy"))
+    assert [location.decode() for location in bounds["location"]] == names
+    assert bounds["minx"].tolist() == [0, 256, 512]
+    # the pyramid is built from the merged tiles
+    assert ogr.Open(str(tmp_path / "1" / "index.shp")).GetLayer().GetFeatureCount() == 2
+
+
+def test_pipeline(tmp_path, sources, mosaic_data):
+    assert retile("-ps", 256, 256, "-pipeline", "2,2", "-tileIndex", "index.shp",
+                  "-targetDir", tmp_path, *sources) == 0
+
+    tile = gdal.Open(str(tmp_path / "west_1_2.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == mosaic_data[:, 256:512]).all()
+    tile = None
+    assert ogr.Open(str(tmp_path / "index.shp")).GetLayer().GetFeatureCount() == 3
+
+
+@pytest.mark.parametrize("stage", ["writeTileFile", "encodeTile"])
+def test_pipeline_stops_on_error(tmp_path, sources, monkeypatch, stage):
+    calls = []
+    function = getattr(gdal_retile, stage)
+
+    def failing(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise IOError("disk full")
+        return function(*args)
+
+    monkeypatch.setattr(gdal_retile, stage, failing)
+    with pytest.raises(IOError):
+        retile("-ps", 64, 64, "-pipeline", "1,1", "-targetDir", tmp_path, *sources)
+    # the pipeline stops instead of processing all 40 tiles
+    assert len(calls) < 10
+
+
+def test_zoom_from_source_processes(tmp_path, sources):
+    for processes in (1, 2):
+        target = tmp_path / str(processes)
+        target.mkdir()
+        assert retile("-ps", 128, 128, "-levels", 2, "-zoomFrom", "source",
+                      "-processes", processes, "-tileIndex", "index.shp",
+                      "-targetDir", target, *sources) == 0
+
+    for level, count in ((1, 3), (2, 2)):
+        for processes in (1, 2):
+            index = ogr.Open(str(tmp_path / str(processes) / str(level) / "index.shp"))
+            assert index.GetLayer().GetFeatureCount() == count
+            index = None
+        names = sorted(os.listdir(str(tmp_path / "1" / str(level))))
+        assert names == sorted(os.listdir(str(tmp_path / "2" / str(level))))
+        for name in names:
+            if name.endswith(".tif"):
+                expected = gdal.Open(str(tmp_path / "1" / str(level) / name)).ReadAsArray()
+                tile = gdal.Open(str(tmp_path / "2" / str(level) / name)).ReadAsArray()
+                assert (tile == expected).all()
+
+
+def test_dedupe_links_are_not_written_through(tmp_path):
+    pytest.importorskip("osgeo.gdal")
+    from conftest import create_raster
+    zeros = create_raster(tmp_path / "flat.tif", 0, 200, numpy.zeros((1, 200, 600), numpy.uint8))
+    assert retile("-ps", 256, 256, "-of", "PNG", "-dedupe", "-targetDir", tmp_path, zeros) == 0
+    assert os.stat(str(tmp_path / "flat_1_1.png")).st_nlink == 3
+
+    # a later run without -dedupe replaces the links instead of the payloads
+    ones = create_raster(tmp_path / "flat.tif", 0, 200, numpy.ones((1, 200, 600), numpy.uint8))
+    assert retile("-ps", 256, 256, "-of", "PNG", "-targetDir", tmp_path, ones) == 0
+    assert os.stat(str(tmp_path / "flat_1_1.png")).st_nlink == 1
+    blobs = tmp_path / ".dedupe"
+    for root, dirs, names in os.walk(str(blobs)):
+        for name in names:
+            with open(os.path.join(root, name), "rb") as fh:
+                assert hashlib.sha1(fh.read()).hexdigest() == name
+
+
+def test_dedupe_needs_image_format(tmp_path, sources):
+    assert retile("-dedupe", "-targetDir", tmp_path, *sources) == 1
+
+
+def test_journal_reload(tmp_path):
+    fileName = str(tmp_path / "retile.journal")
+    journal = gdal_retile.TileJournal(fileName, 2)
+    assert journal.begin(256, 256, 600, 200)
+    journal.addTile(0, 1, 1, "a_1_1.tif")
+    journal.addTile(0, 2, 1, None)
+    journal.addLevel(0)
+    journal.addTile(1, 1, 1, "1/a_1_1.tif")
+    journal.close()
+
+    journal = gdal_retile.TileJournal(fileName, 2)
+    assert journal.begin(256, 256, 600, 200)
+    assert journal.hasLevel(0) and not journal.hasLevel(1)
+    assert journal.tileName(0, 1, 1) == "a_1_1.tif"
+    assert journal.hasTile(0, 2, 1) and journal.tileName(0, 2, 1) is None
+    assert journal.hasTile(1, 1, 1) and not journal.hasTile(0, 3, 1)
+    journal.close()
+
+    # a different grid can not be resumed
+    journal = gdal_retile.TileJournal(fileName, 2)
+    assert not journal.begin(128, 128, 600, 200)
+    journal.close()
+
+
+def test_journal_cuts_torn_writes(tmp_path):
+    fileName = str(tmp_path / "retile.journal")
+    journal = gdal_retile.TileJournal(fileName, 1)
+    journal.begin(256, 256, 600, 200)
+    journal.addTile(0, 1, 1, "a_1_1.tif")
+    journal.close()
+    with open(fileName, "a") as fh:
+        fh.write("tile\t0\t2\t1\ta_1")
+
+    journal = gdal_retile.TileJournal(fileName, 1)
+    assert journal.hasTile(0, 1, 1) and not journal.hasTile(0, 2, 1)
+    journal.addTile(0, 2, 1, "a_1_2.tif")
+    journal.close()
+    with open(fileName) as fh:
+        assert fh.read().splitlines()[-1] == "tile\t0\t2\t1\ta_1_2.tif"
+
+
+def test_resume_renders_the_unfinished_tiles(tmp_path, sources, mosaic_data):
+    assert retile("-ps", 256, 256, "-resume", "-targetDir", tmp_path, *sources) == 0
+    journal = tmp_path / gdal_retile.JournalName
+    with open(str(journal)) as fh:
+        lines = fh.read().splitlines()
+    assert lines[-1] == "level\t0"
+
+    # crashed while writing the last tile: the level is not finished and
+    # the tile is cut short
+    with open(str(journal), "w") as fh:
+        fh.write("\n".join(lines[:-1]) + "\n")
+    with open(str(tmp_path / "west_1_3.tif"), "r+b") as fh:
+        fh.truncate(500)
+    os.remove(str(tmp_path / "west_1_1.tif"))
+
+    assert retile("-ps", 256, 256, "-resume", "-targetDir", tmp_path, *sources) == 0
+    tile = gdal.Open(str(tmp_path / "west_1_3.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == mosaic_data[:, 512:]).all()
+    tile = None
+    # tiles in the journal are not rendered again
+    assert not os.path.exists(str(tmp_path / "west_1_1.tif"))
+
+
+WEST = ((0.0, 1.0, 0.0, 200.0, 0.0, -1.0), 300, 200)
+EAST = ((300.0, 1.0, 0.0, 200.0, 0.0, -1.0), 300, 200)
+
+
+class FakeSources(object):
+    """ returns the given getChanges result """
+    def __init__(self, footprints, stale, changed):
+        self.changes = (footprints, stale, changed)
+
+    def getChanges(self, names):
+        return self.changes
+
+
+class FakeMosaicInfo(object):
+    ulx, uly, lrx, lry, scaleX, scaleY = 0.0, 200.0, 600.0, 0.0, 1.0, -1.0
+
+
+def test_tile_changed(monkeypatch):
+    monkeypatch.setattr(gdal_retile, "ChangedAreas", None)
+    assert gdal_retile.isTileChanged([256, 1, 0, 200, 0, -1], 256, 200)
+    monkeypatch.setattr(gdal_retile, "ChangedAreas", [(0.0, 0.0, 256.0, 200.0)])
+    # touching the changed area is not overlapping it
+    assert not gdal_retile.isTileChanged([256, 1, 0, 200, 0, -1], 256, 200)
+    assert gdal_retile.isTileChanged([0, 1, 0, 200, 0, -1], 256, 200)
+    monkeypatch.setattr(gdal_retile, "ChangedAreas", [])
+    assert not gdal_retile.isTileChanged([0, 1, 0, 200, 0, -1], 256, 200)
+
+
+def test_changed_areas(monkeypatch):
+    import footprints
+    monkeypatch.setattr(gdal_retile, "Names", [])
+    monkeypatch.setattr(gdal_retile, "Verbose", False)
+    monkeypatch.setattr(footprints, "readFootprint", lambda name: (name, EAST))
+
+    # no previous run
+    assert gdal_retile.getChangedAreas(FakeSources([], [], ["west.tif"]), FakeMosaicInfo()) is None
+    # a removed input and a changed one
+    sources = FakeSources([WEST, EAST], [WEST], ["east.tif"])
+    assert gdal_retile.getChangedAreas(sources, FakeMosaicInfo()) == [
+        (0.0, 0.0, 300.0, 200.0), (300.0, 0.0, 600.0, 200.0)]
+    # the mosaic grew, so every tile is rendered
+    sources = FakeSources([WEST], [], [])
+    assert gdal_retile.getChangedAreas(sources, FakeMosaicInfo()) is None
+
+
+def test_update_renders_the_changed_tiles(tmp_path, sources, mosaic_data):
+    from conftest import create_raster
+    assert retile("-ps", 256, 256, "-update", "-targetDir", tmp_path, *sources) == 0
+    assert os.path.exists(str(tmp_path / gdal_retile.SourcesName))
+
+    # west_1_1.tif only covers the west input, so it is not rendered again
+    os.remove(str(tmp_path / "west_1_1.tif"))
+    changed = numpy.full((1, 200, 300), 7, numpy.uint8)
+    create_raster(sources[1], 300, 200, changed)
+    assert retile("-ps", 256, 256, "-update", "-targetDir", tmp_path, *sources) == 0
+
+    assert not os.path.exists(str(tmp_path / "west_1_1.tif"))
+    tile = gdal.Open(str(tmp_path / "west_1_2.tif"))
+    data = tile.GetRasterBand(1).ReadAsArray()
+    assert (data[:, :44] == mosaic_data[:, 256:300]).all()
+    assert (data[:, 44:] == 7).all()
+    tile = gdal.Open(str(tmp_path / "west_1_3.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == 7).all()
@@ -0,0 +1,49 @@
+import hashlib
+import os
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+gdal = pytest.importorskip("gdal")
+import hdf2tiff
+
+from conftest import create_raster
+
+
+def test_warp_in_chunks(tmp_path):
+    data = numpy.arange(70 * 50, dtype=numpy.int16).reshape((1, 50, 70))
+    data[0, :10, :10] = hdf2tiff.NO_DATA
+    source = create_raster(tmp_path / "source.tif", 0, 50, data, nodata=hdf2tiff.NO_DATA)
+    tiff = str(tmp_path / "chunked.tif")
+
+    statistics = hdf2tiff.warp_in_chunks(tiff, source, str(tmp_path), {}, 16, threads=3)
+
+    result = gdal.Open(tiff).GetRasterBand(1).ReadAsArray()
+    assert (result == data[0]).all()
+    valid = data[0][data[0] != hdf2tiff.NO_DATA]
+    low, high, mean, stddev = statistics[0]
+    assert (low, high) == (valid.min(), valid.max())
+    assert mean == pytest.approx(valid.mean())
+    assert stddev == pytest.approx(valid.std())
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_store_statistics(tmp_path, chunked):
+    data = numpy.arange(70 * 50, dtype=numpy.int16).reshape((1, 50, 70))
+    data[0, :10, :10] = hdf2tiff.NO_DATA
+    tiff = create_raster(tmp_path / "warped.tif", 0, 50, data, nodata=hdf2tiff.NO_DATA)
+    with open(tiff, "rb") as fh:
+        written = hashlib.sha1(fh.read()).hexdigest()
+
+    valid = data[0][data[0] != hdf2tiff.NO_DATA].astype(numpy.float64)
+    expected = (valid.min(), valid.max(), valid.mean(), valid.std())
+    hdf2tiff.store_statistics(tiff, [expected] if chunked else None)
+
+    # the tiff is not rewritten, the exact statistics are in the sidecar
+    with open(tiff, "rb") as fh:
+        assert hashlib.sha1(fh.read()).hexdigest() == written
+    assert os.path.exists(tiff + ".aux.xml")
+    band = gdal.Open(tiff).GetRasterBand(1)
+    assert band.GetMetadataItem("STATISTICS_APPROXIMATE") is None
+    assert float(band.GetMetadataItem("STATISTICS_MEAN")) == pytest.approx(valid.mean())
+    assert float(band.GetMetadataItem("STATISTICS_MINIMUM")) == valid.min()
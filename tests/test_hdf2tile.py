@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+gdal = pytest.importorskip("gdal")
+import hdf2tile
+
+from conftest import create_raster
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch, mosaic_data):
+    """ a 600x200 raster tiled as if it was the stack built from an HDF file """
+    monkeypatch.setattr(hdf2tile, "build_stack", lambda hdf, data_dir, **kwargs: (hdf, {}))
+    return create_raster(tmp_path / "source.tif", 0, 200, mosaic_data[numpy.newaxis])
+
+
+def test_hdf2tile(tmp_path, source, mosaic_data):
+    output_dir = str(tmp_path / "tiles")
+    assert hdf2tile.hdf2tile(source, output_dir, 256, levels=1) == 3
+
+    tile = gdal.Open(os.path.join(output_dir, "source_1_2.tif"))
+    assert (tile.GetRasterBand(1).ReadAsArray() == mosaic_data[:, 256:512]).all()
+    tile = None
+    assert sorted(os.listdir(os.path.join(output_dir, "1"))) == ["source_1_1.tif",
+                                                                  "source_1_2.tif"]
+
+
+def test_no_clobber_checks_every_level(tmp_path, source):
+    output_dir = str(tmp_path / "tiles")
+    os.makedirs(os.path.join(output_dir, "1"))
+    open(os.path.join(output_dir, "1", "source_1_2.tif"), "w").close()
+
+    with pytest.raises(RuntimeError):
+        hdf2tile.hdf2tile(source, output_dir, 256, levels=1)
+    assert not os.path.exists(os.path.join(output_dir, "source_1_1.tif"))
+    assert hdf2tile.hdf2tile(source, output_dir, 256, levels=1, clobber=True) == 3
@@ -0,0 +1,38 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+from hdfreader import HDFBand, HDFReader, sampled_blocks
+
+
+@pytest.fixture
+def band(tmp_path):
+    """ a 100x60 band in 16x16 blocks, read like an HDF subdataset """
+    gdal = pytest.importorskip("gdal")
+    path = str(tmp_path / "band.tif")
+    ds = gdal.GetDriverByName("GTiff").Create(path, 100, 60, 1, gdal.GDT_Int16,
+                                              ["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+    ds.SetMetadata({"scale_factor": "0.5", "_FillValue": "-1"})
+    ds.GetRasterBand(1).WriteArray(numpy.arange(6000, dtype=numpy.int16).reshape((60, 100)))
+    ds = None
+
+    reader = HDFReader(path)
+    yield HDFBand(reader, 1, path)
+    reader.close()
+
+
+def test_sampled_blocks():
+    # samples 3, 10, ..., 94 of 16 pixel blocks
+    assert list(sampled_blocks(3, 94, 7, 16)) == \
+        [(0, 0, 2), (1, 2, 5), (2, 5, 7), (3, 7, 9), (4, 9, 11), (5, 11, 14)]
+
+
+def test_strided_read(band):
+    expected = numpy.arange(6000).reshape((60, 100))[5:50:7, 3:97:40] * 0.5
+    assert (band[5:50:7, 3:97:40] == expected).all()
+
+
+def test_strided_read_only_reads_sampled_blocks(band):
+    band.read(step=(40, 20))
+    # columns 0, 40 and 80 and rows 0, 20 and 40 fall into these blocks
+    assert set(key[1:] for key in band.reader._cache) == \
+        set((bx, by) for bx in (0, 2, 5) for by in (0, 1, 2))
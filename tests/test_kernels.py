@@ -0,0 +1,39 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+import kernels
+
+NODATA = -9999
+
+
+def test_methods_ignore_nodata():
+    data = numpy.array([[1, NODATA, 4, 4],
+                        [3, NODATA, 2, 9]], dtype=numpy.int16)
+    assert kernels.downsample(data, "mean", NODATA).tolist() == [[2, 5]]
+    assert kernels.downsample(data, "min", NODATA).tolist() == [[1, 2]]
+    assert kernels.downsample(data, "max", NODATA).tolist() == [[3, 9]]
+    # the smallest of the most frequent values
+    assert kernels.downsample(data, "mode", NODATA).tolist() == [[1, 4]]
+
+
+@pytest.mark.parametrize("method", kernels.METHODS)
+def test_odd_sizes_and_empty_blocks(method):
+    data = numpy.full((3, 5), NODATA, dtype=numpy.float32)
+    data[2, 4] = 7
+    result = kernels.downsample(data, method, NODATA)
+    assert result.dtype == numpy.float32
+    assert result.tolist() == [[NODATA] * 3, [NODATA, NODATA, 7]]
+
+
+@pytest.mark.parametrize("method", kernels.METHODS)
+def test_empty_blocks_without_nodata(method):
+    data = numpy.array([[numpy.nan, numpy.nan, 1, numpy.nan],
+                        [numpy.nan, numpy.nan, numpy.nan, numpy.nan]])
+    result = kernels.downsample(data, method)
+    assert numpy.isnan(result[0, 0]) and result[0, 1] == 1
+
+
+def test_integer_mean_rounds():
+    data = numpy.array([[1, 2], [2, 2]], dtype=numpy.uint8)
+    assert kernels.downsample(data, "mean").tolist() == [[2]]
+    assert kernels.downsample(data, "mean").dtype == numpy.uint8
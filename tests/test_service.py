@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+
+import pytest
+
+import service
+
+
+class FailingHDF2Tiff(object):
+    """ stands in for hdf2tiff in the forked workers """
+
+    class gdal(object):
+        @staticmethod
+        def VersionInfo():
+            return ""
+
+    @staticmethod
+    def process_file(job):
+        raise IOError("{} is not an HDF file".format(job[0]))
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    monkeypatch.setattr(service, "hdf2tiff", FailingHDF2Tiff)
+
+
+def test_claims_files_once_their_size_is_stable(tmp_path):
+    spool = str(tmp_path)
+    os.mkdir(os.path.join(spool, "processing"))
+    sizes = {}
+    with open(os.path.join(spool, "a.hdf"), "wb") as hdf:
+        hdf.write(b"part")
+    assert service.claim_spool_files(spool, sizes) == []
+
+    # still being copied
+    with open(os.path.join(spool, "a.hdf"), "ab") as hdf:
+        hdf.write(b"more")
+    assert service.claim_spool_files(spool, sizes) == []
+
+    assert service.claim_spool_files(spool, sizes) == [os.path.join(spool, "processing", "a.hdf")]
+    assert os.listdir(os.path.join(spool, "processing")) == ["a.hdf"]
+
+
+def test_failed_conversions_release_their_workers(tmp_path, failing):
+    conversions = service.ConversionService({}, workers=1, queue_size=1,
+                                            event_log=str(tmp_path / "events.log"))
+    events = []
+    done = threading.Event()
+
+    def finished(event):
+        events.append(event)
+        if len(events) == 4:
+            done.set()
+
+    try:
+        # more failures than workers and queue slots
+        for name in ("a.hdf", "b.hdf", "c.hdf", "d.hdf"):
+            conversions.submit(name, callback=finished, timeout=30)
+        assert done.wait(30)
+    finally:
+        conversions.close()
+    assert [event["event"] for event in events] == ["failed"] * 4
+    assert events[0]["error"].endswith("a.hdf is not an HDF file")
+    with open(str(tmp_path / "events.log")) as log:
+        logged = [json.loads(line)["event"] for line in log]
+    assert sorted(logged) == ["failed"] * 4 + ["queued"] * 4
+
+
+def test_unpicklable_jobs_fail(tmp_path, failing):
+    # a lock can not be pickled to the workers
+    conversions = service.ConversionService({"lock": threading.Lock()}, workers=1,
+                                            event_log=str(tmp_path / "events.log"))
+    events = []
+    done = threading.Event()
+
+    def finished(event):
+        events.append(event)
+        done.set()
+
+    try:
+        conversions.submit("a.hdf", callback=finished)
+        assert done.wait(30)
+        assert events[0]["event"] == "failed"
+        # the worker slot was released
+        done.clear()
+        conversions.submit("b.hdf", callback=finished)
+        assert done.wait(30)
+    finally:
+        conversions.close()
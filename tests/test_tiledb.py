@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+from tiledb import SQLiteTileWriter
+
+
+def test_mbtiles_rows_are_flipped(tmp_path):
+    writer = SQLiteTileWriter(str(tmp_path / "tiles.mbtiles"), batchSize=2)
+    writer.addTileMatrix(1, 2, 2, 256, 256, 1.0, 1.0)
+    writer.put(1, 0, 0, b"top")
+    writer.put(1, 1, 1, b"bottom")
+    writer.flush()
+    assert writer.read(1, 0, 0) == b"top"
+    assert writer.read(1, 1, 1) == b"bottom"
+    assert writer.read(1, 1, 0) is None
+    writer.close()
+
+    connection = sqlite3.connect(str(tmp_path / "tiles.mbtiles"))
+    rows = connection.execute("SELECT tile_column, tile_row, tile_data FROM tiles "
+                              "ORDER BY tile_column").fetchall()
+    connection.close()
+    assert [(col, row, bytes(data)) for col, row, data in rows] == [(0, 1, b"top"), (1, 0, b"bottom")]
+
+
+def test_open_error_does_not_block(tmp_path):
+    writer = SQLiteTileWriter(str(tmp_path / "missing" / "tiles.mbtiles"), queueSize=2)
+    writer.addTileMatrix(0, 1, 1, 256, 256, 1.0, 1.0)
+    with pytest.raises(sqlite3.Error):
+        for col in range(10):
+            writer.put(0, col, 0, b"tile")
+        writer.flush()
+    with pytest.raises(sqlite3.Error):
+        writer.close()
+
+
+def test_dedupe_stores_payloads_once(tmp_path):
+    writer = SQLiteTileWriter(str(tmp_path / "tiles.mbtiles"), batchSize=3, dedupe=True)
+    writer.addTileMatrix(0, 4, 1, 256, 256, 1.0, 1.0)
+    for col, data in enumerate([b"ocean", b"ocean", b"land", b"ocean"]):
+        writer.put(0, col, 0, data)
+    assert writer.getDedupeStats() == (4, 2, 19, 9)
+    assert writer.read(0, 3, 0) == b"ocean"
+    writer.close()
+
+
+def test_dedupe_needs_mbtiles(tmp_path):
+    with pytest.raises(ValueError):
+        SQLiteTileWriter(str(tmp_path / "tiles.gpkg"), dedupe=True)
+
+
@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+
+import pytest
+
+try:
+    from urllib2 import HTTPError, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+import gdal_retile
+import tileserver
+
+
+class FakeRenderer:
+    """ renders tiles as their key, column 1 has no data """
+    def __init__(self):
+        self.calls=[]
+        self.release=threading.Event()
+        self.release.set()
+
+    def render(self, level, col, row, width, height):
+        self.calls.append((level, col, row))
+        self.release.wait()
+        if col == 1:
+            return None
+        return (level, col, row, width, height)
+
+
+@pytest.fixture
+def tiles(monkeypatch):
+    def encodeTile(ds, name):
+        if ds[:2] == (1, 0):
+            raise IOError("Encoding failed for %s" % name)
+        return ("%d/%d/%d %dx%d" % ds).encode("ascii")
+    monkeypatch.setattr(gdal_retile, "encodeTile", encodeTile)
+    grids=[gdal_retile.tile_info(600, 200, 256, 256), gdal_retile.tile_info(300, 100, 256, 256)]
+    return tileserver.TileCache(grids, [FakeRenderer()], 1024)
+
+
+@pytest.fixture
+def server(tiles):
+    server=tileserver.TileServer(("127.0.0.1", 0), tiles, {"levels": 2}, "image/png")
+    thread=threading.Thread(target=server.serve_forever)
+    thread.daemon=True
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(url):
+    try:
+        response=urlopen(url)
+    except HTTPError as e:
+        return e.code, None, None
+    return response.getcode(), response.info().get("X-Tile-Source"), response.read()
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache=tileserver.LRUCache(10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.size == 8
+    # tiles larger than the cache are not kept
+    cache.put("d", b"12345678901")
+    assert cache.get("d") is None
+
+
+def test_concurrent_requests_are_coalesced(tiles):
+    renderer=tiles.renderers.queue[0]
+    renderer.release.clear()
+    sources=[]
+
+    def get():
+        sources.append(tiles.get(0, 2, 0)[1])
+    threads=[threading.Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while not renderer.calls:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    renderer.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert renderer.calls == [(0, 2, 0)]
+    assert sorted(sources) == ["coalesced"] * 3 + ["render"]
+    assert tiles.stats["coalesced"] == 3
+
+
+def test_serves_tiles(server):
+    assert fetch(server + "/0/0/0") == (200, "render", b"0/0/0 256x200")
+    assert fetch(server + "/0/0/0") == (200, "memory", b"0/0/0 256x200")
+    assert fetch(server + "/0/2/0") == (200, "render", b"0/2/0 88x200")
+    assert fetch(server + "/0/1/0") == (204, "render", b"")
+    assert fetch(server + "/0/3/0")[0] == 404
+    assert fetch(server + "/2/0/0")[0] == 404
+    assert fetch(server + "/tiles")[0] == 404
+    assert fetch(server + "/1/2/0")[0] == 404
+    assert fetch(server + "/1/1/0") == (204, "render", b"")
+    # encoding errors fail the request, not the server
+    assert fetch(server + "/1/0/0")[0] == 500
+    assert fetch(server + "/0/0/0") == (200, "memory", b"0/0/0 256x200")
+
+    status, source, data=fetch(server + "/stats")
+    stats=json.loads(data.decode("utf-8"))
+    assert (stats["render"], stats["memory"]) == (4, 2)
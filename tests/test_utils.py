@@ -0,0 +1,11 @@
+import pytest
+
+from utils import find_metadata_item
+
+
+def test_find_metadata_item():
+    metadata = {"Scale_Factor": "0.0001", "_FillValue": "-3000"}
+    assert find_metadata_item(metadata, "scale") == "0.0001"
+    assert find_metadata_item(metadata, "offset", 0) == 0
+    with pytest.raises(IndexError):
+        find_metadata_item(metadata, "offset")